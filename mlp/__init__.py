@@ -1,6 +1,43 @@
 # -*- coding: utf-8 -*-
 """Machine Learning Practical package."""
 
+import numpy as np
+
 __authors__ = ['Pawel Swietojanski', 'Steve Renals', 'Matt Graham']
 
 DEFAULT_SEED = 123456  # Default random number generator seed if none provided.
+
+# Default floating point type of parameters and data if none provided. Single
+# precision halves the memory bandwidth of the (typically bandwidth-bound)
+# layer computations compared to double precision.
+_default_dtype = np.dtype(np.float32)
+
+
+def get_default_dtype():
+    """Returns the default floating point dtype for parameters and data."""
+    return _default_dtype
+
+
+def set_default_dtype(dtype):
+    """Sets the default floating point dtype for parameters and data.
+
+    This is honoured by the parameter initialisers, layers, learning rules
+    and data providers created or called after it is set. For example
+    double precision may be preferable when numerically checking gradients.
+
+    Args:
+        dtype: Floating point numpy dtype (or object convertible to one).
+    """
+    global _default_dtype
+    dtype = np.dtype(dtype)
+    assert np.issubdtype(dtype, np.floating), (
+        'Default dtype must be a floating point type.'
+    )
+    _default_dtype = dtype
+
+
+def resolve_dtype(dtype=None):
+    """Returns `dtype` as a numpy dtype or the default dtype if `None`."""
+    if dtype is None:
+        return _default_dtype
+    return np.dtype(dtype)
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""Array containers.
+
+This module defines array data structures used to pass parameters and their
+gradients between models and learning rules, and sparse activations between
+layers.
+"""
+
+import numpy as np
+
+
+class FlatArrayList(list):
+    """List of arrays which are views into a single contiguous flat array.
+
+    Models storing their parameters (and parameter gradients) contiguously
+    return them as instances of this class, allowing learning rules to update
+    all of them at once with vectorised operations on the flat array rather
+    than looping over the individual arrays.
+    """
+
+    def __init__(self, flat, shapes):
+        """Creates a list of views into a flat array.
+
+        Args:
+            flat: One dimensional C-contiguous array.
+            shapes: Shapes of the consecutive views of `flat` making up the
+                list, which should exactly cover it.
+        """
+        assert flat.ndim == 1 and flat.flags.c_contiguous, (
+            'flat should be a contiguous one dimensional array.'
+        )
+        views = []
+        start = 0
+        for shape in shapes:
+            size = int(np.prod(shape))
+            views.append(flat[start:start + size].reshape(shape))
+            start += size
+        assert start == flat.size, 'shapes should exactly cover flat.'
+        super(FlatArrayList, self).__init__(views)
+        self.flat = flat
+
+    @classmethod
+    def zeros_like(cls, arrays, dtype=None):
+        """Returns a zero-initialised flat list matching a list of arrays.
+
+        Args:
+            arrays: List of arrays to match the shapes (and if `dtype` is
+                `None` the dtype) of.
+            dtype: Dtype of the new arrays, or `None` for the result type of
+                `arrays`.
+        """
+        if dtype is None:
+            dtype = np.result_type(*arrays)
+        return cls(np.zeros(sum(array.size for array in arrays), dtype),
+                   [array.shape for array in arrays])
+
+
+class SliceSparseArray(np.ndarray):
+    """Dense array which is zero outside a subset of slices along one axis.
+
+    Layers may return parameter gradients as (views of ordinary arrays cast
+    to) this class to allow learning rules supporting it to update only the
+    parameter slices with non-zero gradients. Arrays derived from an instance
+    (e.g. by slicing or arithmetic) do not inherit the active slices, and so
+    are treated as dense.
+
+    Attributes:
+        active: Sorted integer array of the indices along `axis` of the
+            slices which may be non-zero, or `None` if unknown.
+        axis: Axis the slices are taken along.
+    """
+
+    @classmethod
+    def wrap(cls, array, active, axis=0):
+        """Returns a view of an array with the given active slices.
+
+        Args:
+            array: Array which is zero outside the active slices.
+            active: Sorted integer array of indices of the active slices.
+            axis: Axis the slices are taken along.
+        """
+        view = array.view(cls)
+        view.active = active
+        view.axis = axis
+        return view
+
+    def __array_finalize__(self, obj):
+        self.active = None
+        self.axis = 0
+
+    def active_index(self):
+        """Returns an index selecting the active slices of the array."""
+        return (slice(None),) * self.axis + (self.active,)
+
+
+class GridBasisArray(object):
+    """Sparse outputs of basis functions along the axes of a regular grid.
+
+    Represents an array of shape `(batch_size, input_dim * grid_dim**input_dim)`
+    which, viewed as shape `(batch_size, input_dim) + (grid_dim,) * input_dim`,
+    holds for each input dimension `k` and grid point the value of a basis
+    function of the grid point's coordinate along grid axis `grid_axes[k]`
+    (so is constant along the other grid axes), as output by a truncated
+    `mlp.layers.RadialBasisFunctionLayer`. Only the basis function values at
+    a few grid coordinates per input dimension are stored, all other values
+    being zero, so the array never needs to be formed densely: products with
+    dense matrices (as computed by an `AffineLayer`) are computed by first
+    summing the matrix over the grid axes the values are constant along.
+
+    Attributes:
+        values: Array of shape `(batch_size, input_dim, num_neighbours)` of
+            the stored basis function values.
+        indices: Integer array of the same shape as `values` of the (distinct
+            for each input and dimension) grid coordinate indices in
+            `[0, grid_dim)` the values correspond to.
+        grid_dim: Number of grid coordinates along each axis.
+        grid_axes: Sequence of the grid axis along which the basis function
+            for each input dimension varies.
+        shape: Shape of the represented (dense) array.
+        dtype: Dtype of the values.
+    """
+
+    def __init__(self, values, indices, grid_dim, grid_axes):
+        """Creates a new grid basis array.
+
+        Args:
+            values: Array of shape `(batch_size, input_dim, num_neighbours)`
+                of basis function values.
+            indices: Integer array of the same shape of the distinct grid
+                coordinate indices of the values along each dimension.
+            grid_dim: Number of grid coordinates along each axis.
+            grid_axes: Sequence of the grid axis along which the basis
+                function for each input dimension varies.
+        """
+        assert values.shape == indices.shape, (
+            'values and indices should have the same shape.'
+        )
+        self.values = values
+        self.indices = indices
+        self.grid_dim = grid_dim
+        self.grid_axes = grid_axes
+        batch_size, input_dim = values.shape[:2]
+        self.shape = (batch_size, input_dim * grid_dim**input_dim)
+        self.dtype = values.dtype
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _grid_shape(self, leading_dim, dim):
+        """Shape to broadcast per grid coordinate values along dimension."""
+        input_dim = self.values.shape[1]
+        shape = [leading_dim] + [1] * input_dim
+        shape[self.grid_axes[dim] + 1] = self.grid_dim
+        return shape
+
+    def _block_view(self, array, dim):
+        """Grid view of the columns of a 2D array for an input dimension."""
+        input_dim = self.values.shape[1]
+        block_size = self.grid_dim**input_dim
+        block = array[:, dim * block_size:(dim + 1) * block_size].view()
+        # assigning the shape raises an error if a copy would be needed
+        block.shape = (array.shape[0],) + (self.grid_dim,) * input_dim
+        return block
+
+    def scattered(self):
+        """Returns the values scattered to all grid coordinates.
+
+        Returns:
+            Array of shape `(batch_size, input_dim, grid_dim)` of the basis
+            function values at every grid coordinate along each dimension.
+        """
+        scattered = np.zeros(self.values.shape[:2] + (self.grid_dim,),
+                             self.dtype)
+        np.put_along_axis(scattered, self.indices, self.values, axis=2)
+        return scattered
+
+    def toarray(self, out=None):
+        """Returns the represented array densely.
+
+        Args:
+            out: Optional array of shape `shape` to write the result to.
+        """
+        if out is None:
+            out = np.empty(self.shape, self.dtype)
+        scattered = self.scattered()
+        for dim in range(scattered.shape[1]):
+            self._block_view(out, dim)[...] = scattered[:, dim].reshape(
+                self._grid_shape(scattered.shape[0], dim))
+        return out
+
+    def dot(self, matrix, out=None):
+        """Returns the matrix product of the array with a dense matrix.
+
+        Args:
+            matrix: Array of shape `(shape[1], num_cols)`.
+            out: Optional array of shape `(shape[0], num_cols)` to write the
+                result to.
+        """
+        batch_size, input_dim = self.values.shape[:2]
+        # sum each dimension's rows of the matrix over the grid axes the
+        # array is constant along
+        summed = np.empty((input_dim, self.grid_dim, matrix.shape[1]),
+                          np.result_type(self.dtype, matrix))
+        for dim in range(input_dim):
+            block = self._block_view(matrix.T, dim)
+            summed[dim] = block.sum(axis=tuple(
+                axis + 1 for axis in range(input_dim)
+                if axis != self.grid_axes[dim])).T
+        return np.dot(self.scattered().reshape((batch_size, -1)),
+                      summed.reshape((-1, matrix.shape[1])), out=out)
+
+    def rdot(self, matrix, out=None):
+        """Returns the matrix product of a dense matrix with the array.
+
+        Args:
+            matrix: Array of shape `(num_rows, shape[0])`.
+            out: Optional array of shape `(num_rows, shape[1])` to write the
+                result to.
+        """
+        batch_size, input_dim = self.values.shape[:2]
+        summed = np.dot(
+            matrix, self.scattered().reshape((batch_size, -1))).reshape(
+                (matrix.shape[0], input_dim, self.grid_dim))
+        if out is None:
+            out = np.empty((matrix.shape[0], self.shape[1]), summed.dtype)
+        for dim in range(input_dim):
+            self._block_view(out, dim)[...] = summed[:, dim].reshape(
+                self._grid_shape(matrix.shape[0], dim))
+        return out
+
+    def __repr__(self):
+        return 'GridBasisArray(shape={0}, num_neighbours={1})'.format(
+            self.shape, self.values.shape[2])
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+"""Convolution algorithm autotuning.
+
+This module defines a plan cache which records, for each convolution problem
+(input shape, kernel shape and dtype), which of the algorithms implemented by
+`mlp.layers.ConvolutionalLayer` was fastest when benchmarked. The fastest
+algorithm differs considerably between e.g. small 3x3 kernels and large
+kernels, so rather than hard-coding a choice it is measured on first use.
+Plans are only kept in memory unless a cache file is given (or set with the
+`MLP_CONV_PLAN_CACHE` environment variable), in which case they are persisted
+to disk so later runs can skip the benchmarking.
+"""
+
+import json
+import os
+import time
+import logging
+import numpy as np
+from mlp import DEFAULT_SEED
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PLAN_CACHE_PATH = os.path.join(
+    os.path.expanduser('~'), '.mlp', 'conv_plans.json')
+
+
+class ConvolutionPlanCache(object):
+    """Benchmarks convolution algorithms and caches the fastest choice.
+
+    Plans are stored in a dictionary mapping the string returned by
+    `layer.plan_key(inputs_shape, dtype)` to an algorithm name, and if a
+    `path` is set saved as JSON to it every time a new plan is added.
+    `DEFAULT_PLAN_CACHE_PATH` is a conventional location for a cache file
+    shared between runs.
+    """
+
+    def __init__(self, path=None, num_repeats=3):
+        """Create a new plan cache object.
+
+        Args:
+            path: Path of JSON file to load plans from and save plans to. If
+                `None` the `MLP_CONV_PLAN_CACHE` environment variable is used
+                if set. If `None` and the variable is not set, or if set to
+                an empty string, plans are only kept in memory.
+            num_repeats (int): Number of timed repeats per algorithm when
+                benchmarking, the minimum time over repeats being used.
+        """
+        if path is None:
+            path = os.environ.get('MLP_CONV_PLAN_CACHE', '')
+        assert num_repeats > 0, 'num_repeats should be positive.'
+        self.path = path
+        self.num_repeats = num_repeats
+        self.plans = {}
+        if self.path and os.path.isfile(self.path):
+            with open(self.path, 'r') as f:
+                self.plans = json.load(f)
+
+    def select(self, layer, inputs_shape, dtype):
+        """Returns the algorithm to use for a layer and input shape.
+
+        If no plan is cached for this problem all algorithms applicable to it
+        are benchmarked and the fastest recorded.
+
+        Args:
+            layer: `ConvolutionalLayer` instance.
+            inputs_shape: Shape of the layer inputs.
+            dtype: Data type of the layer inputs.
+
+        Returns:
+            Name of the algorithm to use.
+        """
+        key = layer.plan_key(inputs_shape, dtype)
+        algorithm = self.plans.get(key)
+        if algorithm is None:
+            timings = self.benchmark(layer, inputs_shape, dtype)
+            algorithm = min(timings, key=timings.get)
+            logger.info('Convolution plan for {0}: {1} ({2})'.format(
+                key, algorithm, ', '.join(
+                    '{0}={1:.2e}s'.format(k, v) for k, v in timings.items())))
+            self.plans[key] = algorithm
+            self.save()
+        return algorithm
+
+    def benchmark(self, layer, inputs_shape, dtype):
+        """Times a forward and backward pass of each applicable algorithm.
+
+        The layer parameters are left unchanged, however its `cache` and
+        padded inputs buffer will be cleared. These are also cleared before
+        each timed repeat so that every repeat (and algorithm) pays the cost
+        of padding and allocating buffers for new inputs.
+
+        Args:
+            layer: `ConvolutionalLayer` instance.
+            inputs_shape: Shape of the layer inputs.
+            dtype: Data type of the layer inputs.
+
+        Returns:
+            Dictionary mapping algorithm names to the time in seconds taken
+            for a call to each of `fprop`, `bprop` and `grads_wrt_params`.
+        """
+        rng = np.random.RandomState(DEFAULT_SEED)
+        inputs = rng.standard_normal(inputs_shape).astype(dtype)
+        timings = {}
+        for algorithm in layer.applicable_algorithms(inputs_shape, dtype):
+            fprop = getattr(layer, '_fprop_' + algorithm)
+            bprop = getattr(layer, '_bprop_' + algorithm)
+            grads_wrt_kernels = getattr(
+                layer, '_grads_wrt_kernels_' + algorithm)
+            best_time = float('inf')
+            for _ in range(self.num_repeats):
+                layer.cache = None
+                layer._padded = None
+                start_time = time.perf_counter()
+                outputs = fprop(inputs)
+                bprop(inputs, outputs)
+                grads_wrt_kernels(inputs, outputs)
+                best_time = min(best_time, time.perf_counter() - start_time)
+            timings[algorithm] = best_time
+        layer.cache = None
+        layer._padded = None
+        return timings
+
+    def save(self):
+        """Writes the cached plans to `path` (if set)."""
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        # write to a temporary file and then move so that concurrent readers
+        # never see a partially written file
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(self.plans, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        """Removes all cached plans (including those saved to disk)."""
+        self.plans = {}
+        self.save()
+
+    def __repr__(self):
+        return 'ConvolutionPlanCache(path={0!r})'.format(self.path)
+
+
+_default_plan_cache = None
+
+
+def get_default_plan_cache():
+    """Returns the plan cache shared by all layers not given their own."""
+    global _default_plan_cache
+    if _default_plan_cache is None:
+        _default_plan_cache = ConvolutionPlanCache()
+    return _default_plan_cache
@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+"""Layer computation backends.
+
+This module defines backends implementing the computationally intensive
+kernels used by the layers in `mlp.layers` (matrix products, convolutions and
+element-wise non-linearities). All backends take and return NumPy arrays, so
+layers using different backends can be freely mixed within a model, with the
+PyTorch backend exchanging data with NumPy without copying via
+`torch.from_numpy`.
+
+Each layer class lists the kernels it needs in its `backend_ops` attribute and
+a layer can be run on any backend implementing all of them. Backends are
+chosen per layer when a model is built, e.g.
+
+    model = MultipleLayerModel(layers, backend='torch')
+
+runs all layers the PyTorch backend supports (e.g. affine and convolutional
+layers) on it and the rest on NumPy. The optional dependencies of a backend
+are only imported when it is first requested using `get_backend`.
+"""
+
+import numpy as np
+
+
+class NumpyBackend(object):
+    """Backend implementing the layer kernels using NumPy (the default)."""
+
+    name = 'numpy'
+
+    # kernels implemented by this backend (convolutions are implemented
+    # directly by `ConvolutionalLayer` when using the NumPy backend)
+    ops = frozenset(['dot', 'sigmoid', 'sigmoid_grad', 'tanh', 'tanh_grad'])
+
+    def dot(self, a, b, out=None):
+        """Matrix product of two 2D arrays, equivalent to `np.dot(a, b, out)`.
+
+        NumPy has no BLAS routines for half precision, so float16 products
+        are instead accumulated in float32 (two orders of magnitude faster and
+        more accurate than the native float16 loop) and cast back to float16.
+        """
+        if a.dtype == np.float16 or b.dtype == np.float16:
+            if out is None:
+                out = np.empty((a.shape[0], b.shape[1]), np.result_type(a, b))
+            return np.matmul(a, b, out=out, dtype=np.float32)
+        return np.dot(a, b, out=out)
+
+    def sigmoid(self, x, out=None):
+        """Element-wise logistic sigmoid `1 / (1 + exp(-x))`."""
+        outputs = np.negative(x, out=out)
+        np.exp(outputs, out=outputs)
+        outputs += 1.
+        return np.reciprocal(outputs, out=outputs)
+
+    def sigmoid_grad(self, y, grads_wrt_y, out=None):
+        """Gradient with respect to sigmoid inputs given its outputs `y`."""
+        grads_wrt_x = np.subtract(1., y, out=out)
+        grads_wrt_x *= y
+        grads_wrt_x *= grads_wrt_y
+        return grads_wrt_x
+
+    def tanh(self, x, out=None):
+        """Element-wise hyperbolic tangent."""
+        return np.tanh(x, out=out)
+
+    def tanh_grad(self, y, grads_wrt_y, out=None):
+        """Gradient with respect to tanh inputs given its outputs `y`."""
+        grads_wrt_x = np.square(y, out=out)
+        np.subtract(1., grads_wrt_x, out=grads_wrt_x)
+        grads_wrt_x *= grads_wrt_y
+        return grads_wrt_x
+
+    def __repr__(self):
+        return '{0}()'.format(type(self).__name__)
+
+
+class TorchBackend(NumpyBackend):
+    """Backend running the layer kernels on PyTorch CPU tensors.
+
+    Arrays are wrapped as tensors sharing their memory and results written
+    directly into NumPy output arrays, so no data is copied between the
+    libraries. PyTorch's convolution kernels are multithreaded and typically
+    considerably faster than the NumPy convolution algorithms.
+    """
+
+    name = 'torch'
+
+    ops = NumpyBackend.ops | frozenset(['conv2d'])
+
+    def __init__(self, num_threads=None):
+        """Creates a new PyTorch backend object.
+
+        Args:
+            num_threads: Number of threads used by PyTorch for intra-op
+                parallelism. If `None` the PyTorch default is used.
+        """
+        import torch
+        self.torch = torch
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def _tensor(self, array):
+        """Returns a tensor sharing memory with an array where possible."""
+        if any(stride < 0 for stride in array.strides):
+            # tensors cannot have negative strides
+            array = array.copy()
+        return self.torch.from_numpy(array)
+
+    def _result(self, tensor, out):
+        """Returns a result tensor as an array, copying it into `out` if set."""
+        if out is None:
+            return tensor.numpy()
+        out[...] = tensor.numpy()
+        return out
+
+    def dot(self, a, b, out=None):
+        if a.dtype == np.float16 or b.dtype == np.float16:
+            return super(TorchBackend, self).dot(a, b, out)
+        if out is None:
+            out = np.empty((a.shape[0], b.shape[1]), np.result_type(a, b))
+        self.torch.matmul(self._tensor(a), self._tensor(b),
+                          out=self.torch.from_numpy(out))
+        return out
+
+    def sigmoid(self, x, out=None):
+        if out is None:
+            out = np.empty_like(x)
+        self.torch.sigmoid(self._tensor(x), out=self.torch.from_numpy(out))
+        return out
+
+    def tanh(self, x, out=None):
+        if out is None:
+            out = np.empty_like(x)
+        self.torch.tanh(self._tensor(x), out=self.torch.from_numpy(out))
+        return out
+
+    def _conv_weight(self, kernels):
+        """Converts convolution kernels to (cross-correlation) weights."""
+        return self.torch.flip(self._tensor(kernels), dims=(2, 3))
+
+    def conv2d(self, inputs, kernels, biases, padding, stride, dilation,
+               out=None):
+        """Computes a 2D convolution (*not* cross-correlation) of the inputs.
+
+        Args:
+            inputs: Array of shape
+                (batch_size, num_input_channels, input_height, input_width).
+            kernels: Array of shape (num_output_channels, num_input_channels,
+                kernel_height, kernel_width).
+            biases: Array of shape (num_output_channels,).
+            padding, stride, dilation: As for `ConvolutionalLayer`.
+            out: Optional array to write the outputs to.
+
+        Returns:
+            Array of shape
+            (batch_size, num_output_channels, output_height, output_width).
+        """
+        outputs = self.torch.nn.functional.conv2d(
+            self._tensor(inputs), self._conv_weight(kernels),
+            self._tensor(biases), stride=stride, padding=padding,
+            dilation=dilation)
+        return self._result(outputs, out)
+
+    def conv2d_grad_wrt_inputs(self, inputs_shape, kernels, grads_wrt_outputs,
+                               padding, stride, dilation, out=None):
+        """Gradient of a 2D convolution with respect to its inputs."""
+        grads_wrt_inputs = self.torch.nn.grad.conv2d_input(
+            inputs_shape, self._conv_weight(kernels),
+            self._tensor(grads_wrt_outputs), stride=stride, padding=padding,
+            dilation=dilation)
+        return self._result(grads_wrt_inputs, out)
+
+    def conv2d_grad_wrt_kernels(self, inputs, kernels_shape,
+                                grads_wrt_outputs, padding, stride, dilation,
+                                out=None):
+        """Gradient of a 2D convolution with respect to its kernels."""
+        grads_wrt_weight = self.torch.nn.grad.conv2d_weight(
+            self._tensor(inputs), kernels_shape,
+            self._tensor(grads_wrt_outputs), stride=stride, padding=padding,
+            dilation=dilation)
+        return self._result(self.torch.flip(grads_wrt_weight, dims=(2, 3)), out)
+
+
+class NumexprBackend(NumpyBackend):
+    """Backend evaluating element-wise kernels using `numexpr`.
+
+    Multi-operation element-wise expressions are evaluated in a single
+    multithreaded pass over cache-sized blocks rather than one pass over
+    memory per NumPy operation. Other kernels use NumPy.
+    """
+
+    name = 'numexpr'
+
+    def __init__(self, num_threads=None):
+        """Creates a new numexpr backend object.
+
+        Args:
+            num_threads: Number of threads used by numexpr. If `None` the
+                numexpr default is used.
+        """
+        import numexpr
+        self.numexpr = numexpr
+        if num_threads is not None:
+            numexpr.set_num_threads(num_threads)
+
+    def _evaluate(self, expression, out, **arrays):
+        # allow writing into lower precision outputs as NumPy ufuncs do
+        return self.numexpr.evaluate(
+            expression, local_dict=arrays, out=out, casting='same_kind')
+
+    def sigmoid(self, x, out=None):
+        return self._evaluate('1 / (1 + exp(-x))', out, x=x)
+
+    def sigmoid_grad(self, y, grads_wrt_y, out=None):
+        return self._evaluate('g * y * (1 - y)', out, y=y, g=grads_wrt_y)
+
+    def tanh(self, x, out=None):
+        return self._evaluate('tanh(x)', out, x=x)
+
+    def tanh_grad(self, y, grads_wrt_y, out=None):
+        return self._evaluate('g * (1 - y * y)', out, y=y, g=grads_wrt_y)
+
+
+_backend_classes = {
+    'numpy': NumpyBackend,
+    'torch': TorchBackend,
+    'numexpr': NumexprBackend,
+}
+
+_backends = {}
+
+
+def register_backend(name, backend_class):
+    """Registers a backend class so it can be requested by name.
+
+    Args:
+        name: Name to register backend under.
+        backend_class: Class (or other callable without arguments) returning
+            a backend object. Only called when the backend is first requested.
+    """
+    _backend_classes[name] = backend_class
+    _backends.pop(name, None)
+
+
+def get_backend(name):
+    """Returns the (shared) backend object registered under a name.
+
+    Raises:
+        ImportError: If the backend's optional dependencies are not installed.
+    """
+    assert name in _backend_classes, (
+        'Unknown backend {0}, expected one of {1}.'.format(
+            name, sorted(_backend_classes))
+    )
+    backend = _backends.get(name)
+    if backend is None:
+        backend = _backend_classes[name]()
+        _backends[name] = backend
+    return backend
+
+
+def available_backends():
+    """Returns the names of the registered backends which can be loaded."""
+    names = []
+    for name in sorted(_backend_classes):
+        try:
+            get_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def supports(backend, layer):
+    """Returns whether a backend implements all kernels a layer uses.
+
+    All layers support the NumPy backend.
+    """
+    return backend.name == 'numpy' or set(layer.backend_ops) <= backend.ops
+
+
+def assign_backends(layers, backend):
+    """Sets the backend of each of a list of layers.
+
+    Args:
+        layers: List of layer objects.
+        backend: Either the name of a backend to use for all the layers it
+            supports (other layers use NumPy), or a list of backend names
+            (or `None` for the NumPy backend) with one entry per layer, in
+            which case every layer must support the backend specified.
+    """
+    if isinstance(backend, str):
+        selected = get_backend(backend)
+        for layer in layers:
+            if layer.backend_ops and supports(selected, layer):
+                layer.backend = selected
+        return
+    assert len(backend) == len(layers), (
+        'Expected one backend per layer, got {0} for {1} layers.'.format(
+            len(backend), len(layers))
+    )
+    for layer, name in zip(layers, backend):
+        selected = get_backend('numpy' if name is None else name)
+        assert supports(selected, layer), (
+            'Backend {0} does not support layer {1}.'.format(name, layer)
+        )
+        layer.backend = selected
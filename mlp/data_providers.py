@@ -9,7 +9,7 @@ import pickle
 import gzip
 import numpy as np
 import os
-from mlp import DEFAULT_SEED
+from mlp import DEFAULT_SEED, get_default_dtype
 
 
 class DataProvider(object):
@@ -137,7 +137,7 @@ class MNISTDataProvider(DataProvider):
     """Data provider for MNIST handwritten digit images."""
 
     def __init__(self, which_set='train', batch_size=100, max_num_batches=-1,
-                 shuffle_order=True, rng=None):
+                 shuffle_order=True, rng=None, one_hot_targets=True):
         """Create a new MNIST data provider object.
 
         Args:
@@ -151,6 +151,10 @@ class MNISTDataProvider(DataProvider):
             shuffle_order (bool): Whether to randomly permute the order of
                 the data before each epoch.
             rng (RandomState): A seeded random number generator.
+            one_hot_targets (bool): Whether to return targets 1 of K coded
+                (see `to_one_of_k`) or, if False, as the integer class
+                labels. The cross entropy errors accept either form, with
+                integer labels avoiding allocating a dense target array.
         """
         # check a valid which_set was provided
         assert which_set in ['train', 'valid', 'test'], (
@@ -159,6 +163,7 @@ class MNISTDataProvider(DataProvider):
         )
         self.which_set = which_set
         self.num_classes = 10
+        self.one_hot_targets = one_hot_targets
         # construct path to data using os.path.join to ensure the correct path
         # separator for the current platform / OS is used
         # MLP_DATA_DIR environment variable should point to the data directory
@@ -170,7 +175,7 @@ class MNISTDataProvider(DataProvider):
         # load data from compressed numpy file
         loaded = np.load(data_path)
         inputs, targets = loaded['inputs'], loaded['targets']
-        inputs = inputs.astype(np.float32)
+        inputs = inputs.astype(get_default_dtype())
         # pass the loaded data to the parent class __init__
         super(MNISTDataProvider, self).__init__(
             inputs, targets, batch_size, max_num_batches, shuffle_order, rng)
@@ -178,6 +183,8 @@ class MNISTDataProvider(DataProvider):
     def next(self):
         """Returns next data batch or raises `StopIteration` if at end."""
         inputs_batch, targets_batch = super(MNISTDataProvider, self).next()
+        if not self.one_hot_targets:
+            return inputs_batch, targets_batch
         return inputs_batch, self.to_one_of_k(targets_batch)
 
     def to_one_of_k(self, int_targets):
@@ -195,7 +202,8 @@ class MNISTDataProvider(DataProvider):
             to zero except for the column corresponding to the correct class
             which is equal to one.
         """
-        one_of_k_targets = np.zeros((int_targets.shape[0], self.num_classes))
+        one_of_k_targets = np.zeros(
+            (int_targets.shape[0], self.num_classes), dtype=get_default_dtype())
         one_of_k_targets[range(int_targets.shape[0]), int_targets] = 1
         return one_of_k_targets
 
@@ -203,7 +211,8 @@ class EMNISTDataProvider(DataProvider):
     """Data provider for EMNIST handwritten digit images."""
 
     def __init__(self, which_set='train', batch_size=100, max_num_batches=-1,
-                 shuffle_order=True, rng=None, flatten=False):
+                 shuffle_order=True, rng=None, flatten=False,
+                 one_hot_targets=True):
         """Create a new EMNIST data provider object.
 
         Args:
@@ -217,6 +226,10 @@ class EMNISTDataProvider(DataProvider):
             shuffle_order (bool): Whether to randomly permute the order of
                 the data before each epoch.
             rng (RandomState): A seeded random number generator.
+            one_hot_targets (bool): Whether to return targets 1 of K coded
+                (see `to_one_of_k`) or, if False, as the integer class
+                labels. The cross entropy errors accept either form, with
+                integer labels avoiding allocating a dense target array.
         """
         # check a valid which_set was provided
         assert which_set in ['train', 'valid', 'test'], (
@@ -225,6 +238,7 @@ class EMNISTDataProvider(DataProvider):
         )
         self.which_set = which_set
         self.num_classes = 47
+        self.one_hot_targets = one_hot_targets
         # construct path to data using os.path.join to ensure the correct path
         # separator for the current platform / OS is used
         # MLP_DATA_DIR environment variable should point to the data directory
@@ -237,11 +251,11 @@ class EMNISTDataProvider(DataProvider):
         loaded = np.load(data_path)
         print(loaded.keys())
         inputs, targets = loaded['inputs'], loaded['targets']
-        inputs = inputs.astype(np.float32)
+        inputs = inputs.astype(get_default_dtype())
         if flatten:
-            inputs = np.reshape(inputs, newshape=(-1, 28*28))
+            inputs = np.reshape(inputs, (-1, 28*28))
         else:
-            inputs = np.reshape(inputs, newshape=(-1, 1, 28, 28))
+            inputs = np.reshape(inputs, (-1, 1, 28, 28))
         inputs = inputs / 255.0
         # pass the loaded data to the parent class __init__
         super(EMNISTDataProvider, self).__init__(
@@ -250,6 +264,8 @@ class EMNISTDataProvider(DataProvider):
     def next(self):
         """Returns next data batch or raises `StopIteration` if at end."""
         inputs_batch, targets_batch = super(EMNISTDataProvider, self).next()
+        if not self.one_hot_targets:
+            return inputs_batch, targets_batch
         return inputs_batch, self.to_one_of_k(targets_batch)
 
     def to_one_of_k(self, int_targets):
@@ -267,7 +283,8 @@ class EMNISTDataProvider(DataProvider):
             to zero except for the column corresponding to the correct class
             which is equal to one.
         """
-        one_of_k_targets = np.zeros((int_targets.shape[0], self.num_classes))
+        one_of_k_targets = np.zeros(
+            (int_targets.shape[0], self.num_classes), dtype=get_default_dtype())
         one_of_k_targets[range(int_targets.shape[0]), int_targets] = 1
         return one_of_k_targets
 
@@ -306,7 +323,7 @@ class MetOfficeDataProvider(DataProvider):
         # normalise data to zero mean, unit standard deviation
         mean = np.mean(filtered)
         std = np.std(filtered)
-        normalised = (filtered - mean) / std
+        normalised = ((filtered - mean) / std).astype(get_default_dtype())
         # create a view on to array corresponding to a rolling window
         shape = (normalised.shape[-1] - self.window_size + 1, self.window_size)
         strides = normalised.strides + (normalised.strides[-1],)
@@ -352,7 +369,7 @@ class CCPPDataProvider(DataProvider):
             'Got {0}'.format(which_set)
         )
         # check input_dims are valid
-        if not input_dims is not None:
+        if input_dims is not None:
             input_dims = set(input_dims)
             assert input_dims.issubset({0, 1, 2, 3}), (
                 'input_dims should be a subset of {0, 1, 2, 3}'
@@ -360,8 +377,10 @@ class CCPPDataProvider(DataProvider):
         loaded = np.load(data_path)
         inputs = loaded[which_set + '_inputs']
         if input_dims is not None:
-            inputs = inputs[:, input_dims]
+            inputs = inputs[:, sorted(input_dims)]
         targets = loaded[which_set + '_targets']
+        inputs = inputs.astype(get_default_dtype())
+        targets = targets.astype(get_default_dtype())
         super(CCPPDataProvider, self).__init__(
             inputs, targets, batch_size, max_num_batches, shuffle_order, rng)
 
@@ -12,6 +12,26 @@ or batch.
 import numpy as np
 
 
+def _cast_targets(targets, outputs):
+    """Casts targets to the outputs dtype so they do not upcast the error.
+
+    For example float64 targets combined with float32 model outputs would
+    otherwise give float64 gradients, doubling the memory traffic of the
+    whole backwards pass.
+    """
+    return targets.astype(outputs.dtype, copy=False)
+
+
+def _is_labels(targets):
+    """Returns whether targets are integer labels of shape (batch_size,)."""
+    return targets.ndim == 1 and np.issubdtype(targets.dtype, np.integer)
+
+
+def _gather(outputs, labels):
+    """Returns the outputs for the labelled class of each data point."""
+    return outputs[np.arange(outputs.shape[0]), labels]
+
+
 class SumOfSquaredDiffsError(object):
     """Sum of squared differences (squared Euclidean distance) error."""
 
@@ -25,6 +45,7 @@ class SumOfSquaredDiffsError(object):
         Returns:
             Scalar cost function value.
         """
+        targets = _cast_targets(targets, outputs)
         return 0.5 * np.mean(np.sum((outputs - targets)**2, axis=1))
 
     def grad(self, outputs, targets):
@@ -37,8 +58,30 @@ class SumOfSquaredDiffsError(object):
         Returns:
             Gradient of error function with respect to outputs.
         """
+        targets = _cast_targets(targets, outputs)
         return (outputs - targets) / outputs.shape[0]
 
+    def value_and_grad(self, outputs, targets):
+        """Calculates error function value and its gradient wrt the outputs.
+
+        Equivalent to `(self(outputs, targets), self.grad(outputs, targets))`
+        but computing the differences between the outputs and targets once,
+        with the gradient computed from them in-place.
+
+        Args:
+            outputs: Array of model outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim).
+
+        Returns:
+            Tuple `(value, grads_wrt_outputs)` of the scalar error function
+            value and its gradient with respect to the outputs.
+        """
+        targets = _cast_targets(targets, outputs)
+        diffs = outputs - targets
+        value = 0.5 * np.mean(np.sum(diffs**2, axis=1))
+        diffs /= outputs.shape[0]
+        return value, diffs
+
     def __repr__(self):
         return 'MeanSquaredErrorCost'
 
@@ -56,8 +99,9 @@ class BinaryCrossEntropyError(object):
         Returns:
             Scalar error function value.
         """
+        targets = _cast_targets(targets, outputs)
         return -np.mean(
-            targets * np.log(outputs) + (1. - targets) * np.log(1. - ouputs))
+            targets * np.log(outputs) + (1. - targets) * np.log(1. - outputs))
 
     def grad(self, outputs, targets):
         """Calculates gradient of error function with respect to outputs.
@@ -69,9 +113,35 @@ class BinaryCrossEntropyError(object):
         Returns:
             Gradient of error function with respect to outputs.
         """
+        targets = _cast_targets(targets, outputs)
         return ((1. - targets) / (1. - outputs) -
                 (targets / outputs)) / outputs.shape[0]
 
+    def value_and_grad(self, outputs, targets):
+        """Calculates error function value and its gradient wrt the outputs.
+
+        Equivalent to `(self(outputs, targets), self.grad(outputs, targets))`
+        but computing `1 - outputs` and `1 - targets` once for both.
+
+        Args:
+            outputs: Array of model outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim).
+
+        Returns:
+            Tuple `(value, grads_wrt_outputs)` of the scalar error function
+            value and its gradient with respect to the outputs.
+        """
+        targets = _cast_targets(targets, outputs)
+        one_minus_outputs = 1. - outputs
+        one_minus_targets = 1. - targets
+        value = -np.mean(targets * np.log(outputs) +
+                         one_minus_targets * np.log(one_minus_outputs))
+        grads = one_minus_targets
+        grads /= one_minus_outputs
+        grads -= targets / outputs
+        grads /= outputs.shape[0]
+        return value, grads
+
     def __repr__(self):
         return 'BinaryCrossEntropyError'
 
@@ -89,6 +159,7 @@ class BinaryCrossEntropySigmoidError(object):
         Returns:
             Scalar error function value.
         """
+        targets = _cast_targets(targets, outputs)
         probs = 1. / (1. + np.exp(-outputs))
         return -np.mean(
             targets * np.log(probs) + (1. - targets) * np.log(1. - probs))
@@ -103,26 +174,57 @@ class BinaryCrossEntropySigmoidError(object):
         Returns:
             Gradient of error function with respect to outputs.
         """
+        targets = _cast_targets(targets, outputs)
         probs = 1. / (1. + np.exp(-outputs))
         return (probs - targets) / outputs.shape[0]
 
+    def value_and_grad(self, outputs, targets):
+        """Calculates error function value and its gradient wrt the outputs.
+
+        Equivalent to `(self(outputs, targets), self.grad(outputs, targets))`
+        but applying the logistic sigmoid to the outputs once, with the
+        gradient computed from the probabilities in-place.
+
+        Args:
+            outputs: Array of model outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim).
+
+        Returns:
+            Tuple `(value, grads_wrt_outputs)` of the scalar error function
+            value and its gradient with respect to the outputs.
+        """
+        targets = _cast_targets(targets, outputs)
+        probs = 1. / (1. + np.exp(-outputs))
+        value = -np.mean(
+            targets * np.log(probs) + (1. - targets) * np.log(1. - probs))
+        probs -= targets
+        probs /= outputs.shape[0]
+        return value, probs
+
     def __repr__(self):
         return 'BinaryCrossEntropySigmoidError'
 
 
 class CrossEntropyError(object):
-    """Multi-class cross entropy error."""
+    """Multi-class cross entropy error.
+
+    Targets may be given either 1 of K coded or as integer class labels.
+    """
 
     def __call__(self, outputs, targets):
         """Calculates error function given a batch of outputs and targets.
 
         Args:
             outputs: Array of model outputs of shape (batch_size, output_dim).
-            targets: Array of target outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
 
         Returns:
             Scalar error function value.
         """
+        if _is_labels(targets):
+            return -np.mean(np.log(_gather(outputs, targets)))
+        targets = _cast_targets(targets, outputs)
         return -np.mean(np.sum(targets * np.log(outputs), axis=1))
 
     def grad(self, outputs, targets):
@@ -130,32 +232,73 @@ class CrossEntropyError(object):
 
         Args:
             outputs: Array of model outputs of shape (batch_size, output_dim).
-            targets: Array of target outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
 
         Returns:
             Gradient of error function with respect to outputs.
         """
+        if _is_labels(targets):
+            grads = np.zeros_like(outputs)
+            grads[np.arange(outputs.shape[0]), targets] = (
+                -1. / outputs.shape[0]) / _gather(outputs, targets)
+            return grads
+        targets = _cast_targets(targets, outputs)
         return -(targets / outputs) / outputs.shape[0]
 
+    def value_and_grad(self, outputs, targets):
+        """Calculates error function value and its gradient wrt the outputs.
+
+        Equivalent to `(self(outputs, targets), self.grad(outputs, targets))`
+        but, for integer class labels, gathering the outputs of the
+        labelled classes once for both.
+
+        Args:
+            outputs: Array of model outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
+
+        Returns:
+            Tuple `(value, grads_wrt_outputs)` of the scalar error function
+            value and its gradient with respect to the outputs.
+        """
+        if _is_labels(targets):
+            labelled_outputs = _gather(outputs, targets)
+            grads = np.zeros_like(outputs)
+            grads[np.arange(outputs.shape[0]), targets] = (
+                -1. / outputs.shape[0]) / labelled_outputs
+            return -np.mean(np.log(labelled_outputs)), grads
+        targets = _cast_targets(targets, outputs)
+        value = -np.mean(np.sum(targets * np.log(outputs), axis=1))
+        return value, -(targets / outputs) / outputs.shape[0]
+
     def __repr__(self):
         return 'CrossEntropyError'
 
 
 class CrossEntropySoftmaxError(object):
-    """Multi-class cross entropy error with Softmax applied to outputs."""
+    """Multi-class cross entropy error with Softmax applied to outputs.
+
+    Targets may be given either 1 of K coded or as integer class labels.
+    """
 
     def __call__(self, outputs, targets):
         """Calculates error function given a batch of outputs and targets.
 
         Args:
             outputs: Array of model outputs of shape (batch_size, output_dim).
-            targets: Array of target outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
 
         Returns:
             Scalar error function value.
         """
         normOutputs = outputs - outputs.max(-1)[:, None]
-        logProb = normOutputs - np.log(np.sum(np.exp(normOutputs), axis=-1)[:, None])
+        logNorm = np.log(np.sum(np.exp(normOutputs), axis=-1))
+        if _is_labels(targets):
+            return -np.mean(_gather(normOutputs, targets) - logNorm)
+        targets = _cast_targets(targets, outputs)
+        logProb = normOutputs - logNorm[:, None]
         return -np.mean(np.sum(targets * logProb, axis=1))
 
     def grad(self, outputs, targets):
@@ -163,14 +306,81 @@ class CrossEntropySoftmaxError(object):
 
         Args:
             outputs: Array of model outputs of shape (batch_size, output_dim).
-            targets: Array of target outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
 
         Returns:
             Gradient of error function with respect to outputs.
         """
         probs = np.exp(outputs - outputs.max(-1)[:, None])
         probs /= probs.sum(-1)[:, None]
+        if _is_labels(targets):
+            probs[np.arange(outputs.shape[0]), targets] -= 1.
+            probs /= outputs.shape[0]
+            return probs
+        targets = _cast_targets(targets, outputs)
         return (probs - targets) / outputs.shape[0]
 
+    def value_and_grad(self, outputs, targets):
+        """Calculates error function value and its gradient wrt the outputs.
+
+        Equivalent to `(self(outputs, targets), self.grad(outputs, targets))`
+        but computing the exponentiated normalised outputs once, for both the
+        log normaliser and the softmax probabilities the gradient is computed
+        from in-place.
+
+        Args:
+            outputs: Array of model outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
+
+        Returns:
+            Tuple `(value, grads_wrt_outputs)` of the scalar error function
+            value and its gradient with respect to the outputs.
+        """
+        normOutputs = outputs - outputs.max(-1)[:, None]
+        probs = np.exp(normOutputs)
+        sumExp = probs.sum(-1)
+        logNorm = np.log(sumExp)
+        probs /= sumExp[:, None]
+        if _is_labels(targets):
+            value = -np.mean(_gather(normOutputs, targets) - logNorm)
+            probs[np.arange(outputs.shape[0]), targets] -= 1.
+        else:
+            targets = _cast_targets(targets, outputs)
+            normOutputs -= logNorm[:, None]
+            value = -np.mean(np.sum(targets * normOutputs, axis=1))
+            probs -= targets
+        probs /= outputs.shape[0]
+        return value, probs
+
     def __repr__(self):
         return 'CrossEntropySoftmaxError'
+
+
+class ClassificationAccuracy(object):
+    """Classification accuracy data monitor.
+
+    Proportion of data points for which the largest model output corresponds
+    to the target class, with targets either 1 of K coded or integer class
+    labels. This is not differentiable so it has no `grad` method and is
+    intended for use as a data monitor rather than a training error.
+    """
+
+    def __call__(self, outputs, targets):
+        """Calculates accuracy given a batch of outputs and targets.
+
+        Args:
+            outputs: Array of model outputs of shape (batch_size, output_dim).
+            targets: Array of target outputs of shape (batch_size, output_dim)
+                or integer class labels of shape (batch_size,).
+
+        Returns:
+            Scalar accuracy in [0, 1].
+        """
+        if not _is_labels(targets):
+            targets = targets.argmax(-1)
+        return np.mean(outputs.argmax(-1) == targets)
+
+    def __repr__(self):
+        return 'ClassificationAccuracy'
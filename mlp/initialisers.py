@@ -2,67 +2,82 @@
 """Parameter initialisers.
 
 This module defines classes to initialise the parameters in a layer.
+
+All initialisers return arrays of the dtype given on construction or, if none
+was given, the package default dtype (see `mlp.set_default_dtype`) at the
+time they are called.
 """
 
 import numpy as np
-from mlp import DEFAULT_SEED
+from mlp import DEFAULT_SEED, resolve_dtype
 
 
 class ConstantInit(object):
     """Constant parameter initialiser."""
 
-    def __init__(self, value):
+    def __init__(self, value, dtype=None):
         """Construct a constant parameter initialiser.
 
         Args:
             value: Value to initialise parameter to.
+            dtype: Data type of initialised parameters. If `None` the default
+                dtype is used.
         """
         self.value = value
+        self.dtype = dtype
 
     def __call__(self, shape):
-        return np.ones(shape=shape) * self.value
+        return np.full(shape, self.value, dtype=resolve_dtype(self.dtype))
 
 
 class UniformInit(object):
     """Random uniform parameter initialiser."""
 
-    def __init__(self, low, high, rng=None):
+    def __init__(self, low, high, rng=None, dtype=None):
         """Construct a random uniform parameter initialiser.
 
         Args:
             low: Lower bound of interval to sample from.
             high: Upper bound of interval to sample from.
             rng (RandomState): Seeded random number generator.
+            dtype: Data type of initialised parameters. If `None` the default
+                dtype is used.
         """
         self.low = low
         self.high = high
         if rng is None:
             rng = np.random.RandomState(DEFAULT_SEED)
         self.rng = rng
+        self.dtype = dtype
 
     def __call__(self, shape):
-        return self.rng.uniform(low=self.low, high=self.high, size=shape)
+        return self.rng.uniform(low=self.low, high=self.high, size=shape).astype(
+            resolve_dtype(self.dtype), copy=False)
 
 
 class NormalInit(object):
     """Random normal parameter initialiser."""
 
-    def __init__(self, mean, std, rng=None):
+    def __init__(self, mean, std, rng=None, dtype=None):
         """Construct a random uniform parameter initialiser.
 
         Args:
             mean: Mean of distribution to sample from.
             std: Standard deviation of distribution to sample from.
             rng (RandomState): Seeded random number generator.
+            dtype: Data type of initialised parameters. If `None` the default
+                dtype is used.
         """
         self.mean = mean
         self.std = std
         if rng is None:
             rng = np.random.RandomState(DEFAULT_SEED)
         self.rng = rng
+        self.dtype = dtype
 
     def __call__(self, shape):
-        return self.rng.normal(loc=self.mean, scale=self.std, size=shape)
+        return self.rng.normal(loc=self.mean, scale=self.std, size=shape).astype(
+            resolve_dtype(self.dtype), copy=False)
 
 class GlorotUniformInit(object):
     """Glorot and Bengio (2010) random uniform weights initialiser.
@@ -83,7 +98,7 @@ class GlorotUniformInit(object):
            networks, Glorot and Bengio (2010)
     """
 
-    def __init__(self, gain=1., rng=None):
+    def __init__(self, gain=1., rng=None, dtype=None):
         """Construct a normalised initilisation random initialiser object.
 
         Args:
@@ -91,18 +106,23 @@ class GlorotUniformInit(object):
                 Recommended values is 1 for affine layers followed by
                 logistic sigmoid layers (or another affine layer).
             rng (RandomState): Seeded random number generator.
+            dtype: Data type of initialised parameters. If `None` the default
+                dtype is used.
         """
         self.gain = gain
         if rng is None:
             rng = np.random.RandomState(DEFAULT_SEED)
         self.rng = rng
+        self.dtype = dtype
 
     def __call__(self, shape):
         assert len(shape) == 2, (
             'Initialiser should only be used for two dimensional arrays.')
         std = self.gain * (2. / (shape[0] + shape[1]))**0.5
         half_width = 3.**0.5 * std
-        return self.rng.uniform(low=-half_width, high=half_width, size=shape)
+        return self.rng.uniform(
+            low=-half_width, high=half_width, size=shape).astype(
+                resolve_dtype(self.dtype), copy=False)
 
 
 class GlorotNormalInit(object):
@@ -124,7 +144,7 @@ class GlorotNormalInit(object):
            networks, Glorot and Bengio (2010)
     """
 
-    def __init__(self, gain=1., rng=None):
+    def __init__(self, gain=1., rng=None, dtype=None):
         """Construct a normalised initilisation random initialiser object.
 
         Args:
@@ -132,12 +152,16 @@ class GlorotNormalInit(object):
                 Recommended values is 1 for affine layers followed by
                 logistic sigmoid layers (or another affine layer).
             rng (RandomState): Seeded random number generator.
+            dtype: Data type of initialised parameters. If `None` the default
+                dtype is used.
         """
         self.gain = gain
         if rng is None:
             rng = np.random.RandomState(DEFAULT_SEED)
         self.rng = rng
+        self.dtype = dtype
 
     def __call__(self, shape):
         std = self.gain * (2. / (shape[0] + shape[1]))**0.5
-        return self.rng.normal(loc=0., scale=std, size=shape)
+        return self.rng.normal(loc=0., scale=std, size=shape).astype(
+            resolve_dtype(self.dtype), copy=False)
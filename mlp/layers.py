@@ -12,26 +12,58 @@ methods for getting and setting parameter and calculating gradients with
 respect to the layer parameters.
 """
 
+import copy
+import threading
 import numpy as np
 import mlp.initialisers as init
-from mlp import DEFAULT_SEED
+import mlp.autotuner as autotuner
+import mlp.backends as backends
+from mlp import DEFAULT_SEED, get_default_dtype
+from mlp.arrays import GridBasisArray, SliceSparseArray
 
 
 class Layer(object):
-    """Abstract class defining the interface for a layer."""
+    """Abstract class defining the interface for a layer.
+
+    The `fprop`, `bprop` and (where defined) `grads_wrt_params` methods accept
+    an optional `out` argument specifying preallocated array(s) to write their
+    results to, allowing models to reuse buffers across batches rather than
+    allocating new arrays on each call. Layers whose outputs are views of their
+    inputs (e.g. `ReshapeLayer`) may ignore `out`, so callers should always use
+    the returned array.
+
+    Layers performing substantial computation do so using the kernels of
+    their `backend` (see `mlp.backends`), which defaults to NumPy. The names of
+    the kernels used are listed in `backend_ops`.
+    """
+
+    # names of backend kernels used by the layer
+    backend_ops = ()
+
+    backend = backends.get_backend('numpy')
+
+    # attributes holding per-call state (e.g. caches of intermediate results
+    # from the forward pass) which are reset in replicas
+    _state_attributes = ()
+
+    # attributes caching intermediate results of the forward pass for reuse
+    # in the backward pass, which are recomputed if missing
+    _cache_attributes = ()
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
         raise NotImplementedError()
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -43,6 +75,8 @@ class Layer(object):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
@@ -50,17 +84,81 @@ class Layer(object):
         """
         raise NotImplementedError()
 
+    def _scratch(self, name, shape, dtype):
+        """Returns an internal scratch array reused across calls.
+
+        A new array is only allocated when no scratch array with this name,
+        shape and dtype exists. Scratch arrays must never be returned from
+        the public methods as they are overwritten by subsequent calls.
+        """
+        buffers = self.__dict__.setdefault('_scratch_buffers', {})
+        buffer = buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = np.empty(shape, dtype=dtype)
+            buffers[name] = buffer
+        return buffer
+
+    def clear_cache(self):
+        """Drops any cached intermediate results of the forward pass.
+
+        The results are recomputed if needed in the backward pass, so this
+        only frees the memory they use, including any reference to the
+        inputs they were computed from.
+        """
+        for name in self._cache_attributes:
+            setattr(self, name, None)
+
+    def replicate(self, drop_penalties=False):
+        """Returns a replica of the layer which can be used concurrently.
+
+        The replica shares the layer's parameters (and configuration) but has
+        its own scratch arrays and cached intermediate state, so the layer and
+        its replicas can process different inputs at the same time, e.g. on
+        different threads.
+
+        Args:
+            drop_penalties: Whether to remove any parameter penalties from the
+                replica, e.g. so that when summing the parameter gradients of
+                several replicas the penalty gradients are only included once.
+        """
+        replica = copy.copy(self)
+        replica.__dict__.pop('_scratch_buffers', None)
+        for name in self._state_attributes:
+            setattr(replica, name, None)
+        if drop_penalties:
+            for name in list(vars(replica)):
+                if name.endswith('_penalty'):
+                    setattr(replica, name, None)
+        return replica
+
 
 class LayerWithParameters(Layer):
-    """Abstract class defining the interface for a layer with parameters."""
+    """Abstract class defining the interface for a layer with parameters.
+
+    Layers may optionally also define a method
 
-    def grads_wrt_params(self, inputs, grads_wrt_outputs):
+        backward(inputs, outputs, grads_wrt_outputs, grads_wrt_inputs=True,
+                 out=None, params_out=None)
+
+    returning a tuple `(grads_wrt_inputs, grads_wrt_params)` equal to the
+    results of `bprop` and `grads_wrt_params` (with `out` and `params_out`
+    the respective `out` arguments), which models use in place of the two
+    separate calls. This allows intermediate results needed by both to be
+    computed once, and the gradients with respect to the inputs to be
+    skipped (`None` being returned instead) if `grads_wrt_inputs` is False,
+    e.g. for the first layer of a model.
+    """
+
+    def grads_wrt_params(self, inputs, grads_wrt_outputs, out=None):
         """Calculates gradients with respect to layer parameters.
 
         Args:
             inputs: Array of inputs to layer of shape (batch_size, input_dim).
             grads_wrt_to_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional list of arrays, of the same shapes as the layer
+                parameters, to write the gradients to. If `None` new arrays
+                are allocated.
 
         Returns:
             List of arrays of gradients with respect to the layer parameters
@@ -76,6 +174,32 @@ class LayerWithParameters(Layer):
         """
         raise NotImplementedError()
 
+    # whether `grads_wrt_params` includes the gradients of the parameter
+    # penalties, which is not needed when they are instead applied by the
+    # learning rule (see `Optimiser`)
+    include_penalty_grads = True
+
+    @property
+    def penalties(self):
+        """List of the penalties of each parameter (`None` if unpenalised).
+
+        The list is in the same order as `params`.
+        """
+        return [None] * len(self.params)
+
+    def _add_penalty_grads(self, grads_wrt_params):
+        """Adds the gradients of the parameter penalties in-place.
+
+        Nothing is added if `include_penalty_grads` is False.
+        """
+        if not self.include_penalty_grads:
+            return
+        for i, (penalty, param, grad) in enumerate(
+                zip(self.penalties, self.params, grads_wrt_params)):
+            if penalty is not None:
+                penalty.add_grad(param, grad, self._scratch(
+                    'penalty_grad_{0}'.format(i), param.shape, grad.dtype))
+
     @property
     def params(self):
         """Returns a list of parameters of layer.
@@ -97,7 +221,33 @@ class LayerWithParameters(Layer):
         raise NotImplementedError()
 
 
-class StochasticLayerWithParameters(Layer):
+class _RandomStateMixin(object):
+    """Mixin for stochastic layers saving and restoring their `rng` state."""
+
+    def get_rng_state(self):
+        """Returns the state of the layer's random number generator.
+
+        Restoring the state with `set_rng_state` before repeating a
+        stochastic forward propagation reproduces the same random sample,
+        e.g. when recomputing discarded activations in a backward pass.
+        """
+        if isinstance(self.rng, np.random.Generator):
+            return self.rng.bit_generator.state
+        return self.rng.get_state()
+
+    def set_rng_state(self, state):
+        """Sets the state of the layer's random number generator.
+
+        Args:
+            state: State previously returned by `get_rng_state`.
+        """
+        if isinstance(self.rng, np.random.Generator):
+            self.rng.bit_generator.state = state
+        else:
+            self.rng.set_state(state)
+
+
+class StochasticLayerWithParameters(_RandomStateMixin, Layer):
     """Specialised layer which uses a stochastic forward propagation."""
 
     def __init__(self, rng=None):
@@ -110,7 +260,7 @@ class StochasticLayerWithParameters(Layer):
             rng = np.random.RandomState(DEFAULT_SEED)
         self.rng = rng
 
-    def fprop(self, inputs, stochastic=True):
+    def fprop(self, inputs, stochastic=True, out=None):
         """Forward propagates activations through the layer transformation.
 
         Args:
@@ -121,19 +271,24 @@ class StochasticLayerWithParameters(Layer):
                 a deterministic forward-propagation transformation
                 corresponding to the expected output of the stochastic
                 forward-propagation is applied.
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
         raise NotImplementedError()
 
-    def grads_wrt_params(self, inputs, grads_wrt_outputs):
+    def grads_wrt_params(self, inputs, grads_wrt_outputs, out=None):
         """Calculates gradients with respect to layer parameters.
 
         Args:
             inputs: Array of inputs to layer of shape (batch_size, input_dim).
             grads_wrt_to_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional list of arrays, of the same shapes as the layer
+                parameters, to write the gradients to. If `None` new arrays
+                are allocated.
 
         Returns:
             List of arrays of gradients with respect to the layer parameters
@@ -170,7 +325,7 @@ class StochasticLayerWithParameters(Layer):
         raise NotImplementedError()
 
 
-class StochasticLayer(Layer):
+class StochasticLayer(_RandomStateMixin, Layer):
     """Specialised layer which uses a stochastic forward propagation."""
 
     def __init__(self, rng=None):
@@ -183,7 +338,7 @@ class StochasticLayer(Layer):
             rng = np.random.RandomState(DEFAULT_SEED)
         self.rng = rng
 
-    def fprop(self, inputs, stochastic=True):
+    def fprop(self, inputs, stochastic=True, out=None):
         """Forward propagates activations through the layer transformation.
 
         Args:
@@ -194,13 +349,15 @@ class StochasticLayer(Layer):
                 a deterministic forward-propagation transformation
                 corresponding to the expected output of the stochastic
                 forward-propagation is applied.
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
         raise NotImplementedError()
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -213,6 +370,8 @@ class StochasticLayer(Layer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
@@ -227,10 +386,13 @@ class AffineLayer(LayerWithParameters):
     This layer is parameterised by a weight matrix and bias vector.
     """
 
+    backend_ops = ('dot',)
+
     def __init__(self, input_dim, output_dim,
                  weights_initialiser=init.UniformInit(-0.1, 0.1),
                  biases_initialiser=init.ConstantInit(0.),
-                 weights_penalty=None, biases_penalty=None):
+                 weights_penalty=None, biases_penalty=None,
+                 sparse_grads=False):
         """Initialises a parameterised affine layer.
 
         Args:
@@ -242,29 +404,44 @@ class AffineLayer(LayerWithParameters):
                 None if no regularisation is to be applied to the weights.
             biases_penalty: Biases-dependent penalty term (regulariser) or
                 None if no regularisation is to be applied to the biases.
+            sparse_grads: Whether to return the gradients with respect to the
+                weights as a `SliceSparseArray` recording which weight
+                columns (input dimensions) are non-zero in the batch. Only
+                these columns are computed, and learning rules supporting
+                sparse gradients only update them, which is worthwhile for
+                sparse inputs e.g. one-hot encodings.
         """
         self.input_dim = input_dim
         self.output_dim = output_dim
+        self.sparse_grads = sparse_grads
         self.weights = weights_initialiser((self.output_dim, self.input_dim))
         self.biases = biases_initialiser(self.output_dim)
         self.weights_penalty = weights_penalty
         self.biases_penalty = biases_penalty
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         For inputs `x`, outputs `y`, weights `W` and biases `b` the layer
         corresponds to `y = W.dot(x) + b`.
 
         Args:
-            inputs: Array of layer inputs of shape (batch_size, input_dim).
+            inputs: Array of layer inputs of shape (batch_size, input_dim),
+                which may be a sparse `GridBasisArray`.
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
-        return self.weights.dot(inputs.T).T + self.biases
+        if isinstance(inputs, GridBasisArray):
+            outputs = inputs.dot(self.weights.T, out=out)
+        else:
+            outputs = self.backend.dot(inputs, self.weights.T, out=out)
+        outputs += self.biases
+        return outputs
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -276,36 +453,104 @@ class AffineLayer(LayerWithParameters):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        return grads_wrt_outputs.dot(self.weights)
+        return self.backend.dot(grads_wrt_outputs, self.weights, out=out)
 
-    def grads_wrt_params(self, inputs, grads_wrt_outputs):
+    def grads_wrt_params(self, inputs, grads_wrt_outputs, out=None):
         """Calculates gradients with respect to layer parameters.
 
         Args:
             inputs: array of inputs to layer of shape (batch_size, input_dim)
             grads_wrt_to_outputs: array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim)
+            out: optional list of arrays `[weights_buffer, biases_buffer]` to
+                write the gradients to. If `None` new arrays are allocated.
 
         Returns:
             list of arrays of gradients with respect to the layer parameters
             `[grads_wrt_weights, grads_wrt_biases]`.
         """
+        if out is None:
+            out = [None, None]
 
-        grads_wrt_weights = np.dot(grads_wrt_outputs.T, inputs)
-        grads_wrt_biases = np.sum(grads_wrt_outputs, axis=0)
+        grads_wrt_weights = self._grads_wrt_weights(
+            inputs, grads_wrt_outputs, out[0])
+        return self._grads_wrt_params(
+            grads_wrt_weights, grads_wrt_outputs, out[1])
 
-        if self.weights_penalty is not None:
-            grads_wrt_weights += self.weights_penalty.grad(parameter=self.weights)
+    def backward(self, inputs, outputs, grads_wrt_outputs,
+                 grads_wrt_inputs=True, out=None, params_out=None):
+        """Calculates gradients with respect to the inputs and parameters.
 
-        if self.biases_penalty is not None:
-            grads_wrt_biases += self.biases_penalty.grad(parameter=self.biases)
+        Equivalent to calling `bprop` and `grads_wrt_params` but with the
+        output gradients made contiguous once for both matrix products, and
+        the gradients with respect to the inputs only computed if required.
 
-        return [grads_wrt_weights, grads_wrt_biases]
+        Args:
+            inputs: Array of layer inputs of shape (batch_size, input_dim).
+            outputs: Array of layer outputs of shape (batch_size, output_dim).
+            grads_wrt_outputs: Array of gradients with respect to the layer
+                outputs of shape (batch_size, output_dim).
+            grads_wrt_inputs: Whether to calculate the gradients with respect
+                to the inputs.
+            out: Optional array to write the gradients with respect to the
+                inputs to.
+            params_out: Optional list of arrays to write the gradients with
+                respect to the parameters to.
+
+        Returns:
+            Tuple `(grads_wrt_inputs, grads_wrt_params)`, the former being
+            `None` if `grads_wrt_inputs` is False.
+        """
+        if params_out is None:
+            params_out = [None, None]
+        grads_wrt_outputs = np.ascontiguousarray(grads_wrt_outputs)
+        grads_wrt_weights = self._grads_wrt_weights(
+            inputs, grads_wrt_outputs, params_out[0])
+        grads_wrt_params = self._grads_wrt_params(
+            grads_wrt_weights, grads_wrt_outputs, params_out[1])
+        if not grads_wrt_inputs:
+            return None, grads_wrt_params
+        return (self.backend.dot(grads_wrt_outputs, self.weights, out=out),
+                grads_wrt_params)
+
+    def _grads_wrt_weights(self, inputs, grads_wrt_outputs, out=None):
+        """Calculates the gradients with respect to the weights.
+
+        If `sparse_grads` is set only the columns corresponding to inputs
+        non-zero somewhere in the batch are computed, the rest being zeroed,
+        unless a weights penalty gradient (which is dense) is to be added.
+        """
+        if isinstance(inputs, GridBasisArray):
+            return inputs.rdot(grads_wrt_outputs.T, out=out)
+        if not self.sparse_grads or (
+                self.include_penalty_grads and
+                self.weights_penalty is not None):
+            return self.backend.dot(grads_wrt_outputs.T, inputs, out=out)
+        active = np.flatnonzero(inputs.any(axis=0))
+        if out is None:
+            out = np.zeros(self.weights.shape,
+                           np.result_type(grads_wrt_outputs, inputs))
+        else:
+            out.fill(0)
+        if active.size > 0:
+            out[:, active] = self.backend.dot(
+                grads_wrt_outputs.T, inputs[:, active])
+        return SliceSparseArray.wrap(out, active, axis=1)
+
+    def _grads_wrt_params(self, grads_wrt_weights, grads_wrt_outputs,
+                          biases_out=None):
+        """Completes the parameter gradients given those wrt the weights."""
+        grads_wrt_biases = np.sum(grads_wrt_outputs, axis=0, out=biases_out)
+        grads_wrt_params = [grads_wrt_weights, grads_wrt_biases]
+        self._add_penalty_grads(grads_wrt_params)
+        return grads_wrt_params
 
     def params_penalty(self):
         """Returns the parameter dependent penalty term for this layer.
@@ -319,6 +564,11 @@ class AffineLayer(LayerWithParameters):
             params_penalty += self.biases_penalty(self.biases)
         return params_penalty
 
+    @property
+    def penalties(self):
+        """List of parameter penalties: `[weights_penalty, biases_penalty]`."""
+        return [self.weights_penalty, self.biases_penalty]
+
     @property
     def params(self):
         """A list of layer parameter values: `[weights, biases]`."""
@@ -337,7 +587,9 @@ class AffineLayer(LayerWithParameters):
 class SigmoidLayer(Layer):
     """Layer implementing an element-wise logistic sigmoid transformation."""
 
-    def fprop(self, inputs):
+    backend_ops = ('sigmoid', 'sigmoid_grad')
+
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         For inputs `x` and outputs `y` this corresponds to
@@ -345,13 +597,15 @@ class SigmoidLayer(Layer):
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
-        return 1. / (1. + np.exp(-inputs))
+        return self.backend.sigmoid(inputs, out=out)
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -363,12 +617,14 @@ class SigmoidLayer(Layer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        return grads_wrt_outputs * outputs * (1. - outputs)
+        return self.backend.sigmoid_grad(outputs, grads_wrt_outputs, out=out)
 
     def __repr__(self):
         return 'SigmoidLayer'
@@ -386,14 +642,53 @@ class ConvolutionalLayer(LayerWithParameters):
     inputs, and that unit strides are used the outputs will have spatial extent
         output_height = input_height - kernel_height + 1
         output_width = input_width - kernel_width + 1
+    More generally, with the inputs zero-padded by `padding` on each side,
+    kernel elements spaced `dilation` apart and the kernels moved `stride`
+    positions between outputs, the output height is
+        output_height = (input_height + 2 * padding -
+                         dilation * (kernel_height - 1) - 1) // stride + 1
+    and similarly for the output width. Strided outputs are computed directly
+    rather than by subsampling a unit-stride output. Note that as the layer
+    computes a convolution, its kernels correspond to spatially flipped
+    `torch.nn.Conv2d` weights (which compute a cross-correlation).
+
+    Several algorithms are available for computing the convolution:
+        'im2col': unfolds the input windows into a matrix and performs a
+            single matrix product (the default).
+        'einsum': contracts a strided view of the input windows with the
+            kernels using `np.einsum` with a precomputed contraction path.
+        'fft': multiplies the inputs and kernels in the Fourier domain, which
+            is typically only worthwhile for large kernels. Only available
+            for unit stride and dilation.
+        'auto': benchmarks the applicable algorithms the first time a given
+            input shape and dtype is seen and uses the fastest, recording the
+            choice in a `ConvolutionPlanCache`. Plans are only kept in memory
+            unless the plan cache is given a file path (or the
+            `MLP_CONV_PLAN_CACHE` environment variable is set), in which case
+            they are saved to and reused from that file by later runs.
+    If the layer `backend` implements convolutions (e.g. the PyTorch backend)
+    they are computed by the backend and the algorithm is ignored.
     """
 
+    algorithms = ('im2col', 'einsum', 'fft')
+
+    backend_ops = ('conv2d',)
+
+    _state_attributes = ('cache', '_padded')
+
+    _cache_attributes = ('cache', '_padded')
+
+    # minimum kernel extent for the FFT algorithm to be considered by 'auto'
+    fft_min_kernel_size = 5
+
     def __init__(self, num_input_channels, num_output_channels,
                  input_height, input_width,
                  kernel_height, kernel_width,
                  kernels_init=init.UniformInit(-0.01, 0.01),
                  biases_init=init.ConstantInit(0.),
-                 kernels_penalty=None, biases_penalty=None):
+                 kernels_penalty=None, biases_penalty=None,
+                 padding=0, stride=1, dilation=1,
+                 algorithm='im2col', plan_cache=None):
         """Initialises a parameterised convolutional layer.
         Args:
             num_input_channels (int): Number of channels in inputs to
@@ -417,7 +712,27 @@ class ConvolutionalLayer(LayerWithParameters):
                 None if no regularisation is to be applied to the kernels.
             biases_penalty: Biases-dependent penalty term (regulariser) or
                 None if no regularisation is to be applied to the biases.
+            padding (int): Number of zeros to pad each side of both spatial
+                dimensions of the inputs with.
+            stride (int): Step size between the positions the kernels are
+                applied at in both spatial dimensions.
+            dilation (int): Spacing between kernel elements in both spatial
+                dimensions (1 corresponds to a standard convolution).
+            algorithm: One of 'im2col', 'einsum', 'fft' or 'auto', specifying
+                the algorithm used to compute the convolution.
+            plan_cache: `ConvolutionPlanCache` used to record the algorithm
+                choices when `algorithm='auto'`. If `None` the shared default
+                plan cache is used.
         """
+        assert algorithm == 'auto' or algorithm in self.algorithms, (
+            'algorithm should be one of {0} or auto.'.format(self.algorithms)
+        )
+        assert padding >= 0, 'padding should be non-negative.'
+        assert stride >= 1, 'stride should be at least 1.'
+        assert dilation >= 1, 'dilation should be at least 1.'
+        assert algorithm != 'fft' or (stride == 1 and dilation == 1), (
+            'fft algorithm requires unit stride and dilation.'
+        )
         self.num_input_channels = num_input_channels
         self.num_output_channels = num_output_channels
         self.input_height = input_height
@@ -436,21 +751,35 @@ class ConvolutionalLayer(LayerWithParameters):
         self.biases = self.biases_init(num_output_channels)
         self.kernels_penalty = kernels_penalty
         self.biases_penalty = biases_penalty
+        self.padding = padding
+        self.stride = stride
+        self.dilation = dilation
+        self.algorithm = algorithm
+        self.plan_cache = plan_cache
+        # algorithm choices for previously seen (input shape, dtype) pairs
+        self._plans = {}
+        # contraction paths for `np.einsum` keyed by operand shapes
+        self._einsum_paths = {}
+        # most recent inputs and their zero-padded copy
+        self._padded = None
 
         self.cache = None
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
         For inputs `x`, outputs `y`, kernels `K` and biases `b` the layer
         corresponds to `y = conv2d(x, K) + b`.
         Args:
             inputs: Array of layer inputs of shape (batch_size, num_input_channels, image_height, image_width).
+            out: Optional array to write the outputs to. If `None` a new array
+                is allocated.
         Returns:
             outputs: Array of layer outputs of shape (batch_size, num_output_channels, output_height, output_width).
         """
-        raise NotImplementedError
+        return getattr(self, '_fprop_' + self._get_algorithm(inputs))(
+            inputs, out)
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
         Given gradients with respect to the outputs of the layer calculates the
         gradients with respect to the layer inputs.
@@ -463,24 +792,530 @@ class ConvolutionalLayer(LayerWithParameters):
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape
                 (batch_size, num_output_channels, output_height, output_width).
+            out: Optional array to write the gradients to. If `None` a new
+                array is allocated.
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, num_input_channels, input_height, input_width).
         """
-        raise NotImplementedError
+        return getattr(self, '_bprop_' + self._get_algorithm(inputs))(
+            inputs, grads_wrt_outputs, out)
 
-    def grads_wrt_params(self, inputs, grads_wrt_outputs):
+    def grads_wrt_params(self, inputs, grads_wrt_outputs, out=None):
         """Calculates gradients with respect to layer parameters.
         Args:
             inputs: array of inputs to layer of shape (batch_size, input_dim)
             grads_wrt_to_outputs: array of gradients with respect to the layer
                 outputs of shape
                 (batch_size, num_output_channels, output_height, output_width).
+            out: optional list of arrays `[kernels_buffer, biases_buffer]` to
+                write the gradients to. If `None` new arrays are allocated.
         Returns:
             list of arrays of gradients with respect to the layer parameters
             `[grads_wrt_kernels, grads_wrt_biases]`.
         """
-        raise NotImplementedError
+        if out is None:
+            out = [None, None]
+        grads_wrt_kernels = getattr(
+            self, '_grads_wrt_kernels_' + self._get_algorithm(inputs))(
+                inputs, grads_wrt_outputs, out[0])
+        return self._grads_wrt_params(
+            grads_wrt_kernels, grads_wrt_outputs, out[1])
+
+    def backward(self, inputs, outputs, grads_wrt_outputs,
+                 grads_wrt_inputs=True, out=None, params_out=None):
+        """Calculates gradients with respect to the inputs and parameters.
+
+        Equivalent to calling `bprop` and `grads_wrt_params`, but algorithms
+        with intermediate results needed for both (the reshaped output
+        gradients for 'im2col' and their FFT for 'fft') compute them once,
+        and the gradients with respect to the inputs are only computed if
+        required.
+
+        Args:
+            inputs: Array of layer inputs of shape
+                (batch_size, num_input_channels, input_height, input_width).
+            outputs: Array of layer outputs calculated in forward pass.
+            grads_wrt_outputs: Array of gradients with respect to the layer
+                outputs of shape
+                (batch_size, num_output_channels, output_height, output_width).
+            grads_wrt_inputs: Whether to calculate the gradients with respect
+                to the inputs.
+            out: Optional array to write the gradients with respect to the
+                inputs to.
+            params_out: Optional list of arrays `[kernels_buffer,
+                biases_buffer]` to write the parameter gradients to.
+
+        Returns:
+            Tuple `(grads_wrt_inputs, grads_wrt_params)`, the former being
+            `None` if `grads_wrt_inputs` is False.
+        """
+        if params_out is None:
+            params_out = [None, None]
+        algorithm = self._get_algorithm(inputs)
+        fused_backward = getattr(self, '_backward_' + algorithm, None)
+        if fused_backward is not None:
+            grads_wrt_inputs, grads_wrt_kernels = fused_backward(
+                inputs, grads_wrt_outputs, grads_wrt_inputs, out,
+                params_out[0])
+        else:
+            if grads_wrt_inputs:
+                grads_wrt_inputs = getattr(self, '_bprop_' + algorithm)(
+                    inputs, grads_wrt_outputs, out)
+            else:
+                grads_wrt_inputs = None
+            grads_wrt_kernels = getattr(
+                self, '_grads_wrt_kernels_' + algorithm)(
+                    inputs, grads_wrt_outputs, params_out[0])
+        return grads_wrt_inputs, self._grads_wrt_params(
+            grads_wrt_kernels, grads_wrt_outputs, params_out[1])
+
+    def _grads_wrt_params(self, grads_wrt_kernels, grads_wrt_outputs,
+                          biases_out=None):
+        """Completes the parameter gradients given those wrt the kernels."""
+        grads_wrt_biases = np.sum(
+            grads_wrt_outputs, axis=(0, 2, 3), out=biases_out)
+        grads_wrt_params = [grads_wrt_kernels, grads_wrt_biases]
+        self._add_penalty_grads(grads_wrt_params)
+        return grads_wrt_params
+
+    def applicable_algorithms(self, inputs_shape, dtype):
+        """Returns the algorithms 'auto' chooses between for an input shape.
+
+        Args:
+            inputs_shape: Shape of the layer inputs
+                (batch_size, num_input_channels, input_height, input_width).
+            dtype: Data type of the layer inputs.
+
+        Returns:
+            List of algorithm names.
+        """
+        algorithms = ['im2col', 'einsum']
+        if (np.issubdtype(dtype, np.floating) and
+                self.stride == 1 and self.dilation == 1 and
+                max(self.kernel_height, self.kernel_width) >=
+                self.fft_min_kernel_size):
+            algorithms.append('fft')
+        return algorithms
+
+    def plan_key(self, inputs_shape, dtype):
+        """Returns a string identifying a convolution problem.
+
+        Used as the key for algorithm choices in a `ConvolutionPlanCache`.
+        """
+        return (
+            'inputs={0},kernels={1},padding={2},stride={3},dilation={4},'
+            'dtype={5}'.format(
+                'x'.join(str(d) for d in inputs_shape),
+                'x'.join(str(d) for d in self.kernels_shape),
+                self.padding, self.stride, self.dilation,
+                np.dtype(dtype).name))
+
+    def _get_algorithm(self, inputs):
+        """Returns the name of the algorithm to use for a batch of inputs."""
+        if 'conv2d' in self.backend.ops:
+            return 'backend'
+        if self.algorithm != 'auto':
+            return self.algorithm
+        plan_id = (inputs.shape, inputs.dtype)
+        algorithm = self._plans.get(plan_id)
+        if algorithm is None:
+            plan_cache = self.plan_cache
+            if plan_cache is None:
+                plan_cache = autotuner.get_default_plan_cache()
+            algorithm = plan_cache.select(self, inputs.shape, inputs.dtype)
+            self._plans[plan_id] = algorithm
+        return algorithm
+
+    def _add_biases(self, outputs_view, dtype, out=None):
+        """Adds biases to a (possibly non-contiguous) view of the outputs.
+
+        Returns a C-contiguous array of shape
+            (batch_size, num_output_channels, output_height, output_width)
+        which is `out` if provided.
+        """
+        if out is None:
+            out = np.empty(outputs_view.shape,
+                           dtype=np.result_type(dtype, self.biases))
+        np.add(outputs_view, self.biases[:, None, None], out=out)
+        return out
+
+    @staticmethod
+    def _copy_to(values, out):
+        """Returns a copy of `values`, written to `out` if provided."""
+        if out is None:
+            return values.copy()
+        out[...] = values
+        return out
+
+    def _matmul(self, name, a, b):
+        """Matrix product of `a` and `b` into a reused scratch array."""
+        return self.backend.dot(a, b, out=self._scratch(
+            name, (a.shape[0], b.shape[1]), np.result_type(a, b)))
+
+    def _fprop_im2col(self, inputs, out=None):
+        # (batch_size * output_height * output_width, num_output_channels)
+        outputs_matrix = self._matmul(
+            'outputs_matrix', self._im2col(inputs, reuse_cached=False),
+            self._kernels_matrix().T)
+        output_height, output_width = self._output_spatial_shape(inputs.shape)
+        return self._add_biases(
+            outputs_matrix.reshape(
+                (inputs.shape[0], output_height, output_width, -1)
+            ).transpose(0, 3, 1, 2),
+            outputs_matrix.dtype, out)
+
+    def _bprop_im2col(self, inputs, grads_wrt_outputs, out=None):
+        grads_wrt_cols = self._matmul(
+            'grads_wrt_cols', self._grads_matrix(grads_wrt_outputs),
+            self._kernels_matrix())
+        return self._col2im(grads_wrt_cols, inputs.shape, out)
+
+    def _grads_wrt_kernels_im2col(self, inputs, grads_wrt_outputs, out=None):
+        grads_wrt_kernels = self._matmul(
+            'grads_wrt_kernels', self._grads_matrix(grads_wrt_outputs).T,
+            self._im2col(inputs))
+        # undo the kernel flip applied in `_kernels_matrix`
+        return self._copy_to(
+            grads_wrt_kernels.reshape(self.kernels_shape)[:, :, ::-1, ::-1],
+            out)
+
+    def _backward_im2col(self, inputs, grads_wrt_outputs, grads_wrt_inputs,
+                         out=None, kernels_out=None):
+        grads_matrix = self._grads_matrix(grads_wrt_outputs)
+        grads_wrt_kernels = self._copy_to(
+            self._matmul('grads_wrt_kernels', grads_matrix.T,
+                         self._im2col(inputs)
+                         ).reshape(self.kernels_shape)[:, :, ::-1, ::-1],
+            kernels_out)
+        if not grads_wrt_inputs:
+            return None, grads_wrt_kernels
+        grads_wrt_cols = self._matmul(
+            'grads_wrt_cols', grads_matrix, self._kernels_matrix())
+        return (self._col2im(grads_wrt_cols, inputs.shape, out),
+                grads_wrt_kernels)
+
+    def _fprop_backend(self, inputs, out=None):
+        return self.backend.conv2d(
+            inputs, self.kernels, self.biases, self.padding, self.stride,
+            self.dilation, out=out)
+
+    def _bprop_backend(self, inputs, grads_wrt_outputs, out=None):
+        return self.backend.conv2d_grad_wrt_inputs(
+            inputs.shape, self.kernels, grads_wrt_outputs, self.padding,
+            self.stride, self.dilation, out=out)
+
+    def _grads_wrt_kernels_backend(self, inputs, grads_wrt_outputs, out=None):
+        return self.backend.conv2d_grad_wrt_kernels(
+            inputs, self.kernels_shape, grads_wrt_outputs, self.padding,
+            self.stride, self.dilation, out=out)
+
+    def _einsum(self, subscripts, *operands):
+        """Evaluates `np.einsum` with a cached contraction path."""
+        path_key = (subscripts,) + tuple(op.shape for op in operands)
+        path = self._einsum_paths.get(path_key)
+        if path is None:
+            path = np.einsum_path(subscripts, *operands, optimize='optimal')[0]
+            self._einsum_paths[path_key] = path
+        return np.einsum(subscripts, *operands, optimize=path)
+
+    def _fprop_einsum(self, inputs, out=None):
+        outputs = self._einsum(
+            'bcyxij,ocij->boyx', self._windows(self._pad(inputs, reuse_cached=False)),
+            self.kernels[:, :, ::-1, ::-1])
+        return self._add_biases(outputs, outputs.dtype, out)
+
+    def _bprop_einsum(self, inputs, grads_wrt_outputs, out=None):
+        grads_wrt_windows = self._einsum(
+            'boyx,ocij->byxcij', grads_wrt_outputs,
+            self.kernels[:, :, ::-1, ::-1])
+        return self._col2im(grads_wrt_windows, inputs.shape, out)
+
+    def _grads_wrt_kernels_einsum(self, inputs, grads_wrt_outputs, out=None):
+        return self._copy_to(
+            self._einsum(
+                'boyx,bcyxij->ocij', grads_wrt_outputs,
+                self._windows(self._pad(inputs))
+            )[:, :, ::-1, ::-1],
+            out)
+
+    def _fft_inputs(self, inputs, reuse_cached=True):
+        """Returns the 2D real FFT of the inputs, cached as in `_im2col`.
+
+        Circular convolutions of length equal to the input size are exact for
+        all 'valid' output positions, so no additional padding is needed.
+        """
+        if (reuse_cached and self.cache is not None and
+                self.cache[0] == 'fft' and self.cache[1] is inputs):
+            return self.cache[2]
+        fft_inputs = np.fft.rfft2(self._pad(inputs, reuse_cached))
+        self.cache = ('fft', inputs, fft_inputs)
+        return fft_inputs
+
+    def _fft_grads_wrt_outputs(self, grads_wrt_outputs, spatial_shape):
+        """Returns the 2D real FFT of the output gradients.
+
+        The gradients are aligned with the positions of the last kernel
+        element in the (padded) inputs and zero-padded to their size.
+        """
+        padded = np.zeros(grads_wrt_outputs.shape[:2] + spatial_shape,
+                          dtype=grads_wrt_outputs.dtype)
+        padded[:, :, self.kernel_height - 1:, self.kernel_width - 1:] = (
+            grads_wrt_outputs)
+        return np.fft.rfft2(padded)
+
+    @staticmethod
+    def _fft_channel_product(fft_a, fft_b):
+        """Contracts over a shared channel axis at each frequency.
+
+        Computes `c[n, m, u, v] = sum_k a[n, k, u, v] * b[k, m, u, v]` as a
+        batch of matrix products, one per frequency.
+        """
+        return np.matmul(
+            fft_a.transpose(2, 3, 0, 1), fft_b.transpose(2, 3, 0, 1)
+        ).transpose(2, 3, 0, 1)
+
+    def _fft_dtype(self, inputs):
+        """Returns the floating point dtype FFT algorithm results are cast to."""
+        dtype = np.result_type(inputs, self.kernels)
+        return dtype if np.issubdtype(dtype, np.floating) else np.float64
+
+    def _padded_spatial_shape(self, inputs_shape):
+        """Returns the spatial shape of the inputs after zero-padding."""
+        return (inputs_shape[2] + 2 * self.padding,
+                inputs_shape[3] + 2 * self.padding)
+
+    def _fprop_fft(self, inputs, out=None):
+        spatial_shape = self._padded_spatial_shape(inputs.shape)
+        fft_kernels = np.fft.rfft2(self.kernels, s=spatial_shape)
+        outputs = np.fft.irfft2(
+            self._fft_channel_product(
+                self._fft_inputs(inputs, reuse_cached=False),
+                fft_kernels.transpose(1, 0, 2, 3)),
+            s=spatial_shape)
+        return self._add_biases(
+            outputs[:, :, self.kernel_height - 1:, self.kernel_width - 1:],
+            self._fft_dtype(inputs), out)
+
+    def _bprop_fft(self, inputs, grads_wrt_outputs, out=None,
+                   fft_grads_wrt_outputs=None):
+        spatial_shape = self._padded_spatial_shape(inputs.shape)
+        if fft_grads_wrt_outputs is None:
+            fft_grads_wrt_outputs = self._fft_grads_wrt_outputs(
+                grads_wrt_outputs, spatial_shape)
+        fft_kernels = np.fft.rfft2(self.kernels, s=spatial_shape)
+        grads_wrt_inputs = np.fft.irfft2(
+            self._fft_channel_product(
+                fft_grads_wrt_outputs, fft_kernels.conj()),
+            s=spatial_shape)
+        if out is not None:
+            out[...] = self._crop(grads_wrt_inputs)
+            return out
+        return self._crop(grads_wrt_inputs).astype(
+            self._fft_dtype(inputs), copy=False)
+
+    def _grads_wrt_kernels_fft(self, inputs, grads_wrt_outputs, out=None,
+                               fft_grads_wrt_outputs=None):
+        spatial_shape = self._padded_spatial_shape(inputs.shape)
+        if fft_grads_wrt_outputs is None:
+            fft_grads_wrt_outputs = self._fft_grads_wrt_outputs(
+                grads_wrt_outputs, spatial_shape)
+        grads_wrt_kernels = np.fft.irfft2(
+            self._fft_channel_product(
+                fft_grads_wrt_outputs.transpose(1, 0, 2, 3),
+                self._fft_inputs(inputs).conj()),
+            s=spatial_shape)
+        grads_wrt_kernels = grads_wrt_kernels[
+            :, :, :self.kernel_height, :self.kernel_width]
+        if out is not None:
+            out[...] = grads_wrt_kernels
+            return out
+        return grads_wrt_kernels.astype(self._fft_dtype(inputs))
+
+    def _backward_fft(self, inputs, grads_wrt_outputs, grads_wrt_inputs,
+                      out=None, kernels_out=None):
+        fft_grads_wrt_outputs = self._fft_grads_wrt_outputs(
+            grads_wrt_outputs, self._padded_spatial_shape(inputs.shape))
+        grads_wrt_kernels = self._grads_wrt_kernels_fft(
+            inputs, grads_wrt_outputs, kernels_out, fft_grads_wrt_outputs)
+        if not grads_wrt_inputs:
+            return None, grads_wrt_kernels
+        return (self._bprop_fft(inputs, grads_wrt_outputs, out,
+                                fft_grads_wrt_outputs),
+                grads_wrt_kernels)
+
+    def _output_spatial_shape(self, inputs_shape):
+        """Returns `(output_height, output_width)` for an input shape."""
+        padded_height, padded_width = self._padded_spatial_shape(inputs_shape)
+        return (
+            (padded_height - self.dilation * (self.kernel_height - 1) - 1) //
+            self.stride + 1,
+            (padded_width - self.dilation * (self.kernel_width - 1) - 1) //
+            self.stride + 1)
+
+    def _pad(self, inputs, reuse_cached=True):
+        """Returns the inputs zero-padded along both spatial dimensions.
+
+        The padded array is kept together with the inputs it was computed from
+        so that it can be reused for the same inputs, and its memory (with the
+        already zeroed border) reused for subsequent batches of the same shape.
+
+        Args:
+            inputs: Array of layer inputs of shape
+                (batch_size, num_input_channels, input_height, input_width).
+            reuse_cached: Whether to return the cached padded inputs if they
+                were computed from the same `inputs` object.
+        """
+        if self.padding == 0:
+            return inputs
+        if reuse_cached and self._padded is not None and self._padded[0] is inputs:
+            return self._padded[1]
+        padded_shape = inputs.shape[:2] + self._padded_spatial_shape(inputs.shape)
+        if (self._padded is not None and self._padded[1].shape == padded_shape and
+                self._padded[1].dtype == inputs.dtype):
+            padded = self._padded[1]
+        else:
+            padded = np.zeros(padded_shape, dtype=inputs.dtype)
+        self._crop(padded)[...] = inputs
+        self._padded = (inputs, padded)
+        return padded
+
+    def _crop(self, padded):
+        """Returns a view of a padded array with the padding removed."""
+        if self.padding == 0:
+            return padded
+        return padded[:, :, self.padding:-self.padding,
+                      self.padding:-self.padding]
+
+    def _windows(self, padded):
+        """Returns a strided view of all kernel windows of the padded inputs.
+
+        The view has shape
+            (batch_size, num_input_channels, output_height, output_width,
+             kernel_height, kernel_width)
+        and shares memory with `padded`, so no data is copied. Stride and
+        dilation are applied through the view's strides so only the windows
+        actually needed for the outputs are visited.
+        """
+        output_height, output_width = self._output_spatial_shape(
+            self._crop(padded).shape)
+        shape = padded.shape[:2] + (
+            output_height, output_width, self.kernel_height, self.kernel_width)
+        strides = padded.strides[:2] + (
+            padded.strides[2] * self.stride, padded.strides[3] * self.stride,
+            padded.strides[2] * self.dilation, padded.strides[3] * self.dilation)
+        return np.lib.stride_tricks.as_strided(
+            padded, shape=shape, strides=strides, writeable=False)
+
+    def _im2col(self, inputs, reuse_cached=True):
+        """Unfolds the inputs into a matrix with one kernel window per row.
+
+        The returned matrix has shape
+            (batch_size * output_height * output_width,
+             num_input_channels * kernel_height * kernel_width)
+        so that the convolution reduces to a single matrix product. The matrix
+        is kept in `self.cache` together with the inputs it was computed from
+        so that it can be reused by `grads_wrt_params` for the same inputs and
+        its memory reused for subsequent batches of the same shape.
+
+        Args:
+            inputs: Array of layer inputs of shape
+                (batch_size, num_input_channels, input_height, input_width).
+            reuse_cached: Whether to return the cached matrix if it was
+                computed from the same `inputs` object. `fprop` always
+                recomputes it as the inputs may have been modified in-place.
+        """
+        cached = self.cache is not None and self.cache[0] == 'im2col'
+        if reuse_cached and cached and self.cache[1] is inputs:
+            return self.cache[2]
+        windows = self._windows(
+            self._pad(inputs, reuse_cached)).transpose(0, 2, 3, 1, 4, 5)
+        cols_shape = (
+            windows.shape[0] * windows.shape[1] * windows.shape[2],
+            windows.shape[3] * windows.shape[4] * windows.shape[5])
+        if (cached and self.cache[2].shape == cols_shape and
+                self.cache[2].dtype == inputs.dtype):
+            cols = self.cache[2]
+        else:
+            cols = np.empty(cols_shape, dtype=inputs.dtype)
+        cols.reshape(windows.shape)[...] = windows
+        self.cache = ('im2col', inputs, cols)
+        return cols
+
+    def _col2im(self, grads_wrt_cols, inputs_shape, out=None):
+        """Folds gradients with respect to unfolded windows back on to inputs.
+
+        This is the adjoint of `_im2col`: contributions of overlapping windows
+        are summed. Rather than looping over output pixels we loop over the
+        (small) number of kernel offsets, adding a whole strided slab of
+        gradients for each.
+
+        Args:
+            grads_wrt_cols: Array of gradients with respect to the unfolded
+                windows, either in the matrix layout returned by `_im2col`
+                or of shape
+                    (batch_size, output_height, output_width,
+                     num_input_channels, kernel_height, kernel_width).
+            inputs_shape: Shape of the layer inputs.
+            out: Optional array of shape `inputs_shape` to write the
+                gradients with respect to the inputs to.
+        """
+        output_height, output_width = self._output_spatial_shape(inputs_shape)
+        grads_wrt_windows = grads_wrt_cols.reshape(
+            (inputs_shape[0], output_height, output_width,
+             self.num_input_channels, self.kernel_height, self.kernel_width)
+        ).transpose(0, 3, 1, 2, 4, 5)
+        padded_shape = inputs_shape[:2] + self._padded_spatial_shape(inputs_shape)
+        if out is None:
+            grads_wrt_padded = np.zeros(padded_shape, dtype=grads_wrt_cols.dtype)
+        elif self.padding == 0:
+            grads_wrt_padded = out
+            grads_wrt_padded.fill(0)
+        else:
+            grads_wrt_padded = self._scratch(
+                'grads_wrt_padded', padded_shape, out.dtype)
+            grads_wrt_padded.fill(0)
+        # extent of input positions covered by one kernel offset
+        height_extent = self.stride * (output_height - 1) + 1
+        width_extent = self.stride * (output_width - 1) + 1
+        for i in range(self.kernel_height):
+            for j in range(self.kernel_width):
+                row, col = i * self.dilation, j * self.dilation
+                grads_wrt_padded[:, :, row:row + height_extent:self.stride,
+                                 col:col + width_extent:self.stride] += (
+                    grads_wrt_windows[..., i, j])
+        if out is not None and self.padding != 0:
+            out[...] = self._crop(grads_wrt_padded)
+            return out
+        return self._crop(grads_wrt_padded)
+
+    def _kernels_matrix(self):
+        """Returns the flipped kernels reshaped to a 2D matrix.
+
+        Kernels are flipped along both spatial axes so that the product with
+        the unfolded inputs is a convolution rather than a cross-correlation.
+        The returned matrix has shape
+            (num_output_channels,
+             num_input_channels * kernel_height * kernel_width)
+        """
+        return self.kernels[:, :, ::-1, ::-1].reshape(
+            (self.num_output_channels, -1))
+
+    def _grads_matrix(self, grads_wrt_outputs):
+        """Reshapes output gradients to match the rows of `_im2col`.
+
+        The returned matrix has shape
+            (batch_size * output_height * output_width, num_output_channels)
+        and is a scratch array overwritten by the next call.
+        """
+        transposed = grads_wrt_outputs.transpose(0, 2, 3, 1)
+        grads_matrix = self._scratch(
+            'grads_matrix',
+            (transposed.size // self.num_output_channels,
+             self.num_output_channels),
+            grads_wrt_outputs.dtype)
+        grads_matrix.reshape(transposed.shape)[...] = transposed
+        return grads_matrix
 
     def params_penalty(self):
         """Returns the parameter dependent penalty term for this layer.
@@ -493,6 +1328,11 @@ class ConvolutionalLayer(LayerWithParameters):
             params_penalty += self.biases_penalty(self.biases)
         return params_penalty
 
+    @property
+    def penalties(self):
+        """List of parameter penalties: `[kernels_penalty, biases_penalty]`."""
+        return [self.kernels_penalty, self.biases_penalty]
+
     @property
     def params(self):
         """A list of layer parameter values: `[kernels, biases]`."""
@@ -508,17 +1348,24 @@ class ConvolutionalLayer(LayerWithParameters):
             'ConvolutionalLayer(\n'
             '    num_input_channels={0}, num_output_channels={1},\n'
             '    input_height={2}, input_width={3},\n'
-            '    kernel_height={4}, kernel_width={5}\n'
+            '    kernel_height={4}, kernel_width={5},\n'
+            '    padding={6}, stride={7}, dilation={8}\n'
             ')'
                 .format(self.num_input_channels, self.num_output_channels,
                         self.input_height, self.input_width, self.kernel_height,
-                        self.kernel_width)
+                        self.kernel_width, self.padding, self.stride,
+                        self.dilation)
         )
 
 class MaxPooling2DLayer(Layer):
     """
     A class implementing a MaxPooling2D layer.
     """
+
+    _state_attributes = ('cache',)
+
+    _cache_attributes = ('cache',)
+
     def __init__(self, input_height, input_width, size, stride):
         """
         Initializes a max pooling 2D layer
@@ -533,45 +1380,126 @@ class MaxPooling2DLayer(Layer):
         self.size = size
         self.stride = stride
         self.cache = None
+        self._index_tables = None
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """
         Given an input of shape (b, c, input_height, input_width), apply the max pooling function without padding.
         :param inputs: Inputs of size (b, c, input_height, input_width)
+        :param out: Optional array to write the outputs to. If None a new array is allocated.
         :return: The output of the max pooling operation. Assuming a stride=2 the output should have a shape of
         (b, c, (input_height - size)/stride + 1, (input_width - size)/stride + 1)
         """
-        raise NotImplementedError
+        batch_size, num_channels, input_height, input_width = inputs.shape
+        output_height = (input_height - self.size) // self.stride + 1
+        output_width = (input_width - self.size) // self.stride + 1
+        # strided view of the (possibly overlapping) pooling windows
+        windows = np.lib.stride_tricks.as_strided(
+            inputs,
+            shape=(batch_size, num_channels, output_height, output_width,
+                   self.size, self.size),
+            strides=inputs.strides[:2] + (
+                inputs.strides[2] * self.stride,
+                inputs.strides[3] * self.stride) + inputs.strides[2:],
+            writeable=False)
+        flat_windows = self._scratch(
+            'windows', windows.shape[:4] + (self.size ** 2,), inputs.dtype)
+        flat_windows.reshape(windows.shape)[...] = windows
+        window_argmax = flat_windows.argmax(-1, out=self._scratch(
+            'window_argmax', windows.shape[:4], np.intp))
+        outputs = flat_windows.max(-1, out=out)
+        # convert within-window argmax to indices into the flattened inputs
+        window_offsets, window_starts = self._flat_index_tables(inputs.shape)
+        if self.cache is not None and self.cache[1].shape == window_argmax.shape:
+            argmax_indices = self.cache[1]
+        else:
+            argmax_indices = np.empty(window_argmax.shape, np.intp)
+        np.take(window_offsets, window_argmax, out=argmax_indices)
+        argmax_indices += window_starts
+        self.cache = (inputs, argmax_indices)
+        return outputs
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """
         Given the inputs, outputs and grads_wrt_outputs of the max pooling layer, compute the grads_wrt_inputs
         :param inputs:  Inputs of size (b, c, input_height, input_width)
         :param outputs: The output of the max pooling layer fprop function. Assuming a stride=2 the output should have a shape of
         (b, c, (input_height - size)/stride + 1, (input_width - size)/stride + 1)
         :param grads_wrt_outputs: The grads wrt to the outputs, of shape equal to that of the outputs.
+        :param out: Optional array to write the grads_wrt_inputs to. If None a new array is allocated.
         :return: grads_wrt_input, of shape equal to the inputs.
         """
-        raise NotImplementedError
+        if self.cache is None or self.cache[0] is not inputs:
+            self.fprop(inputs)
+        argmax_indices = self.cache[1]
+        if self.stride >= self.size:
+            # windows do not overlap so each input receives at most one
+            # gradient and a plain scatter suffices
+            if out is None:
+                grads_wrt_inputs = np.zeros(inputs.shape, dtype=grads_wrt_outputs.dtype)
+            else:
+                grads_wrt_inputs = out
+                grads_wrt_inputs.fill(0)
+            np.put(grads_wrt_inputs, argmax_indices, grads_wrt_outputs)
+            return grads_wrt_inputs
+        # overlapping windows may share a maximum so gradients are summed
+        grads_wrt_inputs = np.bincount(
+            argmax_indices.ravel(), weights=grads_wrt_outputs.ravel(),
+            minlength=inputs.size).reshape(inputs.shape)
+        if out is not None:
+            out[...] = grads_wrt_inputs
+            return out
+        return grads_wrt_inputs.astype(grads_wrt_outputs.dtype, copy=False)
+
+    def _flat_index_tables(self, inputs_shape):
+        """Returns lookup tables for converting window argmaxes to indices.
+
+        The first table maps a position within a flattened pooling window to
+        its offset in the flattened inputs relative to the window's top-left
+        corner. The second, of shape (b, c, output_height, output_width),
+        gives the flattened index of each window's top-left corner. The tables
+        are computed once per input shape.
+        """
+        if self._index_tables is not None and self._index_tables[0] == inputs_shape:
+            return self._index_tables[1:]
+        batch_size, num_channels, input_height, input_width = inputs_shape
+        output_height = (input_height - self.size) // self.stride + 1
+        output_width = (input_width - self.size) // self.stride + 1
+        window_offsets = (
+            np.arange(self.size)[:, None] * input_width +
+            np.arange(self.size)[None, :]).ravel()
+        window_starts = (
+            np.arange(batch_size * num_channels).reshape(
+                (batch_size, num_channels, 1, 1)) * input_height * input_width +
+            np.arange(output_height)[:, None] * self.stride * input_width +
+            np.arange(output_width)[None, :] * self.stride)
+        self._index_tables = (inputs_shape, window_offsets, window_starts)
+        return window_offsets, window_starts
+
+    def __repr__(self):
+        return 'MaxPooling2DLayer(size={0}, stride={1})'.format(
+            self.size, self.stride)
 
 
 class ReluLayer(Layer):
     """Layer implementing an element-wise rectified linear transformation."""
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         For inputs `x` and outputs `y` this corresponds to `y = max(0, x)`.
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
-        return np.maximum(inputs, 0.)
+        return np.maximum(inputs, 0., out=out)
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -583,12 +1511,17 @@ class ReluLayer(Layer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        return (outputs > 0) * grads_wrt_outputs
+        # outputs are non-negative so their sign is the indicator of `> 0`
+        grads_wrt_inputs = np.sign(outputs, out=out)
+        grads_wrt_inputs *= grads_wrt_outputs
+        return grads_wrt_inputs
 
     def __repr__(self):
         return 'ReluLayer'
@@ -597,20 +1530,24 @@ class ReluLayer(Layer):
 class TanhLayer(Layer):
     """Layer implementing an element-wise hyperbolic tangent transformation."""
 
-    def fprop(self, inputs):
+    backend_ops = ('tanh', 'tanh_grad')
+
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         For inputs `x` and outputs `y` this corresponds to `y = tanh(x)`.
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
-        return np.tanh(inputs)
+        return self.backend.tanh(inputs, out=out)
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -622,12 +1559,14 @@ class TanhLayer(Layer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        return (1. - outputs ** 2) * grads_wrt_outputs
+        return self.backend.tanh_grad(outputs, grads_wrt_outputs, out=out)
 
     def __repr__(self):
         return 'TanhLayer'
@@ -636,7 +1575,7 @@ class TanhLayer(Layer):
 class SoftmaxLayer(Layer):
     """Layer implementing a softmax transformation."""
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         For inputs `x` and outputs `y` this corresponds to
@@ -645,16 +1584,20 @@ class SoftmaxLayer(Layer):
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
         # subtract max inside exponential to improve numerical stability -
         # when we divide through by sum this term cancels
-        exp_inputs = np.exp(inputs - inputs.max(-1)[:, None])
-        return exp_inputs / exp_inputs.sum(-1)[:, None]
+        outputs = np.subtract(inputs, inputs.max(-1)[:, None], out=out)
+        np.exp(outputs, out=outputs)
+        outputs /= outputs.sum(-1)[:, None]
+        return outputs
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -666,22 +1609,48 @@ class SoftmaxLayer(Layer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        return (outputs * (grads_wrt_outputs -
-                           (grads_wrt_outputs * outputs).sum(-1)[:, None]))
+        grads_wrt_inputs = np.multiply(grads_wrt_outputs, outputs, out=out)
+        np.subtract(grads_wrt_outputs, grads_wrt_inputs.sum(-1)[:, None],
+                    out=grads_wrt_inputs)
+        grads_wrt_inputs *= outputs
+        return grads_wrt_inputs
 
     def __repr__(self):
         return 'SoftmaxLayer'
 
 
 class RadialBasisFunctionLayer(Layer):
-    """Layer implementing projection to a grid of radial basis functions."""
+    """Layer implementing projection to a grid of radial basis functions.
+
+    For each of the `grid_dim**input_dim` grid points and each input dimension
+    the layer outputs a Gaussian basis function of the distance between the
+    input and grid point along that dimension. As the grid coordinate along
+    each dimension takes only `grid_dim` distinct values, the basis functions
+    are evaluated once per distinct value (an array of shape
+    `(batch_size, input_dim, grid_dim)`) and broadcast along the grid axes
+    into the outputs, rather than computing distances to every grid point.
+
+    The dense outputs still have `input_dim * grid_dim**input_dim` elements
+    per input, which is prohibitive for more than a few input dimensions. If
+    `support` is set the basis functions are truncated to zero more than
+    `support` scales from their centres, only the few basis functions along
+    each dimension within the support of each input are evaluated, and the
+    outputs are returned as a sparse `GridBasisArray`. An `AffineLayer`
+    following the layer accepts these outputs without forming them densely,
+    and `MultipleLayerModel` does not compute the (dense) gradients with
+    respect to the layer outputs unless an earlier layer has parameters.
+    The sparse outputs are not supported by the sharded models and
+    compiled execution plans of `MultipleLayerModel`.
+    """
 
-    def __init__(self, grid_dim, intervals=[[0., 1.]]):
+    def __init__(self, grid_dim, intervals=[[0., 1.]], support=None):
         """Creates a radial basis function layer object.
 
         Args:
@@ -692,27 +1661,118 @@ class RadialBasisFunctionLayer(Layer):
                 specifying extents of axis-aligned region in input-space to
                 tile basis functions in grid across. For example for a 2D input
                 space spanning [0, 1] x [0, 1] use intervals=[[0, 1], [0, 1]].
+            support: If not `None`, the number of scales from their centres
+                beyond which the basis functions are truncated to zero (e.g.
+                `support=3` truncates values below `exp(-9)`), with the
+                outputs returned as a sparse `GridBasisArray`.
         """
-        num_basis = grid_dim ** len(intervals)
+        assert support is None or support > 0., 'support should be positive.'
+        dtype = get_default_dtype()
+        self.grid_dim = grid_dim
+        self.support = support
         self.centres = np.array(np.meshgrid(*[
             np.linspace(low, high, grid_dim) for (low, high) in intervals])
-                                ).reshape((len(intervals), -1))
+                                ).reshape((len(intervals), -1)).astype(dtype)
         self.scales = np.array([
-            [(high - low) * 1. / grid_dim] for (low, high) in intervals])
+            [(high - low) * 1. / grid_dim] for (low, high) in intervals],
+            dtype=dtype)
+        # distinct grid coordinates along each dimension
+        self._grid_coords = np.array([
+            np.linspace(low, high, grid_dim) for (low, high) in intervals],
+            dtype=dtype)
+        # axis of the grid (as ordered in `centres`) along which the
+        # coordinate for each dimension varies - `np.meshgrid` uses
+        # Cartesian ('xy') indexing so the first two axes are swapped
+        self._grid_axes = list(range(len(intervals)))
+        if len(intervals) > 1:
+            self._grid_axes[:2] = [1, 0]
+        if support is not None:
+            # the basis functions within the support of an input lie within
+            # a window of grid coordinates of a fixed size along each
+            # dimension, whose offsets from the window start are precomputed
+            spacings = np.array([
+                (high - low) / max(grid_dim - 1, 1) for (low, high) in intervals])
+            half_widths = np.ceil(support * self.scales[:, 0] / spacings)
+            num_neighbours = int(min(grid_dim, 2 * half_widths.max() + 1))
+            self._neighbours = np.arange(num_neighbours)
+            self._spacings = spacings[:, None].astype(dtype)
+
+    def _bases(self, inputs):
+        """Evaluates the basis functions along each dimension.
+
+        Returns:
+            Tuple `(offsets, bases)` of arrays of shape
+            `(batch_size, input_dim, grid_dim)`, the first the scaled
+            offsets of the inputs from the grid coordinates and the second
+            the corresponding basis function values.
+        """
+        offsets = inputs[:, :, None] - self._grid_coords
+        offsets /= self.scales
+        bases = np.exp(-offsets ** 2)
+        return offsets, bases
 
-    def fprop(self, inputs):
+    def _truncated_bases(self, inputs):
+        """Evaluates the truncated basis functions near the inputs.
+
+        Returns:
+            Tuple `(indices, offsets, bases)` of arrays of shape
+            `(batch_size, input_dim, num_neighbours)`, the first the indices
+            of the grid coordinates along each dimension in the window
+            around each input, and the others the corresponding scaled
+            offsets and (truncated) basis function values.
+        """
+        num_neighbours = self._neighbours.shape[0]
+        # centre the windows on the nearest grid coordinates, shifted to lie
+        # within the grid
+        nearest = np.rint((inputs - self._grid_coords[:, 0]) /
+                          self._spacings[:, 0]).astype(np.intp)
+        starts = np.clip(nearest - num_neighbours // 2, 0,
+                         self.grid_dim - num_neighbours)
+        indices = starts[:, :, None] + self._neighbours
+        offsets = inputs[:, :, None] - np.take_along_axis(
+            self._grid_coords[None], indices, axis=2)
+        offsets /= self.scales
+        bases = np.exp(-offsets ** 2)
+        bases[abs(offsets) > self.support] = 0.
+        return indices, offsets, bases
+
+    def _grid_view(self, array):
+        """Reshapes flat per basis function values to a view on the grid."""
+        grid_view = array.view()
+        # assigning the shape raises an error if a copy would be needed
+        grid_view.shape = (
+            (array.shape[0], self._grid_coords.shape[0]) +
+            (self.grid_dim,) * self._grid_coords.shape[0])
+        return grid_view
+
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated. Ignored
+                if `support` is set.
 
         Returns:
-            outputs: Array of layer outputs of shape (batch_size, output_dim).
+            outputs: Array of layer outputs of shape (batch_size, output_dim),
+                a `GridBasisArray` if `support` is set.
         """
-        return np.exp(-(inputs[..., None] - self.centres[None, ...]) ** 2 /
-                      self.scales ** 2).reshape((inputs.shape[0], -1))
-
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+        if self.support is not None:
+            indices, _, bases = self._truncated_bases(inputs)
+            return GridBasisArray(bases, indices, self.grid_dim,
+                                  self._grid_axes)
+        _, bases = self._bases(inputs)
+        if out is None:
+            out = np.empty((inputs.shape[0], self.centres.size), bases.dtype)
+        grid_outputs = self._grid_view(out)
+        for dim, axis in enumerate(self._grid_axes):
+            shape = [inputs.shape[0]] + [1] * len(self._grid_axes)
+            shape[axis + 1] = self.grid_dim
+            grid_outputs[:, dim] = bases[:, dim].reshape(shape)
+        return out
+
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -721,44 +1781,176 @@ class RadialBasisFunctionLayer(Layer):
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
             outputs: Array of layer outputs calculated in forward pass of
-                shape (batch_size, output_dim).
+                shape (batch_size, output_dim), a `GridBasisArray` if
+                `support` is set.
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        num_basis = self.centres.shape[1]
-        return -2 * (
-                ((inputs[..., None] - self.centres[None, ...]) / self.scales ** 2) *
-                grads_wrt_outputs.reshape((inputs.shape[0], -1, num_basis))
-        ).sum(-1)
+        # sum the output gradients over all grid points sharing each
+        # coordinate value along a dimension
+        grid_grads = self._grid_view(grads_wrt_outputs)
+        grads_wrt_coords = np.empty(
+            inputs.shape + (self.grid_dim,), grads_wrt_outputs.dtype)
+        for dim, axis in enumerate(self._grid_axes):
+            grads_wrt_coords[:, dim] = grid_grads[:, dim].sum(
+                axis=tuple(a + 1 for a in self._grid_axes if a != axis))
+        if self.support is not None:
+            # only the basis functions evaluated in the forward pass are
+            # non-zero, with zero gradients where truncated
+            indices, offsets, bases = self._truncated_bases(inputs)
+            grads_wrt_bases = np.take_along_axis(
+                grads_wrt_coords, indices, axis=2)
+        else:
+            offsets, bases = self._bases(inputs)
+            grads_wrt_bases = grads_wrt_coords
+        # d/dx exp(-((x - c) / s)**2) = -2 * ((x - c) / s) / s * exp(...)
+        grads_wrt_bases *= bases
+        grads_wrt_bases *= offsets
+        grads_wrt_inputs = np.sum(grads_wrt_bases, axis=-1, out=out)
+        grads_wrt_inputs *= -2. / self.scales[:, 0]
+        return grads_wrt_inputs
 
     def __repr__(self):
         return 'RadialBasisFunctionLayer(grid_dim={0})'.format(self.grid_dim)
 
 
 class DropoutLayer(StochasticLayer):
-    """Layer which stochastically drops input dimensions in its output."""
+    """Layer which stochastically drops input dimensions in its output.
+
+    Dropout masks are generated by thresholding raw 32-bit outputs of a
+    `np.random.Generator` bit generator (e.g. PCG64 or Philox), which is
+    considerably cheaper than sampling floating point uniforms, and are stored
+    between the forward and backward passes packed eight to a byte.
+
+    If `inverted` is True the outputs are scaled by `1 / incl_prob` during
+    the stochastic forward propagation, so that the deterministic forward
+    propagation is the identity and returns the inputs without copying them.
+    Otherwise the deterministic forward propagation scales the inputs by
+    `incl_prob`.
+
+    Replicas of the layer (see `replicate`) sample their masks from new bit
+    generators spawned from the layer's, so that replicas used concurrently
+    (e.g. by different worker processes) draw independent masks. Replicas
+    applied to consecutive slices of one batch (e.g. the shards of a
+    `MultipleLayerModel`) can instead be set to use slices of a single mask
+    sampled by the layer with `share_samples`.
+    """
+
+    _state_attributes = ('_mask_shape', '_packed_mask', '_shared_mask')
 
-    def __init__(self, rng=None, incl_prob=0.5, share_across_batch=True):
+    def __init__(self, rng=None, incl_prob=0.5, share_across_batch=True,
+                 inverted=False):
         """Construct a new dropout layer.
 
         Args:
-            rng (RandomState): Seeded random number generator.
+            rng: Seeded random number generator. Either a `Generator`, whose
+                bit generator is used directly, or a `RandomState`, which is
+                used to seed a new PCG64 bit generator. Note that the masks
+                sampled for a given `RandomState` therefore differ from those
+                of earlier versions of this layer, which sampled uniform
+                floats from the `RandomState` itself, so runs seeded with a
+                `RandomState` will not reproduce earlier results exactly.
             incl_prob: Scalar value in (0, 1] specifying the probability of
                 each input dimension being included in the output.
             share_across_batch: Whether to use same dropout mask across
                 all inputs in a batch or use per input masks.
+            inverted: Whether to apply inverted dropout, i.e. to scale the
+                included inputs by `1 / incl_prob` in the stochastic forward
+                propagation rather than the inputs by `incl_prob` in the
+                deterministic forward propagation.
         """
+        if rng is None:
+            rng = np.random.Generator(np.random.PCG64(DEFAULT_SEED))
         super(DropoutLayer, self).__init__(rng)
         assert incl_prob > 0. and incl_prob <= 1.
         self.incl_prob = incl_prob
         self.share_across_batch = share_across_batch
-        self.rng = rng
+        self.inverted = inverted
+        if isinstance(rng, np.random.Generator):
+            self._bit_generator = rng.bit_generator
+        else:
+            self._bit_generator = np.random.PCG64(
+                rng.randint(2**31 - 1, size=4))
+        # inputs are included if a uniform 32-bit integer is below this
+        self._threshold = int(round(incl_prob * 2**32))
+        self._mask_shape = None
+        self._packed_mask = None
+        # mask sampled by another layer and slice of its rows to use in
+        # place of sampling a mask in the next forward propagation
+        self._shared_mask = None
+
+    def get_rng_state(self):
+        """Returns the state of the bit generator used to sample masks."""
+        return self._bit_generator.state
+
+    def set_rng_state(self, state):
+        """Sets the state of the bit generator used to sample masks."""
+        self._bit_generator.state = state
+
+    def replicate(self, drop_penalties=False):
+        """Returns a replica of the layer which can be used concurrently.
+
+        The replica samples masks from a new bit generator spawned from the
+        layer's, independent of the layer's and any other replica's.
+
+        Args:
+            drop_penalties: Unused as the layer has no parameters.
+        """
+        replica = super(DropoutLayer, self).replicate(drop_penalties)
+        replica._bit_generator = self._bit_generator.spawn(1)[0]
+        replica.rng = np.random.Generator(replica._bit_generator)
+        return replica
+
+    def share_samples(self, replicas, row_slices):
+        """Sets replicas to use slices of a single mask sampled by the layer.
+
+        In their next stochastic forward propagation, rather than sampling
+        their own masks, the replicas use the rows `row_slices[i]` (or the
+        whole mask if `share_across_batch` is True) of one mask sampled by
+        this layer for the whole batch, on the first request of any of the
+        replicas. Replicas applied concurrently to consecutive slices of a
+        batch therefore together apply the same mask, and advance this
+        layer's bit generator in the same way, as this layer applied to the
+        whole batch.
 
-    def fprop(self, inputs, stochastic=True):
+        Args:
+            replicas: Replicas of this layer (see `replicate`).
+            row_slices: Slices of the rows of the batch each replica is
+                applied to, together consecutively covering the batch.
+        """
+        shared_mask = _SharedMask(self, row_slices[-1].stop)
+        for replica, rows in zip(replicas, row_slices):
+            replica._shared_mask = (shared_mask, rows)
+
+    def _sample_mask(self, mask_shape):
+        """Samples a boolean inclusion mask and stores it bit-packed."""
+        if self._shared_mask is not None:
+            shared_mask, rows = self._shared_mask
+            self._shared_mask = None
+            mask = shared_mask.get(mask_shape, rows)
+        else:
+            size = int(np.prod(mask_shape))
+            # each raw 64-bit output provides two independent 32-bit integers
+            bits = self._bit_generator.random_raw(
+                (size + 1) // 2).view(np.uint32)
+            mask = (bits[:size] < self._threshold).reshape(mask_shape)
+        self._mask_shape = mask_shape
+        self._packed_mask = np.packbits(mask, axis=None)
+        return mask
+
+    def _unpack_mask(self):
+        """Returns the most recently sampled mask (as uint8 zeros and ones)."""
+        size = int(np.prod(self._mask_shape))
+        return np.unpackbits(self._packed_mask, count=size).reshape(
+            self._mask_shape)
+
+    def fprop(self, inputs, stochastic=True, out=None):
         """Forward propagates activations through the layer transformation.
 
         Args:
@@ -769,18 +1961,26 @@ class DropoutLayer(StochasticLayer):
                 a deterministic forward-propagation transformation
                 corresponding to the expected output of the stochastic
                 forward-propagation is applied.
+            out: Optional array of shape (batch_size, output_dim) to write
+                the outputs to. If `None` a new array is allocated. Ignored
+                by the deterministic forward propagation of inverted dropout,
+                which returns the inputs.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
         if stochastic:
             mask_shape = (1,) + inputs.shape[1:] if self.share_across_batch else inputs.shape
-            self._mask = (self.rng.uniform(size=mask_shape) < self.incl_prob)
-            return inputs * self._mask
+            outputs = np.multiply(inputs, self._sample_mask(mask_shape), out=out)
+            if self.inverted:
+                outputs *= 1. / self.incl_prob
+            return outputs
+        elif self.inverted:
+            return inputs
         else:
-            return inputs * self.incl_prob
+            return np.multiply(inputs, self.incl_prob, out=out)
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -793,15 +1993,43 @@ class DropoutLayer(StochasticLayer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Optional array of shape (batch_size, input_dim) to write
+                the gradients to. If `None` a new array is allocated.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
             (batch_size, input_dim).
         """
-        return grads_wrt_outputs * self._mask
+        grads_wrt_inputs = np.multiply(
+            grads_wrt_outputs, self._unpack_mask(), out=out)
+        if self.inverted:
+            grads_wrt_inputs *= 1. / self.incl_prob
+        return grads_wrt_inputs
 
     def __repr__(self):
-        return 'DropoutLayer(incl_prob={0:.1f})'.format(self.incl_prob)
+        return 'DropoutLayer(incl_prob={0:.1f}, inverted={1})'.format(
+            self.incl_prob, self.inverted)
+
+
+class _SharedMask(object):
+    """Dropout mask sampled for a whole batch on first use by any replica."""
+
+    def __init__(self, layer, batch_size):
+        self.layer = layer
+        self.batch_size = batch_size
+        self.mask = None
+        self._lock = threading.Lock()
+
+    def get(self, mask_shape, rows):
+        """Returns the mask rows for a replica with the given mask shape."""
+        with self._lock:
+            if self.mask is None:
+                if not self.layer.share_across_batch:
+                    mask_shape = (self.batch_size,) + mask_shape[1:]
+                self.mask = self.layer._sample_mask(mask_shape)
+        if self.layer.share_across_batch:
+            return self.mask
+        return self.mask[rows]
 
 
 class ReshapeLayer(Layer):
@@ -826,18 +2054,20 @@ class ReshapeLayer(Layer):
         """
         self.output_shape = (-1,) if output_shape is None else output_shape
 
-    def fprop(self, inputs):
+    def fprop(self, inputs, out=None):
         """Forward propagates activations through the layer transformation.
 
         Args:
             inputs: Array of layer inputs of shape (batch_size, input_dim).
+            out: Ignored as the outputs are a view of the inputs where
+                possible.
 
         Returns:
             outputs: Array of layer outputs of shape (batch_size, output_dim).
         """
         return inputs.reshape((inputs.shape[0],) + self.output_shape)
 
-    def bprop(self, inputs, outputs, grads_wrt_outputs):
+    def bprop(self, inputs, outputs, grads_wrt_outputs, out=None):
         """Back propagates gradients through a layer.
 
         Given gradients with respect to the outputs of the layer calculates the
@@ -849,6 +2079,8 @@ class ReshapeLayer(Layer):
                 shape (batch_size, output_dim).
             grads_wrt_outputs: Array of gradients with respect to the layer
                 outputs of shape (batch_size, output_dim).
+            out: Ignored as the gradients are a view of `grads_wrt_outputs`
+                where possible.
 
         Returns:
             Array of gradients with respect to the layer inputs of shape
@@ -5,6 +5,8 @@ This module contains classes implementing gradient based learning rules.
 """
 
 import numpy as np
+from mlp.arrays import FlatArrayList, SliceSparseArray
+from mlp.penalties import L1Penalty, L2Penalty
 
 
 class GradientDescentLearningRule(object):
@@ -23,8 +25,27 @@ class GradientDescentLearningRule(object):
     a stochastic estimator of the true error function (e.g. when the error with
     respect to only a subset of data-points is calculated) in which case this
     will correspond to a stochastic gradient descent learning rule.
+
+    The learning rules in this module perform their updates using in-place
+    operations only, with intermediate results written to a preallocated
+    scratch array. If both the parameters and their gradients are passed as
+    `FlatArrayList` instances (as returned by models created with
+    `flat_params=True`) all parameters are updated at once by operating on
+    the underlying flat arrays, rather than looping over the parameters.
+
+    Learning rules with `supports_sparse_grads` set instead update only the
+    active slices of gradients passed as `SliceSparseArray` instances (e.g.
+    by an `AffineLayer` with `sparse_grads=True`), for parameters without a
+    penalty set. Any decay of the state estimates for the other slices is
+    deferred and applied when they are next updated.
     """
 
+    supports_sparse_grads = False
+
+    # whether updates depend on each parameter as a whole (e.g. its norm), in
+    # which case flat parameters are still updated one at a time
+    per_param_updates = False
+
     def __init__(self, learning_rate=1e-3):
         """Creates a new learning rule object.
 
@@ -38,7 +59,18 @@ class GradientDescentLearningRule(object):
         assert learning_rate > 0., 'learning_rate should be positive.'
         self.learning_rate = learning_rate
 
-    def initialise(self, params):
+    @property
+    def learning_rate(self):
+        """Positive scalar scaling the gradient updates."""
+        return self._learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, value):
+        # schedulers may set numpy scalars here: store a Python float so the
+        # updates stay in the parameters' own dtype rather than upcasting
+        self._learning_rate = float(value)
+
+    def initialise(self, params, penalties=None):
         """Initialises the state of the learning rule for a set or parameters.
 
         This must be called before `update_params` is first called.
@@ -47,8 +79,143 @@ class GradientDescentLearningRule(object):
             params: A list of the parameters to be optimised. Note these will
                 be updated *in-place* to avoid reallocating arrays on each
                 update.
+            penalties: Optional list of parameter penalties (e.g.
+                `L2Penalty` instances, or `None` for unpenalised parameters)
+                corresponding to `params`. The penalty gradients are added
+                to the gradients in-place at the start of each update.
         """
         self.params = params
+        self._scratch = self._zeros_like_params()
+        # per parameter index, the step each slice's state was last updated
+        # in by a sparse update and the axis the slices are taken along
+        self._last_steps = {}
+        if penalties is not None:
+            assert len(penalties) == len(params), (
+                'Expected one penalty (or None) per parameter.'
+            )
+        self.penalties = penalties
+        self._flat_penalties = None
+        if penalties is not None and isinstance(params, FlatArrayList):
+            self._flat_penalties = _flat_penalty_coefficients(
+                params, penalties)
+
+    def _zeros_like_params(self):
+        """Returns state arrays of zeros, one for each parameter.
+
+        These are views into a single flat array if the parameters are.
+        """
+        if isinstance(self.params, FlatArrayList):
+            return FlatArrayList.zeros_like(self.params)
+        return [np.zeros_like(param) for param in self.params]
+
+    def _update_groups(self, grads_wrt_params, *states):
+        """Returns tuples `(param, *state_arrays, grad, scratch)` to update.
+
+        Called at the start of each update. The gradients of any penalties
+        passed to `initialise` are first added to the gradients in-place,
+        for flat parameters and gradients with one pass over the flat arrays
+        per kind of penalty rather than a loop over the parameters.
+
+        If the parameters, gradients and states are all `FlatArrayList`
+        instances a single tuple of their flat arrays is returned, so that all
+        parameters are updated at once, unless `per_param_updates` is set.
+
+        Args:
+            grads_wrt_params: List of gradients with respect to the
+                parameters.
+            *states: Lists of state arrays corresponding to the parameters.
+        """
+        if (self._flat_penalties is not None and
+                isinstance(grads_wrt_params, FlatArrayList)):
+            # all parameters with each kind of penalty at once
+            params = self.params.flat
+            grads = grads_wrt_params.flat
+            scratch = self._scratch.flat
+            for kind, coefficients in self._flat_penalties:
+                if kind is L1Penalty:
+                    np.sign(params, out=scratch)
+                    scratch *= coefficients
+                else:
+                    np.multiply(params, coefficients, out=scratch)
+                grads += scratch
+        elif self.penalties is not None:
+            for penalty, param, grad, scratch in zip(
+                    self.penalties, self.params, grads_wrt_params,
+                    self._scratch):
+                if penalty is not None:
+                    penalty.add_grad(param, grad, scratch)
+        lists = (self.params,) + states + (grads_wrt_params, self._scratch)
+        if not self.per_param_updates and all(
+                isinstance(arrays, FlatArrayList) for arrays in lists):
+            for i in list(self._last_steps):
+                self._catch_up(i, *[state[i] for state in states])
+            return [tuple(arrays.flat for arrays in lists)]
+        if not self.supports_sparse_grads:
+            return zip(*lists)
+        groups = []
+        for i, group in enumerate(zip(*lists)):
+            param, grad = group[0], group[-2]
+            if (isinstance(grad, SliceSparseArray) and
+                    grad.active is not None and
+                    (self.penalties is None or self.penalties[i] is None)):
+                self._sparse_update(i, param, grad, *group[1:-2])
+            else:
+                if i in self._last_steps:
+                    self._catch_up(i, *group[1:-2])
+                groups.append(group)
+        return groups
+
+    def _state_decays(self):
+        """Returns the factors the states are decayed by in each update."""
+        return ()
+
+    def _lazy_state_slices(self, index, grad, *states):
+        """Returns the active slices of states with deferred decays applied.
+
+        The slices are copies to be written back after updating them, and
+        are recorded as updated in the current step.
+
+        Args:
+            index: Index of the parameter the states correspond to.
+            grad: `SliceSparseArray` of gradients with respect to it.
+            *states: State arrays of the parameter, in the same order as
+                `_state_decays`.
+        """
+        if index not in self._last_steps:
+            self._last_steps[index] = (
+                np.full(grad.shape[grad.axis], self.step_count), grad.axis)
+        last_step = self._last_steps[index][0]
+        missed = self.step_count - last_step[grad.active]
+        shape = [1] * grad.ndim
+        shape[grad.axis] = -1
+        index = grad.active_index()
+        slices = []
+        for state, decay in zip(states, self._state_decays()):
+            state_slice = state[index]
+            state_slice *= (decay ** missed).reshape(shape)
+            slices.append(state_slice)
+        last_step[grad.active] = self.step_count + 1
+        return slices
+
+    def _catch_up(self, index, *states):
+        """Applies the decays deferred by sparse updates to all slices."""
+        last_step, axis = self._last_steps.pop(index)
+        missed = self.step_count - last_step
+        shape = [1] * states[0].ndim
+        shape[axis] = -1
+        for state, decay in zip(states, self._state_decays()):
+            state *= (decay ** missed).reshape(shape)
+
+    def _sparse_update(self, index, param, grad, *states):
+        """Updates the active slices of a parameter given sparse gradients.
+
+        Args:
+            index: Index of the parameter in `params`.
+            param: The parameter array.
+            grad: `SliceSparseArray` of gradients with respect to it.
+            *states: State arrays of the parameter.
+        """
+        raise NotImplementedError()
 
     def reset(self):
         """Resets any additional state variables to their intial values.
@@ -69,8 +236,9 @@ class GradientDescentLearningRule(object):
                 with respect to each of the parameters passed to `initialise`
                 previously, with this list expected to be in the same order.
         """
-        for param, grad in zip(self.params, grads_wrt_params):
-            param -= self.learning_rate * grad
+        for param, grad, scratch in self._update_groups(grads_wrt_params):
+            np.multiply(grad, self.learning_rate, out=scratch)
+            param -= scratch
 
 
 class MomentumLearningRule(GradientDescentLearningRule):
@@ -120,9 +288,9 @@ class MomentumLearningRule(GradientDescentLearningRule):
         assert mom_coeff >= 0. and mom_coeff <= 1., (
             'mom_coeff should be in the range [0, 1].'
         )
-        self.mom_coeff = mom_coeff
+        self.mom_coeff = float(mom_coeff)
 
-    def initialise(self, params):
+    def initialise(self, params, penalties=None):
         """Initialises the state of the learning rule for a set or parameters.
 
         This must be called before `update_params` is first called.
@@ -131,18 +299,20 @@ class MomentumLearningRule(GradientDescentLearningRule):
             params: A list of the parameters to be optimised. Note these will
                 be updated *in-place* to avoid reallocating arrays on each
                 update.
+            penalties: Optional list of parameter penalties (e.g.
+                `L2Penalty` instances, or `None` for unpenalised parameters)
+                corresponding to `params`. The penalty gradients are added
+                to the gradients in-place at the start of each update.
         """
-        super(MomentumLearningRule, self).initialise(params)
-        self.moms = []
-        for param in self.params:
-            self.moms.append(np.zeros_like(param))
+        super(MomentumLearningRule, self).initialise(params, penalties)
+        self.moms = self._zeros_like_params()
 
     def reset(self):
         """Resets any additional state variables to their intial values.
 
         For this learning rule this corresponds to zeroing all the momenta.
         """
-        for mom in zip(self.moms):
+        for mom in self.moms:
             mom *= 0.
 
     def update_params(self, grads_wrt_params):
@@ -156,9 +326,94 @@ class MomentumLearningRule(GradientDescentLearningRule):
                 with respect to each of the parameters passed to `initialise`
                 previously, with this list expected to be in the same order.
         """
-        for param, mom, grad in zip(self.params, self.moms, grads_wrt_params):
+        for param, mom, grad, scratch in self._update_groups(
+                grads_wrt_params, self.moms):
+            mom *= self.mom_coeff
+            np.multiply(grad, self.learning_rate, out=scratch)
+            mom -= scratch
+            param += mom
+
+
+class LARSLearningRule(MomentumLearningRule):
+    """Layer-wise adaptive rate scaling (LARS) learning rule.
+
+    Gradient descent with momentum where the step size of each parameter
+    tensor is scaled by a 'trust ratio' of the norm of the parameter to the
+    norm of its (weight decayed) gradient
+
+        g[i] := dL/dp[i] + weight_decay * p[i]
+        m[i] := mom_coeff * m[i] - learning_rate * local_rate[i] * g[i]
+        p[i] := p[i] + m[i]
+
+    with `local_rate[i] = trust_coefficient * |p[i]| / |g[i]|`, or just
+    `trust_coefficient` if either norm is zero. As the relative size of the
+    updates to each parameter is then independent of the gradient
+    magnitudes, training remains stable with much larger learning rates and
+    batch sizes. As in [1], parameters with fewer than two dimensions (e.g.
+    biases, which typically start at zero) are excluded from the adaptation
+    and weight decay, always using the local rate `trust_coefficient`.
+
+    References:
+      [1]: Large Batch Training of Convolutional Networks
+           You, Gitman and Ginsburg, 2017
+    """
+
+    per_param_updates = True
+
+    def __init__(self, learning_rate=1., mom_coeff=0.9,
+                 trust_coefficient=1e-3, weight_decay=0.):
+        """Creates a new learning rule object.
+
+        Args:
+            learning_rate: A postive scalar to scale the (trust ratio
+                scaled) updates to the parameters by.
+            mom_coeff: A scalar in the range [0, 1] inclusive determining
+                the contribution of the previous momentum value to the
+                value after each update.
+            trust_coefficient: Positive scalar bounding the relative change
+                in each parameter tensor's norm per update (before scaling by
+                `learning_rate`).
+            weight_decay: Non-negative scalar coefficient of the parameters
+                added to the gradients.
+        """
+        super(LARSLearningRule, self).__init__(learning_rate, mom_coeff)
+        assert trust_coefficient > 0., 'trust_coefficient should be > 0.'
+        assert weight_decay >= 0., 'weight_decay should be non-negative.'
+        self.trust_coefficient = float(trust_coefficient)
+        self.weight_decay = float(weight_decay)
+
+    def update_params(self, grads_wrt_params):
+        """Applies a single update to all parameters.
+
+        All parameter updates are performed using in-place operations and so
+        nothing is returned.
+
+        Args:
+            grads_wrt_params: A list of gradients of the scalar loss function
+                with respect to each of the parameters passed to `initialise`
+                previously, with this list expected to be in the same order.
+        """
+        for param, mom, grad, scratch in self._update_groups(
+                grads_wrt_params, self.moms):
+            if param.ndim < 2:
+                weight_decay = 0.
+                step_size = self.learning_rate * self.trust_coefficient
+            else:
+                weight_decay = self.weight_decay
+                # norm of the decayed gradients expanded to avoid forming them
+                param_norm_sq = _inner(param, param)
+                grad_norm_sq = (
+                    _inner(grad, grad) +
+                    2. * weight_decay * _inner(grad, param) +
+                    weight_decay ** 2 * param_norm_sq)
+                step_size = self.learning_rate * _trust_ratio(
+                    param_norm_sq, grad_norm_sq, self.trust_coefficient)
             mom *= self.mom_coeff
-            mom -= self.learning_rate * grad
+            np.multiply(grad, step_size, out=scratch)
+            mom -= scratch
+            if weight_decay > 0.:
+                np.multiply(param, step_size * weight_decay, out=scratch)
+                mom -= scratch
             param += mom
 
 
@@ -167,11 +422,18 @@ class AdamLearningRule(GradientDescentLearningRule):
     First-order gradient-descent based learning rule which uses adaptive
     estimates of first and second moments of the parameter gradients to
     calculate the parameter updates.
+
+    Sparse gradients are supported, in which case the moment estimates of
+    inactive slices are decayed when next updated. Unlike a dense update the
+    inactive slices of the parameters are not moved by their (non-zero)
+    first moment estimates in the meantime.
     References:
       [1]: Adam: a method for stochastic optimisation
            Kingma and Ba, 2015
     """
 
+    supports_sparse_grads = True
+
     def __init__(self, learning_rate=1e-3, beta_1=0.9, beta_2=0.999,
                  epsilon=1e-8):
         """Creates a new learning rule object.
@@ -200,25 +462,25 @@ class AdamLearningRule(GradientDescentLearningRule):
         assert beta_1 >= 0. and beta_1 <= 1., 'beta_1 should be in [0, 1].'
         assert beta_2 >= 0. and beta_2 <= 1., 'beta_2 should be in [0, 2].'
         assert epsilon > 0., 'epsilon should be > 0.'
-        self.beta_1 = beta_1
-        self.beta_2 = beta_2
-        self.epsilon = epsilon
+        self.beta_1 = float(beta_1)
+        self.beta_2 = float(beta_2)
+        self.epsilon = float(epsilon)
 
-    def initialise(self, params):
+    def initialise(self, params, penalties=None):
         """Initialises the state of the learning rule for a set or parameters.
         This must be called before `update_params` is first called.
         Args:
             params: A list of the parameters to be optimised. Note these will
                 be updated *in-place* to avoid reallocating arrays on each
                 update.
+            penalties: Optional list of parameter penalties (e.g.
+                `L2Penalty` instances, or `None` for unpenalised parameters)
+                corresponding to `params`. The penalty gradients are added
+                to the gradients in-place at the start of each update.
         """
-        super(AdamLearningRule, self).initialise(params)
-        self.moms_1 = []
-        for param in self.params:
-            self.moms_1.append(np.zeros_like(param))
-        self.moms_2 = []
-        for param in self.params:
-            self.moms_2.append(np.zeros_like(param))
+        super(AdamLearningRule, self).initialise(params, penalties)
+        self.moms_1 = self._zeros_like_params()
+        self.moms_2 = self._zeros_like_params()
         self.step_count = 0
 
     def reset(self):
@@ -230,6 +492,7 @@ class AdamLearningRule(GradientDescentLearningRule):
             mom_1 *= 0.
             mom_2 *= 0.
         self.step_count = 0
+        self._last_steps = {}
 
     def update_params(self, grads_wrt_params):
         """Applies a single update to all parameters.
@@ -240,18 +503,199 @@ class AdamLearningRule(GradientDescentLearningRule):
                 with respect to each of the parameters passed to `initialise`
                 previously, with this list expected to be in the same order.
         """
-        for param, mom_1, mom_2, grad in zip(
-                self.params, self.moms_1, self.moms_2, grads_wrt_params):
-            mom_1 *= self.beta_1
-            mom_1 += (1. - self.beta_1) * grad
-            mom_2 *= self.beta_2
-            mom_2 += (1. - self.beta_2) * grad ** 2
-            alpha_t = (
-                    self.learning_rate *
-                    (1. - self.beta_2 ** (self.step_count + 1)) ** 0.5 /
-                    (1. - self.beta_1 ** (self.step_count + 1))
-            )
-            param -= alpha_t * mom_1 / (mom_2 ** 0.5 + self.epsilon)
+        alpha_t = self._alpha_t()
+        for param, mom_1, mom_2, grad, scratch in self._update_groups(
+                grads_wrt_params, self.moms_1, self.moms_2):
+            self._adam_step(mom_1, mom_2, grad, scratch, alpha_t)
+            param -= scratch
+        self.step_count += 1
+
+    def _alpha_t(self):
+        """Returns the bias corrected step size for the current step."""
+        return (
+                self.learning_rate *
+                (1. - self.beta_2 ** (self.step_count + 1)) ** 0.5 /
+                (1. - self.beta_1 ** (self.step_count + 1))
+        )
+
+    def _state_decays(self):
+        return (self.beta_1, self.beta_2)
+
+    def _sparse_update(self, index, param, grad, mom_1, mom_2):
+        mom_1_slice, mom_2_slice = self._lazy_state_slices(
+            index, grad, mom_1, mom_2)
+        active = grad.active_index()
+        grad = grad[active].view(np.ndarray)
+        step = np.empty_like(grad)
+        self._adam_step(mom_1_slice, mom_2_slice, grad, step, self._alpha_t())
+        mom_1[active] = mom_1_slice
+        mom_2[active] = mom_2_slice
+        param[active] -= step
+
+    def _adam_step(self, mom_1, mom_2, grad, scratch, alpha_t):
+        """Updates the moment estimates and writes the step to `scratch`.
+
+        The step `alpha_t * mom_1 / (mom_2 ** 0.5 + epsilon)` is to be
+        subtracted from the parameter.
+        """
+        mom_1 *= self.beta_1
+        np.multiply(grad, 1. - self.beta_1, out=scratch)
+        mom_1 += scratch
+        mom_2 *= self.beta_2
+        np.square(grad, out=scratch)
+        scratch *= 1. - self.beta_2
+        mom_2 += scratch
+        np.sqrt(mom_2, out=scratch)
+        scratch += self.epsilon
+        np.divide(mom_1, scratch, out=scratch)
+        scratch *= alpha_t
+
+
+class AdamLearningRuleWithWeightDecay(AdamLearningRule):
+    """Adam learning rule with decoupled weight decay (AdamW).
+
+    Rather than adding the gradient of an L2 penalty to the error gradients,
+    which with Adam's per-parameter normalisation of the updates makes the
+    effective regularisation strength depend on the gradient magnitudes, the
+    parameters are decayed directly in each update
+
+        p := p - alpha_t * m_1 / (m_2 ** 0.5 + epsilon) - eta_t * decay * p
+
+    where `eta_t = learning_rate / initial_learning_rate` is the schedule
+    multiplier applied by any learning rate scheduler. The decay is applied
+    in the same in-place update pass, so no penalty gradients need to be
+    computed by the layers (their penalties should be left unset).
+
+    References:
+      [1]: Decoupled Weight Decay Regularization
+           Loshchilov and Hutter, 2019
+    """
+
+    # the decay applies to every parameter slice in each update
+    supports_sparse_grads = False
+
+    def __init__(self, learning_rate=1e-3, beta_1=0.9, beta_2=0.999,
+                 epsilon=1e-8, weight_decay=1e-5):
+        """Creates a new learning rule object.
+
+        Args:
+            learning_rate: A postive scalar to scale gradient updates to the
+                parameters by. This needs to be carefully set - if too large
+                the learning dynamic will be unstable and may diverge, while
+                if set too small learning will proceed very slowly.
+            beta_1: Exponential decay rate for gradient first moment estimates.
+                This should be a scalar value in [0, 1].
+            beta_2: Exponential decay rate for gradient second moment
+                estimates. This should be a scalar value in [0, 1].
+            epsilon: 'Softening' parameter to stop updates diverging when
+                second moment estimates are close to zero. Should be set to
+                a small positive value.
+            weight_decay: Non-negative scalar rate the parameters are decayed
+                towards zero at in each update (before scheduling).
+        """
+        super(AdamLearningRuleWithWeightDecay, self).__init__(
+            learning_rate, beta_1, beta_2, epsilon)
+        assert weight_decay >= 0., 'weight_decay should be non-negative.'
+        self.weight_decay = float(weight_decay)
+        self.initial_learning_rate = self.learning_rate
+
+    def update_params(self, grads_wrt_params):
+        """Applies a single update to all parameters.
+        All parameter updates are performed using in-place operations and so
+        nothing is returned.
+        Args:
+            grads_wrt_params: A list of gradients of the scalar loss function
+                with respect to each of the parameters passed to `initialise`
+                previously, with this list expected to be in the same order.
+        """
+        alpha_t = self._alpha_t()
+        decay_factor = 1. - (self.weight_decay * self.learning_rate /
+                             self.initial_learning_rate)
+        for param, mom_1, mom_2, grad, scratch in self._update_groups(
+                grads_wrt_params, self.moms_1, self.moms_2):
+            self._adam_step(mom_1, mom_2, grad, scratch, alpha_t)
+            # decay the previous parameter values along with the Adam step
+            param *= decay_factor
+            param -= scratch
+        self.step_count += 1
+
+
+class LAMBLearningRule(AdamLearningRule):
+    """Layer-wise adaptive moments (LAMB) learning rule.
+
+    Adam with the update of each parameter tensor scaled by a 'trust ratio'
+    of the norm of the parameter to the norm of its update
+
+        r[i] := m_1[i] / (m_2[i] ** 0.5 + epsilon) + weight_decay * p[i]
+        p[i] := p[i] - learning_rate * (|p[i]| / |r[i]|) * r[i]
+
+    with bias corrected moment estimates `m_1` and `m_2` as in Adam (and the
+    ratio one if either norm is zero). This keeps the relative size of the
+    updates to each layer's parameters fixed, allowing training with very
+    large batch sizes. As in [1], parameters with fewer than two dimensions
+    (e.g. biases) are excluded from the adaptation and weight decay, so
+    receive plain Adam updates.
+
+    References:
+      [1]: Large Batch Optimization for Deep Learning: Training BERT in 76
+           minutes. You et al., 2020
+    """
+
+    supports_sparse_grads = False
+    per_param_updates = True
+
+    def __init__(self, learning_rate=1e-3, beta_1=0.9, beta_2=0.999,
+                 epsilon=1e-6, weight_decay=0.):
+        """Creates a new learning rule object.
+
+        Args:
+            learning_rate: A postive scalar to scale the (trust ratio
+                scaled) updates to the parameters by, corresponding to the
+                relative change in each parameter tensor's norm per update.
+            beta_1: Exponential decay rate for gradient first moment estimates.
+                This should be a scalar value in [0, 1].
+            beta_2: Exponential decay rate for gradient second moment
+                estimates. This should be a scalar value in [0, 1].
+            epsilon: 'Softening' parameter to stop updates diverging when
+                second moment estimates are close to zero. Should be set to
+                a small positive value.
+            weight_decay: Non-negative scalar coefficient of the parameters
+                added to the Adam updates.
+        """
+        super(LAMBLearningRule, self).__init__(
+            learning_rate, beta_1, beta_2, epsilon)
+        assert weight_decay >= 0., 'weight_decay should be non-negative.'
+        self.weight_decay = float(weight_decay)
+
+    def update_params(self, grads_wrt_params):
+        """Applies a single update to all parameters.
+        All parameter updates are performed using in-place operations and so
+        nothing is returned.
+        Args:
+            grads_wrt_params: A list of gradients of the scalar loss function
+                with respect to each of the parameters passed to `initialise`
+                previously, with this list expected to be in the same order.
+        """
+        # bias correction of the moment estimates (the Adam step size for a
+        # unit learning rate)
+        correction = self._alpha_t() / self.learning_rate
+        for param, mom_1, mom_2, grad, scratch in self._update_groups(
+                grads_wrt_params, self.moms_1, self.moms_2):
+            self._adam_step(mom_1, mom_2, grad, scratch, correction)
+            if param.ndim < 2:
+                step_size = self.learning_rate
+            else:
+                # norm of the decayed update expanded to avoid forming it
+                param_norm_sq = _inner(param, param)
+                update_norm_sq = (
+                    _inner(scratch, scratch) +
+                    2. * self.weight_decay * _inner(scratch, param) +
+                    self.weight_decay ** 2 * param_norm_sq)
+                step_size = self.learning_rate * _trust_ratio(
+                    param_norm_sq, update_norm_sq)
+                param *= 1. - step_size * self.weight_decay
+            scratch *= step_size
+            param -= scratch
         self.step_count += 1
 
 
@@ -259,11 +703,16 @@ class AdaGradLearningRule(GradientDescentLearningRule):
     """Adaptive gradients (AdaGrad) learning rule.
     First-order gradient-descent based learning rule which normalises gradient
     updates by a running sum of the past squared gradients.
+
+    Sparse gradients are supported, with the updates of inactive slices
+    (which would leave them unchanged) skipped.
     References:
       [1]: Adaptive Subgradient Methods for Online Learning and Stochastic
            Optimization. Duchi, Haxan and Singer, 2011
     """
 
+    supports_sparse_grads = True
+
     def __init__(self, learning_rate=1e-2, epsilon=1e-8):
         """Creates a new learning rule object.
         Args:
@@ -277,20 +726,22 @@ class AdaGradLearningRule(GradientDescentLearningRule):
         """
         super(AdaGradLearningRule, self).__init__(learning_rate)
         assert epsilon > 0., 'epsilon should be > 0.'
-        self.epsilon = epsilon
+        self.epsilon = float(epsilon)
 
-    def initialise(self, params):
+    def initialise(self, params, penalties=None):
         """Initialises the state of the learning rule for a set or parameters.
         This must be called before `update_params` is first called.
         Args:
             params: A list of the parameters to be optimised. Note these will
                 be updated *in-place* to avoid reallocating arrays on each
                 update.
+            penalties: Optional list of parameter penalties (e.g.
+                `L2Penalty` instances, or `None` for unpenalised parameters)
+                corresponding to `params`. The penalty gradients are added
+                to the gradients in-place at the start of each update.
         """
-        super(AdaGradLearningRule, self).initialise(params)
-        self.sum_sq_grads = []
-        for param in self.params:
-            self.sum_sq_grads.append(np.zeros_like(param))
+        super(AdaGradLearningRule, self).initialise(params, penalties)
+        self.sum_sq_grads = self._zeros_like_params()
 
     def reset(self):
         """Resets any additional state variables to their initial values.
@@ -309,11 +760,25 @@ class AdaGradLearningRule(GradientDescentLearningRule):
                 with respect to each of the parameters passed to `initialise`
                 previously, with this list expected to be in the same order.
         """
-        for param, sum_sq_grad, grad in zip(
-                self.params, self.sum_sq_grads, grads_wrt_params):
-            sum_sq_grad += grad ** 2
-            param -= (self.learning_rate * grad /
-                      (sum_sq_grad + self.epsilon) ** 0.5)
+        for param, sum_sq_grad, grad, scratch in self._update_groups(
+                grads_wrt_params, self.sum_sq_grads):
+            np.square(grad, out=scratch)
+            sum_sq_grad += scratch
+            # param -= learning_rate * grad / (sum_sq_grad + epsilon) ** 0.5
+            np.add(sum_sq_grad, self.epsilon, out=scratch)
+            np.sqrt(scratch, out=scratch)
+            np.divide(grad, scratch, out=scratch)
+            scratch *= self.learning_rate
+            param -= scratch
+
+    def _sparse_update(self, index, param, grad, sum_sq_grad):
+        active = grad.active_index()
+        grad = grad[active].view(np.ndarray)
+        sum_sq_grad_slice = sum_sq_grad[active]
+        sum_sq_grad_slice += grad ** 2
+        sum_sq_grad[active] = sum_sq_grad_slice
+        param[active] -= self.learning_rate * grad / (
+            sum_sq_grad_slice + self.epsilon) ** 0.5
 
 
 class RMSPropLearningRule(GradientDescentLearningRule):
@@ -321,12 +786,18 @@ class RMSPropLearningRule(GradientDescentLearningRule):
     First-order gradient-descent based learning rule which normalises gradient
     updates by a exponentially smoothed estimate of the gradient second
     moments.
+
+    Sparse gradients are supported, with the second moment estimates of
+    inactive slices decayed when next updated, which is equivalent to the
+    dense update as zero gradients leave the parameters unchanged.
     References:
       [1]: Neural Networks for Machine Learning: Lecture 6a slides
            University of Toronto,Computer Science Course CSC321
       http://www.cs.toronto.edu/~tijmen/csc321/slides/lecture_slides_lec6.pdf
     """
 
+    supports_sparse_grads = True
+
     def __init__(self, learning_rate=1e-3, beta=0.9, epsilon=1e-8):
         """Creates a new learning rule object.
         Args:
@@ -347,21 +818,24 @@ class RMSPropLearningRule(GradientDescentLearningRule):
         super(RMSPropLearningRule, self).__init__(learning_rate)
         assert beta >= 0. and beta <= 1., 'beta should be in [0, 1].'
         assert epsilon > 0., 'epsilon should be > 0.'
-        self.beta = beta
-        self.epsilon = epsilon
+        self.beta = float(beta)
+        self.epsilon = float(epsilon)
 
-    def initialise(self, params):
+    def initialise(self, params, penalties=None):
         """Initialises the state of the learning rule for a set or parameters.
         This must be called before `update_params` is first called.
         Args:
             params: A list of the parameters to be optimised. Note these will
                 be updated *in-place* to avoid reallocating arrays on each
                 update.
+            penalties: Optional list of parameter penalties (e.g.
+                `L2Penalty` instances, or `None` for unpenalised parameters)
+                corresponding to `params`. The penalty gradients are added
+                to the gradients in-place at the start of each update.
         """
-        super(RMSPropLearningRule, self).initialise(params)
-        self.moms_2 = []
-        for param in self.params:
-            self.moms_2.append(np.zeros_like(param))
+        super(RMSPropLearningRule, self).initialise(params, penalties)
+        self.moms_2 = self._zeros_like_params()
+        self.step_count = 0
 
     def reset(self):
         """Resets any additional state variables to their initial values.
@@ -370,6 +844,8 @@ class RMSPropLearningRule(GradientDescentLearningRule):
         """
         for mom_2 in self.moms_2:
             mom_2 *= 0.
+        self.step_count = 0
+        self._last_steps = {}
 
     def update_params(self, grads_wrt_params):
         """Applies a single update to all parameters.
@@ -380,9 +856,220 @@ class RMSPropLearningRule(GradientDescentLearningRule):
                 with respect to each of the parameters passed to `initialise`
                 previously, with this list expected to be in the same order.
         """
-        for param, mom_2, grad in zip(
-                self.params, self.moms_2, grads_wrt_params):
+        for param, mom_2, grad, scratch in self._update_groups(
+                grads_wrt_params, self.moms_2):
             mom_2 *= self.beta
-            mom_2 += (1. - self.beta) * grad ** 2
-            param -= (self.learning_rate * grad /
-                      (mom_2 + self.epsilon) ** 0.5)
+            np.square(grad, out=scratch)
+            scratch *= 1. - self.beta
+            mom_2 += scratch
+            # param -= learning_rate * grad / (mom_2 + epsilon) ** 0.5
+            np.add(mom_2, self.epsilon, out=scratch)
+            np.sqrt(scratch, out=scratch)
+            np.divide(grad, scratch, out=scratch)
+            scratch *= self.learning_rate
+            param -= scratch
+        self.step_count += 1
+
+    def _state_decays(self):
+        return (self.beta,)
+
+    def _sparse_update(self, index, param, grad, mom_2):
+        mom_2_slice, = self._lazy_state_slices(index, grad, mom_2)
+        active = grad.active_index()
+        grad = grad[active].view(np.ndarray)
+        mom_2_slice *= self.beta
+        mom_2_slice += (1. - self.beta) * grad ** 2
+        mom_2[active] = mom_2_slice
+        param[active] -= self.learning_rate * grad / (
+            mom_2_slice + self.epsilon) ** 0.5
+
+
+class MixedPrecisionLearningRule(object):
+    """Wrapper for training models with reduced precision parameters.
+
+    The model parameters, activations and gradients are stored in a reduced
+    precision dtype (typically float16, e.g. by constructing the model as
+    `MultipleLayerModel(layers, dtype=np.float16)`), halving their memory use
+    compared to float32. To avoid small updates being lost to rounding, the
+    wrapped learning rule instead updates float32 'master' copies of the
+    parameters, which are then rounded back into the model parameters.
+
+    Small gradient values underflow in float16, so the error gradients are
+    multiplied by `loss_scale` before being back-propagated (`Optimiser` does
+    this for any learning rule with a `loss_scale` attribute) and the
+    parameter gradients divided by it again in float32. The scale is adjusted
+    dynamically: if any gradient overflows the update is skipped and the scale
+    reduced, while after `growth_interval` consecutive finite updates the
+    scale is increased.
+
+    Note that if parameter penalty gradients are added to the (scaled)
+    parameter gradients by the layers they are not scaled themselves, so their
+    effect is reduced by a factor `loss_scale`. Penalties passed to
+    `initialise` (as `Optimiser` does) are instead applied to the unscaled
+    master gradients by the wrapped learning rule.
+    """
+
+    def __init__(self, learning_rule, init_loss_scale=2.**15,
+                 growth_factor=2., backoff_factor=0.5, growth_interval=2000,
+                 master_dtype=np.float32):
+        """Creates a new mixed precision learning rule object.
+
+        Args:
+            learning_rule: Learning rule object used to update the master
+                parameters, e.g. an instance of `AdamLearningRule`.
+            init_loss_scale: Initial (positive) scale factor for the error
+                gradients.
+            growth_factor: Factor (> 1) to increase the loss scale by after
+                `growth_interval` consecutive steps without overflow.
+            backoff_factor: Factor in (0, 1) to decrease the loss scale by
+                when an overflow is detected.
+            growth_interval: Number of consecutive steps without overflow
+                after which the loss scale is increased.
+            master_dtype: Dtype of the master copies of the parameters.
+        """
+        assert init_loss_scale > 0., 'init_loss_scale should be positive.'
+        assert growth_factor > 1., 'growth_factor should be > 1.'
+        assert backoff_factor > 0. and backoff_factor < 1., (
+            'backoff_factor should be in (0, 1).'
+        )
+        assert growth_interval > 0, 'growth_interval should be positive.'
+        self.learning_rule = learning_rule
+        self.init_loss_scale = float(init_loss_scale)
+        self.loss_scale = self.init_loss_scale
+        self.growth_factor = float(growth_factor)
+        self.backoff_factor = float(backoff_factor)
+        self.growth_interval = growth_interval
+        self.master_dtype = np.dtype(master_dtype)
+        self.num_skipped_steps = 0
+        self._num_good_steps = 0
+
+    @property
+    def learning_rate(self):
+        """Learning rate of the wrapped learning rule."""
+        return self.learning_rule.learning_rate
+
+    @learning_rate.setter
+    def learning_rate(self, value):
+        self.learning_rule.learning_rate = value
+
+    def initialise(self, params, penalties=None):
+        """Initialises the state of the learning rule for a set or parameters.
+
+        This must be called before `update_params` is first called.
+
+        Args:
+            params: A list of the (reduced precision) parameters to be
+                optimised. These are updated *in-place* with the rounded
+                values of the master parameters after each update.
+            penalties: Optional list of parameter penalties corresponding to
+                `params`, passed to the wrapped learning rule so that they
+                are applied to the master parameters.
+        """
+        self.params = params
+        if isinstance(params, FlatArrayList):
+            shapes = [param.shape for param in params]
+            self.master_params = FlatArrayList(
+                params.flat.astype(self.master_dtype), shapes)
+            self.master_grads = FlatArrayList(
+                np.empty_like(self.master_params.flat), shapes)
+        else:
+            self.master_params = [
+                param.astype(self.master_dtype) for param in self.params]
+            self.master_grads = [
+                np.empty_like(master_param)
+                for master_param in self.master_params]
+        if penalties is None:
+            self.learning_rule.initialise(self.master_params)
+        else:
+            self.learning_rule.initialise(self.master_params, penalties)
+
+    def reset(self):
+        """Resets the wrapped learning rule state and the loss scale."""
+        self.learning_rule.reset()
+        self.loss_scale = self.init_loss_scale
+        self.num_skipped_steps = 0
+        self._num_good_steps = 0
+
+    def update_params(self, grads_wrt_params):
+        """Applies a single update to all parameters.
+
+        If any of the gradients are not finite the update is skipped and the
+        loss scale reduced.
+
+        Args:
+            grads_wrt_params: A list of gradients of the scalar loss function
+                multiplied by `loss_scale`, with respect to each of the
+                parameters passed to `initialise` previously, with this list
+                expected to be in the same order.
+        """
+        if (isinstance(grads_wrt_params, FlatArrayList) and
+                isinstance(self.params, FlatArrayList)):
+            # operate on the whole flat arrays at once
+            grads = [grads_wrt_params.flat]
+            params = [self.params.flat]
+            master_params = [self.master_params.flat]
+            master_grads = [self.master_grads.flat]
+        else:
+            grads = grads_wrt_params
+            params = self.params
+            master_params = self.master_params
+            master_grads = self.master_grads
+        if not all(np.isfinite(grad).all() for grad in grads):
+            self.loss_scale *= self.backoff_factor
+            self.num_skipped_steps += 1
+            self._num_good_steps = 0
+            return
+        inv_loss_scale = 1. / self.loss_scale
+        for master_grad, grad in zip(master_grads, grads):
+            np.multiply(grad, inv_loss_scale, out=master_grad,
+                        dtype=self.master_dtype)
+        self.learning_rule.update_params(self.master_grads)
+        for param, master_param in zip(params, master_params):
+            np.copyto(param, master_param, casting='same_kind')
+        self._num_good_steps += 1
+        if self._num_good_steps == self.growth_interval:
+            self.loss_scale *= self.growth_factor
+            self._num_good_steps = 0
+
+
+def _inner(a, b):
+    """Returns the inner product of two arrays of the same shape."""
+    return float(np.dot(a.ravel(), b.ravel()))
+
+
+def _trust_ratio(param_norm_sq, update_norm_sq, coefficient=1.):
+    """Returns the layer-wise trust ratio given squared norms.
+
+    This is `coefficient * |param| / |update|`, or `coefficient` if either is
+    zero.
+    """
+    if param_norm_sq > 0. and update_norm_sq > 0.:
+        return coefficient * (param_norm_sq / update_norm_sq) ** 0.5
+    return coefficient
+
+
+def _flat_penalty_coefficients(params, penalties):
+    """Returns flat per-element penalty coefficients for flat parameters.
+
+    Args:
+        params: `FlatArrayList` of parameters.
+        penalties: List of penalties (or `None`) for each parameter.
+
+    Returns:
+        List of `(penalty class, coefficients)` pairs, with the coefficients
+        an array of the size of the flat parameters which is zero for the
+        parameters without a penalty of that class, or `None` if any penalty
+        is not an `L1Penalty` or `L2Penalty` and so must be applied
+        separately.
+    """
+    coefficients = {}
+    for i, penalty in enumerate(penalties):
+        if penalty is None:
+            continue
+        if type(penalty) not in (L1Penalty, L2Penalty):
+            return None
+        if type(penalty) not in coefficients:
+            coefficients[type(penalty)] = FlatArrayList.zeros_like(params)
+        coefficients[type(penalty)][i][...] = penalty.coefficient
+    return [(kind, kind_coefficients.flat)
+            for kind, kind_coefficients in coefficients.items()]
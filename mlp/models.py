@@ -8,6 +8,12 @@ outputs (and intermediate states) and for calculating gradients of scalar
 functions of the outputs with respect to the model parameters.
 """
 
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import mlp.backends as backends
+from mlp import resolve_dtype
+from mlp.arrays import FlatArrayList, SliceSparseArray
 from mlp.layers import LayerWithParameters, StochasticLayer, StochasticLayerWithParameters
 
 
@@ -27,6 +33,15 @@ class SingleLayerModel(object):
         """A list of all of the parameters of the model."""
         return self.layer.params
 
+    @property
+    def penalties(self):
+        """A list of the penalties (or `None`) of each of the parameters."""
+        return _layer_penalties(self.layer)
+
+    def params_penalty(self):
+        """Returns the value of the parameter penalty terms of the model."""
+        return self.layer.params_penalty()
+
     def fprop(self, inputs):
         """Calculate the model outputs corresponding to a batch of inputs.
 
@@ -43,6 +58,19 @@ class SingleLayerModel(object):
         activations = [inputs, self.layer.fprop(inputs)]
         return activations
 
+    def predict(self, inputs_or_provider, chunk_size=None):
+        """Generates the model outputs for inputs in chunks.
+
+        Args:
+            inputs_or_provider: Array of inputs or data provider.
+            chunk_size: Maximum number of inputs per chunk (see `_chunks`).
+
+        Yields:
+            Array of model outputs for each chunk of inputs.
+        """
+        for inputs in _chunks(inputs_or_provider, chunk_size):
+            yield self.layer.fprop(inputs)
+
     def grads_wrt_params(self, activations, grads_wrt_outputs):
         """Calculates gradients with respect to the model parameters.
 
@@ -66,14 +94,135 @@ class SingleLayerModel(object):
 class MultipleLayerModel(object):
     """A model consisting of multiple layers applied sequentially."""
 
-    def __init__(self, layers):
+    def __init__(self, layers, use_buffer_arena=False, dtype=None,
+                 backend=None, num_shards=1, checkpoints=None,
+                 flat_params=False):
         """Create a new multiple layer model instance.
 
         Args:
             layers: List of the the layer objecst defining the model in the
                 order they should be applied from inputs to outputs.
+            use_buffer_arena: Whether to preallocate the layer activations and
+                gradients once per input batch shape and reuse them on every
+                subsequent call through the `out` arguments of the layer
+                methods, rather than allocating new arrays for each batch.
+                If True the arrays returned by `fprop` and `grads_wrt_params`
+                are overwritten by the next call with the same batch shape
+                so must not be held on to across calls.
+            dtype: If not `None`, floating point dtype all layer parameters
+                are cast to. Every activation and gradient computed by the
+                model is then checked to be of this dtype, so that e.g. a
+                single float64 array accidentally upcasting a float32 model
+                raises an `AssertionError` rather than silently slowing down
+                all the following layers. Inputs passed to `fprop` are cast
+                to this dtype.
+            backend: If not `None`, the computation backend(s) to set on the
+                layers (see `mlp.backends.assign_backends`): either the name
+                of a backend to use for all layers supporting it, e.g.
+                'torch', or a list of backend names, one per layer.
+            num_shards: Number of shards to split each batch into, with the
+                forward and backward passes of the shards run concurrently
+                on a pool of `num_shards` threads and the parameter
+                gradients summed across shards. As NumPy releases the GIL
+                in its array operations, this allows element-wise layers to
+                use multiple cores. Each shard uses replicas of the layers
+                (see `Layer.replicate`) sharing their parameters. Stochastic
+                layers must define a `share_samples` method (as
+                `DropoutLayer` does) so that their replicas use slices of a
+                single sample for the whole batch, keeping the results the
+                same as for the unsharded model. Note that
+                NumPy's BLAS may itself use multiple threads for matrix
+                products, so it may be worth limiting its thread count. If
+                1 (the default) batches are processed serially as a whole.
+            checkpoints: If not `None`, activation checkpointing is used to
+                reduce the memory needed for training. Either a sequence of
+                indices into the list of activations returned by `fprop`
+                (i.e. index `i` corresponds to the inputs to layer `i`) or
+                'sqrt' to use every `ceil(sqrt(len(layers)))`-th index. In
+                non-evaluation forward passes only the activations at these
+                indices (and the model inputs and outputs) are kept, the
+                others being `None` in the returned list, and the discarded
+                activations are recomputed one segment (between consecutive
+                checkpoints) at a time in `grads_wrt_params`. The random
+                number generator states of stochastic layers are replayed so
+                the recomputation uses the same samples (e.g. dropout masks)
+                as the original forward pass. Not supported in combination
+                with `use_buffer_arena` or `num_shards > 1`.
+            flat_params: Whether to store all the layer parameters, and the
+                parameter gradients returned by `grads_wrt_params`, as views
+                into single contiguous flat arrays (cast to a common dtype).
+                `params` and `grads_wrt_params` then return `FlatArrayList`
+                instances, which the learning rules update with a few
+                vectorised operations on the flat arrays rather than a loop
+                over the parameters. The gradients are written to the same
+                arrays on every call. If the layer parameters are later
+                reassigned `params` returns a plain list again.
         """
         self.layers = layers
+        self.use_buffer_arena = use_buffer_arena
+        # whether each layer is stochastic, and the keyword arguments of its
+        # forward propagation in training and evaluation passes (not bound
+        # methods, so copies of the model with replicated layers use them)
+        self._stochastic = [
+            isinstance(layer, StochasticLayer) or
+            isinstance(layer, StochasticLayerWithParameters)
+            for layer in layers]
+        self._train_fprop_kwargs = [
+            {'stochastic': True} if stochastic else {}
+            for stochastic in self._stochastic]
+        self._eval_fprop_kwargs = [
+            {'stochastic': False} if stochastic else {}
+            for stochastic in self._stochastic]
+        self.dtype = None if dtype is None else np.dtype(dtype)
+        if backend is not None:
+            backends.assign_backends(self.layers, backend)
+        if self.dtype is not None:
+            for layer in self.layers:
+                if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
+                    layer.params = [
+                        param.astype(self.dtype, copy=False)
+                        for param in layer.params]
+        self._flat_params = None
+        self._flat_grads = None
+        # views of the flat gradients for each layer with parameters
+        self._layer_flat_grads = {}
+        if flat_params:
+            self._flatten_params()
+        # buffers keyed by (inputs shape, inputs dtype[, evaluation])
+        self._activation_buffers = {}
+        self._grad_buffers = {}
+        assert num_shards >= 1, 'num_shards should be at least 1.'
+        assert num_shards == 1 or all(
+            hasattr(layer, 'share_samples')
+            for i, layer in enumerate(layers) if self._is_stochastic(i)), (
+            'Sharding requires stochastic layers to define share_samples.'
+        )
+        self.num_shards = num_shards
+        # per shard models and the thread pool running them, created on
+        # first use
+        self._shards = None
+        self._executor = None
+        # activations last returned by `fprop` and the per shard activations
+        # they were concatenated from
+        self._last_sharded_activations = (None, None)
+        if checkpoints == 'sqrt':
+            step = int(np.ceil(np.sqrt(len(layers))))
+            checkpoints = range(step, len(layers), step)
+        if checkpoints is not None:
+            assert not use_buffer_arena and num_shards == 1, (
+                'Checkpointing cannot be combined with the buffer arena or '
+                'sharding.'
+            )
+            assert all(0 < i < len(layers) for i in checkpoints), (
+                'Checkpoint indices should be in [1, {0}).'.format(len(layers))
+            )
+            checkpoints = sorted(set(checkpoints))
+        self.checkpoints = checkpoints
+        # random number generator states of the stochastic layers which are
+        # recomputed from checkpoints, from before and after the last forward
+        # pass, keyed by layer index
+        self._rng_states_before = {}
+        self._rng_states_after = {}
 
     @property
     def params(self):
@@ -82,8 +231,84 @@ class MultipleLayerModel(object):
         for layer in self.layers:
             if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
                 params += layer.params
+        # the flat parameters are only valid while no layer's parameters
+        # have been reassigned
+        flat_params = self._flat_params
+        if (flat_params is not None and len(params) == len(flat_params) and
+                all(param is view
+                    for param, view in zip(params, flat_params))):
+            return flat_params
         return params
 
+    @property
+    def penalties(self):
+        """A list of the penalties (or `None`) of each of the parameters."""
+        penalties = []
+        for layer in self.layers:
+            if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
+                penalties += _layer_penalties(layer)
+        return penalties
+
+    def params_penalty(self):
+        """Returns the value of the parameter penalty terms of the model.
+
+        This is only computed when called (e.g. when monitored), rather than
+        for every batch.
+        """
+        params_penalty = 0.
+        for layer in self.layers:
+            if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
+                params_penalty += layer.params_penalty()
+        return params_penalty
+
+    def _flatten_params(self, flat_params=None):
+        """Moves the layer parameters into a single flat array.
+
+        Each layer's parameters are replaced by views into the flat array,
+        and a flat array of the same size allocated for the gradients if not
+        already allocated.
+
+        Args:
+            flat_params: Optional `FlatArrayList` matching the parameters to
+                move them into (e.g. one in shared memory, or the model's
+                original flat parameters to move them back). If `None` a new
+                one is allocated.
+        """
+        params = []
+        layer_slices = []
+        for i, layer in enumerate(self.layers):
+            if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
+                layer_slices.append((i, slice(
+                    len(params), len(params) + len(layer.params))))
+                params += layer.params
+        if not params:
+            return
+        shapes = [param.shape for param in params]
+        if flat_params is None:
+            flat_params = FlatArrayList.zeros_like(params)
+        if (self._flat_grads is None or
+                self._flat_grads.flat.shape != flat_params.flat.shape or
+                self._flat_grads.flat.dtype != flat_params.flat.dtype):
+            self._flat_grads = FlatArrayList(
+                np.empty_like(flat_params.flat), shapes)
+        for view, param in zip(flat_params, params):
+            if view is not param:
+                view[...] = param
+        self._flat_params = flat_params
+        for i, params_slice in layer_slices:
+            self.layers[i].params = self._flat_params[params_slice]
+            self._layer_flat_grads[i] = self._flat_grads[params_slice]
+
+    def _flat_grads_result(self, grads_wrt_params):
+        """Returns the parameter gradients as the flat gradients list.
+
+        Any gradients not already computed in place are copied in.
+        """
+        for view, grad in zip(self._flat_grads, grads_wrt_params):
+            if grad is not view:
+                view[...] = grad
+        return self._flat_grads
+
     def fprop(self, inputs, evaluation=False):
         """Forward propagates a batch of inputs through the model.
 
@@ -95,21 +320,32 @@ class MultipleLayerModel(object):
             plus the inputs (to the first layer) as the first element. The
             last element of the list corresponds to the model outputs.
         """
+        if self.dtype is not None:
+            inputs = inputs.astype(self.dtype, copy=False)
+        if self.num_shards > 1:
+            return self._sharded_fprop(inputs, evaluation)
+        if self.checkpoints is not None and not evaluation:
+            return self._checkpointed_fprop(inputs)
+        buffers = None
+        if self.use_buffer_arena:
+            buffers_key = (inputs.shape, inputs.dtype, evaluation)
+            buffers = self._activation_buffers.get(buffers_key)
+        fprop_kwargs = (self._eval_fprop_kwargs if evaluation else
+                        self._train_fprop_kwargs)
         activations = [inputs]
         for i, layer in enumerate(self.layers):
-            if evaluation:
-                if issubclass(type(self.layers[i]), StochasticLayer) or issubclass(type(self.layers[i]),
-                                                                                   StochasticLayerWithParameters):
-                    current_activations = self.layers[i].fprop(activations[i], stochastic=False)
-                else:
-                    current_activations = self.layers[i].fprop(activations[i])
-            else:
-                if issubclass(type(self.layers[i]), StochasticLayer) or issubclass(type(self.layers[i]),
-                                                                                   StochasticLayerWithParameters):
-                    current_activations = self.layers[i].fprop(activations[i], stochastic=True)
-                else:
-                    current_activations = self.layers[i].fprop(activations[i])
+            kwargs = fprop_kwargs[i]
+            if buffers is not None and buffers[i] is not None:
+                kwargs = dict(kwargs, out=buffers[i])
+            current_activations = layer.fprop(activations[i], **kwargs)
+            self._check_dtype(current_activations, layer, 'outputs')
             activations.append(current_activations)
+        if self.use_buffer_arena and buffers is None:
+            # adopt the arrays allocated in this first pass as the buffers
+            self._activation_buffers[buffers_key] = [
+                _owned_or_none(outputs, inputs)
+                for inputs, outputs in zip(activations[:-1], activations[1:])
+            ]
         return activations
 
     def grads_wrt_params(self, activations, grads_wrt_outputs):
@@ -126,20 +362,636 @@ class MultipleLayerModel(object):
             List of gradients of the scalar function with respect to all model
             parameters.
         """
+        if self.num_shards > 1:
+            return self._sharded_grads_wrt_params(
+                activations, grads_wrt_outputs)
+        if any(acts is None for acts in activations):
+            return self._checkpointed_grads_wrt_params(
+                activations, grads_wrt_outputs)
+        buffers = new_buffers = None
+        if self.use_buffer_arena:
+            buffers_key = (activations[0].shape, activations[0].dtype)
+            buffers = self._grad_buffers.get(buffers_key)
+            if buffers is None:
+                new_buffers = []
         grads_wrt_params = []
-        for i, layer in enumerate(self.layers[::-1]):
+        first = self._first_layer_with_params()
+        for i, layer in enumerate(self.layers[first:][::-1]):
             inputs = activations[-i - 2]
             outputs = activations[-i - 1]
-            grads_wrt_inputs = layer.bprop(inputs, outputs, grads_wrt_outputs)
-            if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
-                grads_wrt_params += layer.grads_wrt_params(
-                    inputs, grads_wrt_outputs)[::-1]
+            bprop_kwargs, params_kwargs = {}, {}
+            if buffers is not None:
+                inputs_buffer, params_buffers = buffers[i]
+                if inputs_buffer is not None:
+                    bprop_kwargs['out'] = inputs_buffer
+                if params_buffers is not None:
+                    params_kwargs['out'] = params_buffers
+            layer_flat_grads = self._layer_flat_grads.get(
+                len(self.layers) - 1 - i)
+            if layer_flat_grads is not None:
+                params_kwargs['out'] = layer_flat_grads
+            # gradients wrt the inputs of the first layer with parameters
+            # (e.g. the model inputs) are not needed
+            grads_wrt_inputs, grads_wrt_layer_params = self._bprop_layer(
+                layer, inputs, outputs, grads_wrt_outputs, bprop_kwargs,
+                params_kwargs, i < len(self.layers) - 1 - first)
+            if grads_wrt_layer_params is not None:
+                grads_wrt_params += grads_wrt_layer_params[::-1]
+            if new_buffers is not None:
+                new_buffers.append((
+                    _owned_or_none(grads_wrt_inputs, grads_wrt_outputs),
+                    grads_wrt_layer_params))
             grads_wrt_outputs = grads_wrt_inputs
+        if new_buffers is not None:
+            self._grad_buffers[buffers_key] = new_buffers
+        if self._flat_grads is not None:
+            return self._flat_grads_result(grads_wrt_params[::-1])
         return grads_wrt_params[::-1]
 
+    def predict(self, inputs_or_provider, chunk_size=None):
+        """Generates the model outputs for inputs in chunks.
+
+        Unlike `fprop` only the activations of the layer currently being
+        evaluated are kept, each intermediate activation being freed as soon
+        as the next is computed, so the memory needed is bounded by the
+        chunk size rather than the number of inputs. The deterministic
+        forward propagation of stochastic layers is used.
+
+        Args:
+            inputs_or_provider: Either an array of inputs or a data provider
+                iterating over `(inputs_batch, targets_batch)` pairs (for
+                one pass through the data), in which case the targets are
+                ignored.
+            chunk_size: Maximum number of inputs propagated at once. Inputs
+                (or provider batches) are split into chunks of this many
+                inputs, with the last chunk of each possibly smaller. If
+                `None` arrays are propagated as a whole and each provider
+                batch as one chunk.
+
+        Yields:
+            Array of model outputs for each chunk of inputs, in order.
+        """
+        for inputs in _chunks(inputs_or_provider, chunk_size):
+            if self.dtype is not None:
+                inputs = inputs.astype(self.dtype, copy=False)
+            for layer in self.layers:
+                if (isinstance(layer, StochasticLayer) or
+                        isinstance(layer, StochasticLayerWithParameters)):
+                    inputs = layer.fprop(inputs, stochastic=False)
+                else:
+                    inputs = layer.fprop(inputs)
+                self._check_dtype(inputs, layer, 'outputs')
+            yield inputs
+
+    def compile(self, input_shape, dtype=None):
+        """Compiles an execution plan for inputs of a fixed shape.
+
+        Infers the shapes of all activations by propagating a batch of zeros
+        through the model, checking the layers are compatible with each
+        other, and returns an `ExecutionPlan` with the per-layer calls and
+        output buffers fixed in advance. The plan can be used in place of
+        the model (e.g. passed to an optimiser) for batches of this shape.
+
+        Args:
+            input_shape: Shape of the input batches, including the batch
+                size.
+            dtype: Dtype of the inputs. If `None` the model dtype is used if
+                set, otherwise the default dtype.
+
+        Returns:
+            `ExecutionPlan` instance.
+        """
+        assert self.num_shards == 1 and self.checkpoints is None, (
+            'Compiling sharded or checkpointed models is not supported.'
+        )
+        if dtype is None:
+            dtype = self.dtype
+        return ExecutionPlan(self, input_shape, resolve_dtype(dtype))
+
+    def _bprop_layer(self, layer, inputs, outputs, grads_wrt_outputs,
+                     bprop_kwargs, params_kwargs, grads_wrt_inputs=True):
+        """Back propagates through a layer and computes its parameter grads.
+
+        Layers defining a `backward` method compute both in a single call.
+
+        Returns:
+            Tuple `(grads_wrt_inputs, grads_wrt_layer_params)`, the former
+            being `None` if `grads_wrt_inputs` is False and the latter for
+            layers without parameters.
+        """
+        grads_wrt_layer_params = None
+        has_params = (isinstance(layer, LayerWithParameters) or
+                      isinstance(layer, StochasticLayerWithParameters))
+        if has_params and hasattr(layer, 'backward'):
+            grads_wrt_inputs, grads_wrt_layer_params = layer.backward(
+                inputs, outputs, grads_wrt_outputs, grads_wrt_inputs,
+                out=bprop_kwargs.get('out'),
+                params_out=params_kwargs.get('out'))
+        else:
+            if grads_wrt_inputs:
+                grads_wrt_inputs = layer.bprop(
+                    inputs, outputs, grads_wrt_outputs, **bprop_kwargs)
+            else:
+                grads_wrt_inputs = None
+            if has_params:
+                grads_wrt_layer_params = layer.grads_wrt_params(
+                    inputs, grads_wrt_outputs, **params_kwargs)
+        if grads_wrt_inputs is not None:
+            self._check_dtype(grads_wrt_inputs, layer, 'gradients wrt inputs')
+        if grads_wrt_layer_params is not None:
+            for grad in grads_wrt_layer_params:
+                self._check_dtype(grad, layer, 'gradients wrt parameters')
+        return grads_wrt_inputs, grads_wrt_layer_params
+
+    def _first_layer_with_params(self):
+        """Returns the index of the first layer with parameters.
+
+        The gradients with respect to the inputs of this and any earlier
+        layers are not needed to calculate the parameter gradients, so the
+        backward passes stop at this layer. Returns the number of layers if
+        no layer has parameters.
+        """
+        for i, layer in enumerate(self.layers):
+            if (isinstance(layer, LayerWithParameters) or
+                    isinstance(layer, StochasticLayerWithParameters)):
+                return i
+        return len(self.layers)
+
+    def _fprop_layer(self, i, inputs):
+        """Forward propagates through layer `i` as in a training pass."""
+        outputs = self.layers[i].fprop(inputs, **self._train_fprop_kwargs[i])
+        self._check_dtype(outputs, self.layers[i], 'outputs')
+        return outputs
+
+    def _is_stochastic(self, i):
+        """Returns whether layer `i` has a stochastic forward propagation."""
+        return self._stochastic[i]
+
+    def _checkpointed_fprop(self, inputs):
+        """Training forward pass only keeping the checkpointed activations."""
+        kept = set(self.checkpoints)
+        kept.add(len(self.layers))
+        self._rng_states_before = {}
+        activations = [inputs]
+        current_activations = inputs
+        for i in range(len(self.layers)):
+            # layers whose outputs are discarded are rerun in the backward
+            # pass so the state of any random number generator is recorded
+            if i + 1 not in kept and self._is_stochastic(i):
+                self._rng_states_before[i] = self.layers[i].get_rng_state()
+            current_activations = self._fprop_layer(i, current_activations)
+            activations.append(
+                current_activations if i + 1 in kept else None)
+            # caches referring to discarded activations would keep them alive
+            if i not in kept and i > 0 or i + 1 not in kept:
+                self.layers[i].clear_cache()
+        self._rng_states_after = {
+            i: self.layers[i].get_rng_state()
+            for i in self._rng_states_before}
+        return activations
+
+    def _checkpointed_grads_wrt_params(self, activations, grads_wrt_outputs):
+        """Calculates parameter gradients recomputing discarded activations.
+
+        The activations must be those returned by the most recent call to
+        `fprop`, so that the recorded random number generator states match.
+        """
+        boundaries = [0] + self.checkpoints + [len(self.layers)]
+        grads_wrt_params = []
+        segments = list(zip(boundaries[:-1], boundaries[1:]))
+        first = self._first_layer_with_params()
+        for start, stop in reversed(segments):
+            if stop <= first:
+                break
+            # recompute the activations within the segment, of which only
+            # those of one segment are therefore kept at a time
+            segment_activations = [activations[start]]
+            for i in range(start, stop - 1):
+                if i in self._rng_states_before:
+                    self.layers[i].set_rng_state(self._rng_states_before[i])
+                segment_activations.append(
+                    self._fprop_layer(i, segment_activations[-1]))
+            segment_activations.append(activations[stop])
+            for i in range(stop - 1, max(start, first) - 1, -1):
+                grads_wrt_inputs, grads_wrt_layer_params = self._bprop_layer(
+                    self.layers[i], segment_activations[i - start],
+                    segment_activations[i - start + 1], grads_wrt_outputs,
+                    {}, {'out': self._layer_flat_grads.get(i)}, i > first)
+                if grads_wrt_layer_params is not None:
+                    grads_wrt_params += grads_wrt_layer_params[::-1]
+                grads_wrt_outputs = grads_wrt_inputs
+            # free the recomputed activations before the next segment
+            for i in range(start, stop):
+                if i > start or i + 1 < stop:
+                    self.layers[i].clear_cache()
+        # leave the generators as after the original forward pass
+        for i, state in self._rng_states_after.items():
+            self.layers[i].set_rng_state(state)
+        if self._flat_grads is not None:
+            return self._flat_grads_result(grads_wrt_params[::-1])
+        return grads_wrt_params[::-1]
+
+    def _get_shards(self):
+        """Returns the per shard models, creating them if needed."""
+        if self._shards is None:
+            self._shards = []
+            for shard_index in range(self.num_shards):
+                # parameter penalty gradients should only be included once in
+                # the sum over shards
+                replicas = [layer.replicate(drop_penalties=shard_index > 0)
+                            for layer in self.layers]
+                self._shards.append(MultipleLayerModel(
+                    replicas, self.use_buffer_arena, self.dtype))
+            self._executor = ThreadPoolExecutor(max_workers=self.num_shards)
+        # the layer parameters may have been reassigned since replicating
+        for shard in self._shards:
+            for layer, replica in zip(self.layers, shard.layers):
+                if isinstance(layer, LayerWithParameters) or isinstance(layer, StochasticLayerWithParameters):
+                    replica.params = layer.params
+                    # penalties may have been moved to the learning rule
+                    replica.include_penalty_grads = getattr(
+                        layer, 'include_penalty_grads', True)
+        return self._shards
+
+    def _sharded_fprop(self, inputs, evaluation):
+        """Forward propagates a batch split in to concurrently run shards."""
+        shards = self._get_shards()
+        inputs_shards = np.array_split(
+            inputs, min(self.num_shards, inputs.shape[0]))
+        if not evaluation:
+            # the replicas of stochastic layers use the rows of one sample
+            # drawn for the whole batch by the layer they replicate
+            stops = np.cumsum([shard.shape[0] for shard in inputs_shards])
+            row_slices = [slice(stop - shard.shape[0], stop)
+                          for shard, stop in zip(inputs_shards, stops)]
+            for i, layer in enumerate(self.layers):
+                if self._is_stochastic(i):
+                    layer.share_samples(
+                        [shard.layers[i] for shard in shards], row_slices)
+        shard_activations = list(self._executor.map(
+            lambda shard, shard_inputs: shard.fprop(shard_inputs, evaluation),
+            shards, inputs_shards))
+        buffers = None
+        if self.use_buffer_arena:
+            buffers_key = (inputs.shape, inputs.dtype, evaluation)
+            buffers = self._activation_buffers.get(buffers_key)
+        activations = [inputs]
+        for i in range(1, len(self.layers) + 1):
+            activations.append(np.concatenate(
+                [shard_acts[i] for shard_acts in shard_activations],
+                out=None if buffers is None else buffers[i - 1]))
+        if self.use_buffer_arena and buffers is None:
+            self._activation_buffers[buffers_key] = activations[1:]
+        self._last_sharded_activations = (activations, shard_activations)
+        return activations
+
+    def _sharded_grads_wrt_params(self, activations, grads_wrt_outputs):
+        """Calculates parameter gradients of concurrently run shards."""
+        shards = self._get_shards()
+        last_activations, shard_activations = self._last_sharded_activations
+        if last_activations is not activations:
+            # split the activations the same way as the inputs in `fprop`
+            num_shards = min(self.num_shards, activations[0].shape[0])
+            shard_activations = list(zip(*[
+                np.array_split(acts, num_shards) for acts in activations]))
+        grads_wrt_outputs_shards = np.array_split(
+            grads_wrt_outputs, len(shard_activations))
+        shard_grads = list(self._executor.map(
+            lambda shard, shard_acts, shard_grads_wrt_outputs:
+                shard.grads_wrt_params(shard_acts, shard_grads_wrt_outputs),
+            shards, shard_activations, grads_wrt_outputs_shards))
+        # reduce in shard order so results are deterministic
+        grads_wrt_params = shard_grads[0]
+        for grads in shard_grads[1:]:
+            for total, grad in zip(grads_wrt_params, grads):
+                total += grad
+        for i, total in enumerate(grads_wrt_params):
+            if isinstance(total, SliceSparseArray):
+                grads_wrt_params[i] = _sum_sparse(
+                    total, [grads[i] for grads in shard_grads])
+        if self._flat_grads is not None:
+            return self._flat_grads_result(grads_wrt_params)
+        return grads_wrt_params
+
+    def _check_dtype(self, array, layer, description):
+        """Asserts an array computed by a layer has the model dtype (if set)."""
+        assert self.dtype is None or array.dtype == self.dtype, (
+            'Expected {0} of {1} to have dtype {2}, got {3}.'.format(
+                description, layer, self.dtype, array.dtype)
+        )
+
     def __repr__(self):
         return (
             'MultiLayerModel(\n    ' +
             '\n    '.join([str(layer) for layer in self.layers]) +
             '\n)'
         )
+
+
+class ExecutionPlan(object):
+    """Forward and backward passes of a model compiled for one input shape.
+
+    Created by `MultipleLayerModel.compile`. The forward and backward passes
+    loop over lists of bound layer methods fixed when the plan is compiled,
+    without per-layer type checks, and write all activations and gradients
+    into buffers allocated at compile time. As for a model using a buffer
+    arena, the arrays returned by `fprop` and `grads_wrt_params` are
+    therefore overwritten by subsequent calls. Batches of any other shape
+    are passed on to the model.
+
+    The list of parameters is also fixed at compile time, so the plan is
+    recompiled if any layer parameters have been reassigned since (see
+    `recompile`).
+    """
+
+    def __init__(self, model, input_shape, dtype):
+        """Compiles an execution plan for a model.
+
+        Args:
+            model: `MultipleLayerModel` instance to compile.
+            input_shape: Shape of the input batches.
+            dtype: Dtype of the inputs.
+        """
+        self.model = model
+        self.input_shape = tuple(input_shape)
+        self.dtype = np.dtype(dtype)
+        self.layers = model.layers
+        self._compile()
+
+    def _compile(self):
+        """Fixes the layer methods, parameters and buffers of the plan."""
+        model = self.model
+        layers = self.layers
+        self._train_fprops = [
+            functools.partial(layer.fprop, **kwargs) if kwargs else
+            layer.fprop
+            for layer, kwargs in zip(layers, model._train_fprop_kwargs)]
+        self._eval_fprops = [
+            functools.partial(layer.fprop, **kwargs) if kwargs else
+            layer.fprop
+            for layer, kwargs in zip(layers, model._eval_fprop_kwargs)]
+        self._backward_steps = []
+        self.params = []
+        self._params_slices = []
+        # (layer, attribute name, array) of each compiled parameter stored
+        # as a layer attribute, checked on every call so that the plan is
+        # recompiled if any are reassigned
+        self._param_attributes = []
+        for layer in layers:
+            if (isinstance(layer, LayerWithParameters) or
+                    isinstance(layer, StochasticLayerWithParameters)):
+                layer_params = layer.params
+                self._params_slices.append(slice(
+                    len(self.params), len(self.params) + len(layer_params)))
+                self.params += layer_params
+                names = {id(value): name
+                         for name, value in vars(layer).items()}
+                self._param_attributes += [
+                    (layer, names[id(param)], param)
+                    for param in layer_params if id(param) in names]
+                if hasattr(layer, 'backward'):
+                    self._backward_steps.append(layer.backward)
+                else:
+                    self._backward_steps.append(_separate_backward(layer))
+            else:
+                self._params_slices.append(None)
+                self._backward_steps.append(_bprop_backward(layer))
+        # as returned by the model, i.e. flat if the model parameters are
+        self.params = model.params
+        # dry runs of the passes to infer the shapes and adopt the arrays
+        # computed as buffers, leaving the layer random states unchanged
+        rng_states = {i: layers[i].get_rng_state()
+                      for i in range(len(layers)) if model._is_stochastic(i)}
+        inputs = np.zeros(self.input_shape, self.dtype)
+        self._train_buffers = [None] * len(layers)
+        self._grad_buffers = [(None, None)] * len(layers)
+        activations = self._dry_run_fprop(inputs, self._train_fprops)
+        self._train_buffers = [
+            _owned_or_none(outputs, inputs)
+            for inputs, outputs in zip(activations[:-1], activations[1:])]
+        self.activation_shapes = [acts.shape for acts in activations]
+        grads_wrt_outputs = np.zeros_like(activations[-1])
+        self._first_with_params = model._first_layer_with_params()
+        for i in range(len(layers) - 1, self._first_with_params - 1, -1):
+            grads_wrt_inputs, grads_wrt_layer_params = (
+                self._backward_steps[i](
+                    activations[i], activations[i + 1], grads_wrt_outputs,
+                    i > self._first_with_params, None, None))
+            self._grad_buffers[i] = (
+                None if grads_wrt_inputs is None else
+                _owned_or_none(grads_wrt_inputs, grads_wrt_outputs),
+                model._layer_flat_grads.get(i, grads_wrt_layer_params))
+            grads_wrt_outputs = grads_wrt_inputs
+        activations = self._dry_run_fprop(inputs, self._eval_fprops)
+        self._eval_buffers = [
+            _owned_or_none(outputs, inputs)
+            for inputs, outputs in zip(activations[:-1], activations[1:])]
+        for i, state in rng_states.items():
+            layers[i].set_rng_state(state)
+        self._grads_wrt_params = [None] * len(self.params)
+
+    @property
+    def output_shape(self):
+        """Shape of the model outputs for the compiled input shape."""
+        return self.activation_shapes[-1]
+
+    def recompile(self):
+        """Recompiles the plan, e.g. after changing the layer parameters.
+
+        This is done automatically on the next call if any parameter stored
+        as a layer attribute (as for all the layers in `mlp.layers`) has
+        been reassigned, so is only needed for layers computing their
+        `params` list in some other way.
+        """
+        self._compile()
+
+    def _recompile_if_params_reassigned(self):
+        """Recompiles the plan if any layer parameters have been reassigned.
+
+        Only the identities of the parameter attributes recorded at compile
+        time are compared, so updating the parameters in place (as the
+        learning rules do) is free.
+        """
+        for layer, name, param in self._param_attributes:
+            if getattr(layer, name) is not param:
+                self._compile()
+                return
+
+    def _dry_run_fprop(self, inputs, fprops):
+        """Forward propagates checking the layers accept their inputs."""
+        activations = [inputs]
+        for i, fprop in enumerate(fprops):
+            layer = self.model.layers[i]
+            try:
+                outputs = fprop(activations[-1])
+            except (ValueError, AssertionError) as e:
+                raise AssertionError(
+                    'Layer {0} ({1}) is incompatible with inputs of shape '
+                    '{2}: {3}'.format(i, layer, activations[-1].shape, e))
+            self.model._check_dtype(outputs, layer, 'outputs')
+            activations.append(outputs)
+        return activations
+
+    def fprop(self, inputs, evaluation=False):
+        """Forward propagates a batch of inputs through the model.
+
+        Args:
+            inputs: Batch of inputs to the model.
+            evaluation: Whether to use the deterministic forward propagation
+                of stochastic layers.
+
+        Returns:
+            List of the activations at the output of all layers of the model
+            plus the inputs (to the first layer) as the first element.
+        """
+        if inputs.shape != self.input_shape:
+            return self.model.fprop(inputs, evaluation)
+        self._recompile_if_params_reassigned()
+        inputs = inputs.astype(self.dtype, copy=False)
+        if evaluation:
+            fprops, buffers = self._eval_fprops, self._eval_buffers
+        else:
+            fprops, buffers = self._train_fprops, self._train_buffers
+        activations = [inputs]
+        for fprop, out in zip(fprops, buffers):
+            activations.append(fprop(activations[-1], out=out))
+        return activations
+
+    @property
+    def penalties(self):
+        """A list of the penalties (or `None`) of each of the parameters."""
+        return self.model.penalties
+
+    def params_penalty(self):
+        """Returns the value of the parameter penalty terms of the model."""
+        return self.model.params_penalty()
+
+    def predict(self, inputs_or_provider, chunk_size=None):
+        """Generates the model outputs for inputs in chunks.
+
+        See `MultipleLayerModel.predict`, which this calls.
+        """
+        return self.model.predict(inputs_or_provider, chunk_size)
+
+    def grads_wrt_params(self, activations, grads_wrt_outputs):
+        """Calculates gradients with respect to the model parameters.
+
+        Args:
+            activations: List of all activations from forward pass through
+                model using `fprop`.
+            grads_wrt_outputs: Gradient with respect to the model outputs of
+               the scalar function parameter gradients are being calculated
+               for.
+
+        Returns:
+            List of gradients of the scalar function with respect to all model
+            parameters.
+        """
+        if activations[0].shape != self.input_shape:
+            return self.model.grads_wrt_params(activations, grads_wrt_outputs)
+        self._recompile_if_params_reassigned()
+        grads_wrt_params = self._grads_wrt_params
+        first = self._first_with_params
+        for i in range(len(self._backward_steps) - 1, first - 1, -1):
+            out, params_out = self._grad_buffers[i]
+            grads_wrt_outputs, grads_wrt_layer_params = (
+                self._backward_steps[i](
+                    activations[i], activations[i + 1], grads_wrt_outputs,
+                    i > first, out, params_out))
+            if grads_wrt_layer_params is not None:
+                grads_wrt_params[self._params_slices[i]] = (
+                    grads_wrt_layer_params)
+        if self.model._flat_grads is not None:
+            return self.model._flat_grads_result(grads_wrt_params)
+        return list(grads_wrt_params)
+
+    def __repr__(self):
+        return 'ExecutionPlan(input_shape={0}, dtype={1})'.format(
+            self.input_shape, self.dtype)
+
+
+def _separate_backward(layer):
+    """Returns a `backward` function calling `bprop` and `grads_wrt_params`."""
+    def backward(inputs, outputs, grads_wrt_outputs, grads_wrt_inputs=True,
+                 out=None, params_out=None):
+        grads_wrt_layer_params = layer.grads_wrt_params(
+            inputs, grads_wrt_outputs, out=params_out)
+        if not grads_wrt_inputs:
+            return None, grads_wrt_layer_params
+        return (layer.bprop(inputs, outputs, grads_wrt_outputs, out=out),
+                grads_wrt_layer_params)
+    return backward
+
+
+def _bprop_backward(layer):
+    """Returns a `backward` function for a layer without parameters."""
+    def backward(inputs, outputs, grads_wrt_outputs, grads_wrt_inputs=True,
+                 out=None, params_out=None):
+        if not grads_wrt_inputs:
+            return None, None
+        return layer.bprop(inputs, outputs, grads_wrt_outputs, out=out), None
+    return backward
+
+
+def _layer_penalties(layer):
+    """Returns the list of penalties of a layer's parameters."""
+    penalties = getattr(layer, 'penalties', None)
+    if penalties is None:
+        return [None] * len(layer.params)
+    return penalties
+
+
+def _sum_sparse(total, grads):
+    """Returns a sum of sparse gradients marked with all their active slices.
+
+    Args:
+        total: `SliceSparseArray` the sum of `grads` was accumulated in.
+        grads: Gradients summed, which are dense unless all are sparse.
+    """
+    if all(isinstance(grad, SliceSparseArray) and grad.active is not None
+           for grad in grads):
+        return SliceSparseArray.wrap(
+            total, functools.reduce(np.union1d, [g.active for g in grads]),
+            total.axis)
+    return total.view(np.ndarray)
+
+
+def _chunks(inputs_or_provider, chunk_size=None):
+    """Generates chunks of at most `chunk_size` inputs for `predict` methods.
+
+    Args:
+        inputs_or_provider: Array of inputs or data provider iterating over
+            `(inputs_batch, targets_batch)` pairs.
+        chunk_size: Maximum number of inputs per chunk or `None` to not split
+            arrays (or provider batches).
+
+    Yields:
+        Views of consecutive chunks of the inputs.
+    """
+    assert chunk_size is None or chunk_size > 0, (
+        'chunk_size should be positive.'
+    )
+    if isinstance(inputs_or_provider, np.ndarray):
+        batches = [inputs_or_provider]
+    else:
+        batches = (inputs for inputs, _ in inputs_or_provider)
+    for inputs in batches:
+        if chunk_size is None:
+            yield inputs
+            continue
+        for start in range(0, inputs.shape[0], chunk_size):
+            yield inputs[start:start + chunk_size]
+
+
+def _owned_or_none(outputs, inputs):
+    """Returns `outputs` unless it shares memory with `inputs`.
+
+    Used to decide which arrays returned by layer methods can be adopted as
+    reusable buffers: arrays which are views of the layer inputs (e.g. from a
+    `ReshapeLayer`) cannot be written to without corrupting the inputs, and
+    sparse outputs (e.g. a `GridBasisArray`) cannot be written to at all.
+    """
+    if (not isinstance(outputs, np.ndarray) or
+            np.may_share_memory(outputs, inputs)):
+        return None
+    return outputs
@@ -5,11 +5,19 @@ This module contains objects implementing (batched) stochastic gradient descent
 based optimisation of models.
 """
 
+import copy
 import time
+import inspect
 import logging
+import contextlib
+import multiprocessing
+from multiprocessing import shared_memory
 from collections import OrderedDict
 import numpy as np
 import tqdm
+from mlp.arrays import FlatArrayList
+from mlp.layers import LayerWithParameters, StochasticLayerWithParameters
+from mlp.learning_rules import GradientDescentLearningRule, MomentumLearningRule
 
 logger = logging.getLogger(__name__)
 
@@ -18,9 +26,21 @@ class Optimiser(object):
     """Basic model optimiser."""
 
     def __init__(self, model, error, learning_rule, train_dataset,
-                 valid_dataset=None, data_monitors=None, notebook=False):
+                 valid_dataset=None, data_monitors=None, notebook=False,
+                 micro_batch_size=None, eval_chunk_size=None,
+                 monitor_penalty=False):
         """Create a new optimiser instance.
 
+        If the model has parameter penalties and the learning rule's
+        `initialise` method accepts them, they are registered with the
+        learning rule, which adds their gradients in-place during its update.
+        The layers are then set to not compute the penalty gradients while
+        the optimiser calculates gradients (in `batch_error_and_grads` and
+        the worker processes of the parallel optimisers) only, so the model
+        is left unchanged for use without the optimiser. Otherwise (e.g. for
+        a learning rule overriding `initialise(params)`) the layers add the
+        penalty gradients as usual.
+
         Args:
             model: The model to optimise.
             error: The scalar error function to minimise.
@@ -33,11 +53,36 @@ class Optimiser(object):
                 validation data sets) to monitor during training in addition
                 to the error. Keys should correspond to a string label for
                 the statistic being evaluated.
+            micro_batch_size: If not `None`, each training batch is split
+                into micro-batches of (at most) this many data points which
+                are propagated through the model one at a time, with their
+                gradients accumulated before a single parameter update per
+                batch. The update is the same as for the whole batch but the
+                memory needed for the model activations is bounded by the
+                micro-batch size, allowing larger batches to be used.
+            eval_chunk_size: Maximum number of data points propagated through
+                the model at once when evaluating the monitors (see the
+                model `predict` method). If `None` each batch is propagated
+                as a whole.
+            monitor_penalty: Whether to record the value of the model
+                parameter penalty terms (as 'params_penalty') along with the
+                other statistics each time they are computed.
         """
+        assert micro_batch_size is None or micro_batch_size > 0, (
+            'micro_batch_size should be positive.'
+        )
         self.model = model
         self.error = error
         self.learning_rule = learning_rule
-        self.learning_rule.initialise(self.model.params)
+        penalties = getattr(self.model, 'penalties', None)
+        if (penalties is not None and
+                any(penalty is not None for penalty in penalties) and
+                _accepts_penalties(self.learning_rule)):
+            self._penalty_layers = _layers_with_params(self.model)
+            self.learning_rule.initialise(self.model.params, penalties)
+        else:
+            self._penalty_layers = []
+            self.learning_rule.initialise(self.model.params)
         self.train_dataset = train_dataset
         self.valid_dataset = valid_dataset
         self.data_monitors = OrderedDict([('error', error)])
@@ -48,6 +93,11 @@ class Optimiser(object):
             self.tqdm_progress = tqdm.tqdm_notebook
         else:
             self.tqdm_progress = tqdm.tqdm
+        self.micro_batch_size = micro_batch_size
+        self.eval_chunk_size = eval_chunk_size
+        self.monitor_penalty = monitor_penalty
+        # buffers gradients are accumulated in across micro-batches
+        self._accumulated_grads = None
 
     def do_training_epoch(self):
         """Do a single training epoch.
@@ -56,16 +106,55 @@ class Optimiser(object):
         calculating the gradient of the estimated error given the batch with
         respect to all the model parameters and then updates the model
         parameters according to the learning rule.
+
+        Returns:
+            Mean over the batches of the error evaluated on each training
+            batch before the corresponding parameter update.
         """
+        sum_batch_errors = 0.
+        num_batches = 0
         with self.tqdm_progress(total=self.train_dataset.num_batches) as train_progress_bar:
             train_progress_bar.set_description("Epoch Progress")
             for inputs_batch, targets_batch in self.train_dataset:
-                activations = self.model.fprop(inputs_batch)
-                grads_wrt_outputs = self.error.grad(activations[-1], targets_batch)
-                grads_wrt_params = self.model.grads_wrt_params(
-                    activations, grads_wrt_outputs)
+                batch_error, grads_wrt_params = self.batch_error_and_grads(
+                    inputs_batch, targets_batch)
+                sum_batch_errors += batch_error
+                num_batches += 1
                 self.learning_rule.update_params(grads_wrt_params)
                 train_progress_bar.update(1)
+            train_error = sum_batch_errors / max(num_batches, 1)
+            train_progress_bar.set_postfix(error=train_error)
+        return train_error
+
+    def batch_error_and_grads(self, inputs_batch, targets_batch):
+        """Calculates the error and parameter gradients for a training batch.
+
+        Args:
+            inputs_batch: Batch of model inputs.
+            targets_batch: Batch of corresponding target outputs.
+
+        Returns:
+            Tuple `(batch_error, grads_wrt_params)` of the error on the batch
+            and list of gradients of the error (multiplied by the learning
+            rule `loss_scale` if it has one) with respect to the model
+            parameters.
+        """
+        # learning rules using loss scaling (e.g. for reduced precision
+        # training) expect correspondingly scaled gradients
+        loss_scale = getattr(self.learning_rule, 'loss_scale', None)
+        batch_size = inputs_batch.shape[0]
+        with _penalty_grads_excluded(self._penalty_layers):
+            if (self.micro_batch_size is None or
+                    batch_size <= self.micro_batch_size):
+                return _batch_error_and_grads(
+                    self.model, self.error, inputs_batch, targets_batch,
+                    loss_scale)
+            batch_error, self._accumulated_grads = (
+                _micro_batch_error_and_grads(
+                    self.model, self.error, inputs_batch, targets_batch,
+                    self.micro_batch_size, self._accumulated_grads,
+                    loss_scale))
+        return batch_error, self._accumulated_grads
 
     def eval_monitors(self, dataset, label):
         """Evaluates the monitors for the given dataset.
@@ -80,10 +169,17 @@ class Optimiser(object):
         data_mon_vals = OrderedDict([(key + label, 0.) for key
                                      in self.data_monitors.keys()])
         for inputs_batch, targets_batch in dataset:
-            activations = self.model.fprop(inputs_batch, evaluation=True)
-            for key, data_monitor in self.data_monitors.items():
-                data_mon_vals[key + label] += data_monitor(
-                    activations[-1], targets_batch)
+            # monitors are batch means so each chunk is weighted by its share
+            # of the batch to give the same value as for the whole batch
+            start = 0
+            for outputs in self.model.predict(
+                    inputs_batch, self.eval_chunk_size):
+                stop = start + outputs.shape[0]
+                weight = outputs.shape[0] / inputs_batch.shape[0]
+                for key, data_monitor in self.data_monitors.items():
+                    data_mon_vals[key + label] += weight * data_monitor(
+                        outputs, targets_batch[start:stop])
+                start = stop
         for key, data_monitor in self.data_monitors.items():
             data_mon_vals[key + label] /= dataset.num_batches
         return data_mon_vals
@@ -100,6 +196,8 @@ class Optimiser(object):
         if self.valid_dataset is not None:
             epoch_stats.update(self.eval_monitors(
                 self.valid_dataset, '(valid)'))
+        if self.monitor_penalty:
+            epoch_stats['params_penalty'] = self.model.params_penalty()
         return epoch_stats
 
     def log_stats(self, epoch, epoch_time, stats):
@@ -135,8 +233,10 @@ class Optimiser(object):
             progress_bar.set_description("Experiment Progress")
             for epoch in range(1, num_epochs + 1):
                 start_time = time.time()
-                self.do_training_epoch()
+                train_error = self.do_training_epoch()
                 epoch_time = time.time()- start_time
+                logger.debug('Epoch {0}: mean training batch error {1:.2e}'.format(
+                    epoch, train_error))
                 if epoch % stats_interval == 0:
                     stats = self.get_epoch_stats()
                     self.log_stats(epoch, epoch_time, stats)
@@ -146,3 +246,673 @@ class Optimiser(object):
         total_train_time = finish_train_time - start_train_time
         return np.array(run_stats), {k: i for i, k in enumerate(stats.keys())}, total_train_time
 
+
+class DataParallelOptimiser(Optimiser):
+    """Optimiser computing batch gradients in parallel worker processes.
+
+    While the workers run the model parameters are moved into shared memory
+    blocks visible to all of `num_workers` worker processes, keeping their
+    storage layout (i.e. a model with flat parameters keeps them in a single
+    flat array). Each training batch is copied into a
+    shared buffer, and each worker computes the gradients of the error on a
+    contiguous slice of the batch using its own replica of the model. The
+    gradients from all workers are then summed (weighted by the slice sizes)
+    in the main process and a single update applied to the shared
+    parameters with the learning rule, so training is equivalent (up to
+    floating point rounding) to `Optimiser` with the same batches.
+
+    Workers are started with the 'fork' start method (so this is only
+    available on POSIX systems) the first time a training batch is seen and
+    run until `close` is called, which copies the parameter values back into
+    the model's original parameter arrays. As each worker is a separate
+    process it may
+    be worth limiting the number of threads used by NumPy's BLAS in each
+    (e.g. setting the `OMP_NUM_THREADS` environment variable before NumPy is
+    imported).
+    """
+
+    def __init__(self, model, error, learning_rule, train_dataset,
+                 valid_dataset=None, data_monitors=None, notebook=False,
+                 num_workers=2, micro_batch_size=None, eval_chunk_size=None,
+                 monitor_penalty=False):
+        """Create a new data parallel optimiser instance.
+
+        Args:
+            model: The model to optimise.
+            error: The scalar error function to minimise.
+            learning_rule: Gradient based learning rule to use to minimise
+                error.
+            train_dataset: Data provider for training set data batches.
+            valid_dataset: Data provider for validation set data batches.
+            data_monitors: Dictionary of functions evaluated on targets and
+                model outputs (averaged across both full training and
+                validation data sets) to monitor during training in addition
+                to the error. Keys should correspond to a string label for
+                the statistic being evaluated.
+            num_workers: Number of worker processes to split batches across.
+            micro_batch_size: If not `None`, each worker's slice of a
+                batch is split into micro-batches of
+                (at most) this many data points which are propagated through
+                the model one at a time (see `Optimiser`).
+            eval_chunk_size: Maximum number of data points propagated through
+                the model at once when evaluating the monitors (see
+                `Optimiser`).
+            monitor_penalty: Whether to record the value of the model
+                parameter penalty terms (as 'params_penalty') along with the
+                other statistics each time they are computed.
+        """
+        assert num_workers >= 1, 'num_workers should be at least 1.'
+        self.num_workers = num_workers
+        # shared memory blocks holding the parameters and the batch and
+        # gradient buffers respectively
+        self._params_shared_memory = []
+        self._buffers_shared_memory = []
+        self._workers = None
+        # the model's own parameters (and each layer's) while they are
+        # replaced by shared memory copies
+        self._original_params = None
+        self._original_layer_params = None
+        super(DataParallelOptimiser, self).__init__(
+            model, error, learning_rule, train_dataset, valid_dataset,
+            data_monitors, notebook, micro_batch_size=micro_batch_size,
+            eval_chunk_size=eval_chunk_size, monitor_penalty=monitor_penalty)
+
+    @staticmethod
+    def _shared_array(shape, dtype, blocks):
+        """Allocates an array in a new shared memory block.
+
+        The block is appended to the list `blocks`.
+        """
+        dtype = np.dtype(dtype)
+        block = shared_memory.SharedMemory(
+            create=True, size=max(int(np.prod(shape)) * dtype.itemsize, 1))
+        blocks.append(block)
+        return np.ndarray(shape, dtype, buffer=block.buf)
+
+    def _shared_copy(self, array):
+        """Copies a parameter array in to a new shared memory block."""
+        shared = self._shared_array(
+            array.shape, array.dtype, self._params_shared_memory)
+        shared[...] = array
+        return shared
+
+    def _share_params(self):
+        """Replaces the model parameters with shared memory copies.
+
+        Flat model parameters are copied into a single shared flat array,
+        and other parameters each into their own block. The learning rule is
+        set to update the shared copies.
+        """
+        layers = _layers_with_params(self.model)
+        self._original_params = self.model.params
+        self._original_layer_params = [list(layer.params) for layer in layers]
+        if isinstance(self._original_params, FlatArrayList):
+            flat = self._original_params.flat
+            self.model._flatten_params(FlatArrayList(
+                self._shared_array(
+                    flat.shape, flat.dtype, self._params_shared_memory),
+                [param.shape for param in self._original_params]))
+        else:
+            for layer in layers:
+                layer.params = [
+                    self._shared_copy(param) for param in layer.params]
+        self.learning_rule.params = self.model.params
+
+    def _unshare_params(self):
+        """Copies the shared parameters back into the original arrays."""
+        layers = _layers_with_params(self.model)
+        if isinstance(self._original_params, FlatArrayList):
+            self.model._flatten_params(self._original_params)
+        else:
+            for layer, originals in zip(layers, self._original_layer_params):
+                for original, shared in zip(originals, layer.params):
+                    original[...] = shared
+                layer.params = originals
+        self.learning_rule.params = self.model.params
+        self._original_params = self._original_layer_params = None
+
+    def _start_workers(self, inputs_batch, targets_batch):
+        """Allocates shared batch and gradient buffers and starts workers."""
+        self._share_params()
+        batch_size = max(self.train_dataset.batch_size, inputs_batch.shape[0])
+        blocks = self._buffers_shared_memory
+        self._inputs = self._shared_array(
+            (batch_size,) + inputs_batch.shape[1:], inputs_batch.dtype, blocks)
+        self._targets = self._shared_array(
+            (batch_size,) + targets_batch.shape[1:], targets_batch.dtype,
+            blocks)
+        # one gradient slot per worker for each parameter
+        self._worker_grads = [
+            self._shared_array(
+                (self.num_workers,) + param.shape, param.dtype, blocks)
+            for param in self.model.params]
+        # flat if the parameters are, so that the learning rule updates all
+        # of them at once
+        params = self.model.params
+        if isinstance(params, FlatArrayList):
+            self._grads = FlatArrayList.zeros_like(params)
+        else:
+            self._grads = [np.empty_like(param) for param in params]
+        context = multiprocessing.get_context('fork')
+        self._workers = []
+        for worker_index in range(self.num_workers):
+            connection, worker_connection = context.Pipe()
+            # replicate in this process so that stochastic layers spawn a
+            # distinct random number generator for each worker
+            process = context.Process(
+                target=_data_parallel_worker,
+                args=(worker_index,
+                      _replicate_model(self.model, worker_index > 0),
+                      self.error, self._inputs,
+                      self._targets, self._worker_grads,
+                      self.micro_batch_size, worker_connection),
+                daemon=True)
+            process.start()
+            worker_connection.close()
+            self._workers.append((process, connection))
+
+    def batch_error_and_grads(self, inputs_batch, targets_batch):
+        """Calculates the error and parameter gradients for a training batch.
+
+        The batch is split across the worker processes.
+
+        Args:
+            inputs_batch: Batch of model inputs.
+            targets_batch: Batch of corresponding target outputs.
+
+        Returns:
+            Tuple `(batch_error, grads_wrt_params)` of the error on the batch
+            and list of gradients of the error (multiplied by the learning
+            rule `loss_scale` if it has one) with respect to the model
+            parameters.
+        """
+        if self._workers is None:
+            # the forked workers keep the layer settings they start with
+            with _penalty_grads_excluded(self._penalty_layers):
+                self._start_workers(inputs_batch, targets_batch)
+        batch_size = inputs_batch.shape[0]
+        assert batch_size <= self._inputs.shape[0], (
+            'Batch larger than shared batch buffer.'
+        )
+        self._inputs[:batch_size] = inputs_batch
+        self._targets[:batch_size] = targets_batch
+        loss_scale = getattr(self.learning_rule, 'loss_scale', None)
+        bounds = np.linspace(
+            0, batch_size, min(self.num_workers, batch_size) + 1).astype(int)
+        active_workers = self._workers[:len(bounds) - 1]
+        for (_, connection), start, stop in zip(
+                active_workers, bounds[:-1], bounds[1:]):
+            connection.send((start, stop, batch_size, loss_scale))
+        # receiving every worker's result also acts as a barrier ensuring all
+        # gradients have been written before they are summed
+        batch_error = 0.
+        for _, connection in active_workers:
+            batch_error += connection.recv()
+        for grads, worker_grads in zip(self._grads, self._worker_grads):
+            np.sum(worker_grads[:len(active_workers)], axis=0, out=grads)
+        return batch_error, self._grads
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory blocks.
+
+        The model parameters are copied back into the model's original
+        parameter arrays, which the model and learning rule use again.
+        """
+        if self._workers is not None:
+            for process, connection in self._workers:
+                connection.send(None)
+            for process, connection in self._workers:
+                process.join()
+                connection.close()
+            self._workers = None
+            self._inputs = self._targets = self._worker_grads = None
+        for block in self._buffers_shared_memory:
+            block.close()
+            block.unlink()
+        self._buffers_shared_memory = []
+        if self._original_params is not None:
+            self._unshare_params()
+        for block in self._params_shared_memory:
+            block.unlink()
+            try:
+                block.close()
+            except BufferError:
+                # arrays using the memory are still referenced elsewhere
+                # (e.g. by a compiled execution plan) so keep the block
+                # referenced, as closing or garbage collecting it would
+                # unmap the memory
+                _unlinked_shared_memory.append(block)
+        self._params_shared_memory = []
+
+    def train(self, num_epochs, stats_interval=5):
+        """Trains a model for a set number of epochs and closes the workers.
+
+        See `Optimiser.train`.
+        """
+        try:
+            return super(DataParallelOptimiser, self).train(
+                num_epochs, stats_interval)
+        finally:
+            self.close()
+
+
+class HogwildOptimiser(DataParallelOptimiser):
+    """Optimiser applying asynchronous lock-free updates in worker processes.
+
+    Implements the 'Hogwild!' scheme [1]: the model parameters are moved into
+    shared memory and each of `num_workers` worker processes repeatedly
+    computes the gradients on a batch from its own independently shuffled
+    stream of the training data and applies them to the shared parameters
+    with its own copy of the learning rule, without any locking or
+    synchronisation with the other workers. The parameters used to compute a
+    gradient may therefore have been updated by other workers (be 'stale')
+    by the time the update is applied. For sparse-ish problems in which
+    updates rarely conflict this scales close to linearly in the number of
+    workers.
+
+    Each epoch the workers between them perform `train_dataset.num_batches`
+    updates. The throughput (training data points per second) and the
+    staleness of the updates (number of updates by other workers between
+    a worker reading the parameters and applying its update) are logged and
+    recorded in `epoch_throughputs` and `epoch_staleness` after each epoch.
+
+    Only `GradientDescentLearningRule` and `MomentumLearningRule` are
+    supported, with the momenta being local to each worker.
+
+    References:
+      [1]: Hogwild!: A Lock-Free Approach to Parallelizing Stochastic
+           Gradient Descent. Niu, Recht, Re and Wright, 2011
+    """
+
+    def __init__(self, model, error, learning_rule, train_dataset,
+                 valid_dataset=None, data_monitors=None, notebook=False,
+                 num_workers=2, micro_batch_size=None, eval_chunk_size=None,
+                 monitor_penalty=False):
+        """Create a new asynchronous optimiser instance.
+
+        Args:
+            model: The model to optimise.
+            error: The scalar error function to minimise.
+            learning_rule: `GradientDescentLearningRule` or
+                `MomentumLearningRule` instance to use to minimise error.
+            train_dataset: Data provider for training set data batches.
+            valid_dataset: Data provider for validation set data batches.
+            data_monitors: Dictionary of functions evaluated on targets and
+                model outputs (averaged across both full training and
+                validation data sets) to monitor during training in addition
+                to the error. Keys should correspond to a string label for
+                the statistic being evaluated.
+            num_workers: Number of worker processes updating the parameters.
+            micro_batch_size: If not `None`, each batch used by a
+                worker is split into micro-batches of
+                (at most) this many data points which are propagated through
+                the model one at a time (see `Optimiser`).
+            eval_chunk_size: Maximum number of data points propagated through
+                the model at once when evaluating the monitors (see
+                `Optimiser`).
+            monitor_penalty: Whether to record the value of the model
+                parameter penalty terms (as 'params_penalty') along with the
+                other statistics each time they are computed.
+        """
+        assert type(learning_rule) in (
+            GradientDescentLearningRule, MomentumLearningRule), (
+            'Only gradient descent and momentum learning rules are '
+            'supported, got {0}.'.format(type(learning_rule).__name__)
+        )
+        super(HogwildOptimiser, self).__init__(
+            model, error, learning_rule, train_dataset, valid_dataset,
+            data_monitors, notebook, num_workers,
+            micro_batch_size=micro_batch_size,
+            eval_chunk_size=eval_chunk_size, monitor_penalty=monitor_penalty)
+        self.epoch_throughputs = []
+        self.epoch_staleness = []
+        # number of updates applied by each worker
+        self._update_counts = None
+
+    def batch_error_and_grads(self, inputs_batch, targets_batch):
+        """Calculates the error and parameter gradients for a training batch.
+
+        As the workers compute and apply their own gradients, these are
+        calculated in this process (as by `Optimiser`).
+
+        Args:
+            inputs_batch: Batch of model inputs.
+            targets_batch: Batch of corresponding target outputs.
+
+        Returns:
+            Tuple `(batch_error, grads_wrt_params)` of the error on the batch
+            and list of gradients of the error with respect to the model
+            parameters.
+        """
+        return Optimiser.batch_error_and_grads(
+            self, inputs_batch, targets_batch)
+
+    def _launch_async_workers(self):
+        """Allocates the shared update counters and starts the workers."""
+        self._share_params()
+        # number of updates applied by each worker, each only written by the
+        # corresponding worker so no locking is needed
+        self._update_counts = self._shared_array(
+            (self.num_workers,), np.int64, self._buffers_shared_memory)
+        self._update_counts[:] = 0
+        seeds = self.train_dataset.rng.randint(
+            2**31 - 1, size=self.num_workers)
+        context = multiprocessing.get_context('fork')
+        self._workers = []
+        for worker_index in range(self.num_workers):
+            connection, worker_connection = context.Pipe()
+            # replicate in this process so that stochastic layers spawn a
+            # distinct random number generator for each worker
+            process = context.Process(
+                target=_hogwild_worker,
+                args=(worker_index, seeds[worker_index],
+                      _replicate_model(self.model),
+                      self.error, self.learning_rule, self.train_dataset,
+                      self._update_counts, self.micro_batch_size,
+                      worker_connection),
+                daemon=True)
+            process.start()
+            worker_connection.close()
+            self._workers.append((process, connection))
+
+    def close(self):
+        """Stops the worker processes and frees the shared memory blocks.
+
+        The model parameters and the update counts remain valid in this
+        process after closing.
+        """
+        if self._update_counts is not None:
+            # copy out of the shared block before it is unmapped
+            self._update_counts = self._update_counts.copy()
+        super(HogwildOptimiser, self).close()
+
+    def do_training_epoch(self):
+        """Do a single training epoch with asynchronous worker updates.
+
+        Returns:
+            Mean over the batches of the error evaluated on each training
+            batch before the corresponding parameter update.
+        """
+        if self._workers is None:
+            # the forked workers keep the layer settings they start with
+            with _penalty_grads_excluded(self._penalty_layers):
+                self._launch_async_workers()
+        num_batches = self.train_dataset.num_batches
+        # number of updates each worker should perform this epoch
+        worker_num_batches = np.diff(np.linspace(
+            0, num_batches, self.num_workers + 1).astype(int))
+        start_time = time.time()
+        for (_, connection), worker_batches in zip(
+                self._workers, worker_num_batches):
+            connection.send((int(worker_batches),
+                             self.learning_rule.learning_rate))
+        sum_batch_errors = 0.
+        num_data = 0
+        staleness = []
+        with self.tqdm_progress(total=num_batches) as train_progress_bar:
+            train_progress_bar.set_description("Epoch Progress")
+            for (_, connection), worker_batches in zip(
+                    self._workers, worker_num_batches):
+                worker_errors, worker_num_data, worker_staleness = (
+                    connection.recv())
+                sum_batch_errors += worker_errors
+                num_data += worker_num_data
+                staleness.append(worker_staleness)
+                train_progress_bar.update(worker_batches)
+            train_error = sum_batch_errors / max(num_batches, 1)
+            train_progress_bar.set_postfix(error=train_error)
+        throughput = num_data / (time.time() - start_time)
+        staleness = np.concatenate(staleness)
+        self.epoch_throughputs.append(throughput)
+        self.epoch_staleness.append(staleness)
+        logger.info(
+            'Asynchronous epoch: {0:.1f} data points/s, update staleness '
+            'mean {1:.2f} max {2}'.format(
+                throughput, staleness.mean() if staleness.size else 0.,
+                staleness.max() if staleness.size else 0))
+        return train_error
+
+
+def _batch_error_and_grads(model, error, inputs_batch, targets_batch,
+                           scale=None):
+    """Calculates the error on a batch and its gradients wrt the parameters.
+
+    Args:
+        model: Model to calculate the gradients of.
+        error: Error function to evaluate.
+        inputs_batch: Batch of model inputs.
+        targets_batch: Batch of corresponding target outputs.
+        scale: If not `None` scalar the gradients are multiplied by.
+
+    Returns:
+        Tuple `(batch_error, grads_wrt_params)`.
+    """
+    activations = model.fprop(inputs_batch)
+    batch_error, grads_wrt_outputs = error.value_and_grad(
+        activations[-1], targets_batch)
+    if scale is None:
+        grads_wrt_params = model.grads_wrt_params(
+            activations, grads_wrt_outputs)
+    else:
+        # overflows are expected occasionally when loss scaling and are
+        # handled by the learning rule skipping the update
+        with np.errstate(over='ignore', invalid='ignore'):
+            grads_wrt_outputs *= scale
+            grads_wrt_params = model.grads_wrt_params(
+                activations, grads_wrt_outputs)
+    return batch_error, grads_wrt_params
+
+
+def _micro_batch_error_and_grads(model, error, inputs_batch, targets_batch,
+                                 micro_batch_size, accumulated_grads=None,
+                                 scale=None, weight=1.):
+    """Calculates the error and gradients on a batch split in micro-batches.
+
+    The micro-batches are propagated through the model one at a time, with
+    their gradients accumulated.
+
+    Args:
+        model: Model to calculate the gradients of.
+        error: Error function to evaluate.
+        inputs_batch: Batch of model inputs.
+        targets_batch: Batch of corresponding target outputs.
+        micro_batch_size: Maximum number of data points per micro-batch.
+        accumulated_grads: List of arrays to accumulate the gradients in, or
+            `None` to allocate new arrays.
+        scale: If not `None` scalar the gradients are multiplied by.
+        weight: Scalar the error and gradients are multiplied by, e.g. the
+            share of a larger batch `inputs_batch` is a slice of.
+
+    Returns:
+        Tuple `(batch_error, accumulated_grads)`.
+    """
+    batch_size = inputs_batch.shape[0]
+    batch_error = 0.
+    for start in range(0, batch_size, micro_batch_size):
+        stop = min(start + micro_batch_size, batch_size)
+        micro_batch_error, grads_wrt_params = _batch_error_and_grads(
+            model, error, inputs_batch[start:stop],
+            targets_batch[start:stop], scale)
+        # errors are means over the batch so weight each micro-batch by
+        # its share of the batch; weighting the parameter gradients
+        # (rather than the gradients wrt the outputs) also includes any
+        # penalty gradients exactly once in the accumulated total
+        micro_batch_weight = weight * (stop - start) / batch_size
+        batch_error += micro_batch_weight * micro_batch_error
+        if accumulated_grads is None:
+            if isinstance(grads_wrt_params, FlatArrayList):
+                accumulated_grads = FlatArrayList.zeros_like(grads_wrt_params)
+            else:
+                accumulated_grads = [
+                    np.empty_like(grad) for grad in grads_wrt_params]
+        if (isinstance(grads_wrt_params, FlatArrayList) and
+                isinstance(accumulated_grads, FlatArrayList)):
+            pairs = [(accumulated_grads.flat, grads_wrt_params.flat)]
+        else:
+            pairs = zip(accumulated_grads, grads_wrt_params)
+        # the model's gradient arrays are not used after this so can be
+        # scaled in place, avoiding allocating temporaries (overflows are
+        # handled by loss scaling learning rules as for whole batches)
+        with np.errstate(over='ignore', invalid='ignore'):
+            for accumulated_grad, grad in pairs:
+                grad *= micro_batch_weight
+                if start == 0:
+                    accumulated_grad[...] = grad
+                else:
+                    accumulated_grad += grad
+    return batch_error, accumulated_grads
+
+
+# shared memory blocks which have been unlinked but which could not be closed
+# as arrays using them were still referenced
+_unlinked_shared_memory = []
+
+
+@contextlib.contextmanager
+def _penalty_grads_excluded(layers):
+    """Context in which layers do not add parameter penalty gradients."""
+    previous = [vars(layer).get('include_penalty_grads') for layer in layers]
+    for layer in layers:
+        layer.include_penalty_grads = False
+    try:
+        yield
+    finally:
+        for layer, include_penalty_grads in zip(layers, previous):
+            if include_penalty_grads is None:
+                # restore the class default
+                del layer.include_penalty_grads
+            else:
+                layer.include_penalty_grads = include_penalty_grads
+
+
+def _accepts_penalties(learning_rule):
+    """Returns whether a learning rule can be initialised with penalties.
+
+    Wrapping learning rules (e.g. `MixedPrecisionLearningRule`) pass the
+    penalties on so the wrapped learning rule must accept them too.
+    """
+    while learning_rule is not None:
+        if 'penalties' not in inspect.signature(
+                learning_rule.initialise).parameters:
+            return False
+        learning_rule = getattr(learning_rule, 'learning_rule', None)
+    return True
+
+
+def _layers_with_params(model):
+    """Returns the layers of a model which have parameters."""
+    layers = getattr(model, 'layers', None)
+    if layers is None:
+        layers = [model.layer]
+    return [layer for layer in layers
+            if isinstance(layer, LayerWithParameters) or
+            isinstance(layer, StochasticLayerWithParameters)]
+
+
+def _replicate_model(model, drop_penalties=False):
+    """Returns a copy of a model using replicas of its layers for a worker.
+
+    The replicas share the (shared memory) parameters, while stochastic
+    layers draw samples independently of the model's and other replicas'.
+
+    Args:
+        model: The model to replicate.
+        drop_penalties: Whether to remove the parameter penalties from the
+            replicas, e.g. so that they are only included by the first
+            worker's replicas when summing the workers' gradients.
+    """
+    replica = copy.copy(model)
+    if hasattr(model, 'layers'):
+        replica.layers = [layer.replicate(drop_penalties=drop_penalties)
+                          for layer in model.layers]
+    else:
+        replica.layer = model.layer.replicate(drop_penalties=drop_penalties)
+    return replica
+
+
+def _data_parallel_worker(worker_index, model, error, inputs, targets,
+                          worker_grads, micro_batch_size, connection):
+    """Worker process loop for `DataParallelOptimiser`.
+
+    The model should be a replica of the optimised model created with
+    `_replicate_model`. Receives `(start, stop, batch_size, loss_scale)`
+    messages specifying a slice of the shared batch to compute gradients
+    for, writes the gradients in to the worker's slot of the shared gradient
+    buffers and replies with its contribution to the batch error, until a
+    `None` message is received. If `micro_batch_size` is not `None` the
+    gradients of larger slices are accumulated over micro-batches.
+    """
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        start, stop, batch_size, loss_scale = message
+        # the errors are means over the batch so weight each slice's error
+        # and gradients by its share of the batch
+        weight = (stop - start) / batch_size
+        if micro_batch_size is not None and stop - start > micro_batch_size:
+            slice_error, _ = _micro_batch_error_and_grads(
+                model, error, inputs[start:stop], targets[start:stop],
+                micro_batch_size,
+                [grads[worker_index] for grads in worker_grads],
+                loss_scale, weight)
+            connection.send(slice_error)
+            continue
+        scale = weight if loss_scale is None else weight * loss_scale
+        slice_error, grads_wrt_params = _batch_error_and_grads(
+            model, error, inputs[start:stop], targets[start:stop], scale)
+        for grads, grad in zip(worker_grads, grads_wrt_params):
+            grads[worker_index] = grad
+        connection.send(weight * slice_error)
+    connection.close()
+
+
+def _hogwild_worker(worker_index, seed, model, error, learning_rule, dataset,
+                    update_counts, micro_batch_size, connection):
+    """Worker process loop for `HogwildOptimiser`.
+
+    The model should be a replica of the optimised model created with
+    `_replicate_model`. Receives `(num_batches, learning_rate)` messages,
+    for each performing that many updates of the shared parameters on
+    batches from its own shuffled stream of the dataset, and replies with
+    the sum of the batch errors, the number of data points used and an
+    array of the staleness of each update, until a `None` message is
+    received. If `micro_batch_size` is not `None` the gradients of larger
+    batches are accumulated over micro-batches.
+    """
+    dataset.rng = np.random.RandomState(seed)
+    dataset.new_epoch()
+    accumulated_grads = None
+    while True:
+        message = connection.recv()
+        if message is None:
+            break
+        num_batches, learning_rate = message
+        learning_rule.learning_rate = learning_rate
+        sum_batch_errors = 0.
+        num_data = 0
+        staleness = np.empty(num_batches, np.int64)
+        for batch_index in range(num_batches):
+            try:
+                inputs_batch, targets_batch = dataset.next()
+            except StopIteration:
+                inputs_batch, targets_batch = dataset.next()
+            updates_before = update_counts.sum()
+            if (micro_batch_size is not None and
+                    inputs_batch.shape[0] > micro_batch_size):
+                batch_error, accumulated_grads = _micro_batch_error_and_grads(
+                    model, error, inputs_batch, targets_batch,
+                    micro_batch_size, accumulated_grads)
+                grads_wrt_params = accumulated_grads
+            else:
+                batch_error, grads_wrt_params = _batch_error_and_grads(
+                    model, error, inputs_batch, targets_batch)
+            learning_rule.update_params(grads_wrt_params)
+            update_counts[worker_index] += 1
+            # updates applied by other workers while computing this one
+            staleness[batch_index] = (
+                update_counts.sum() - updates_before - 1)
+            sum_batch_errors += batch_error
+            num_data += inputs_batch.shape[0]
+        connection.send((sum_batch_errors, num_data, staleness))
+    connection.close()
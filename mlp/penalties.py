@@ -18,7 +18,9 @@ class L1Penalty(object):
             coefficient: Positive constant to scale penalty term by.
         """
         assert coefficient > 0., 'Penalty coefficient must be positive.'
-        self.coefficient = coefficient
+        # store as a Python float so it does not upcast single precision
+        # parameters when multiplied with them
+        self.coefficient = float(coefficient)
 
     def __call__(self, parameter):
         """Calculate L1 penalty value for a parameter.
@@ -43,6 +45,20 @@ class L1Penalty(object):
         """
         return self.coefficient * np.sign(parameter)
 
+    def add_grad(self, parameter, grads, scratch=None):
+        """Adds the penalty gradient to an array of gradients in-place.
+
+        Args:
+            parameter: Array corresponding to a model parameter.
+            grads: Array of gradients with respect to the parameter to add
+                the penalty gradient to.
+            scratch: Optional array of the same shape as the parameter to use
+                for intermediate results rather than allocating a new array.
+        """
+        scratch = np.sign(parameter, out=scratch)
+        scratch *= self.coefficient
+        grads += scratch
+
     def __repr__(self):
         return 'L1Penalty({0})'.format(self.coefficient)
 
@@ -61,7 +77,9 @@ class L2Penalty(object):
             coefficient: Positive constant to scale penalty term by.
         """
         assert coefficient > 0., 'Penalty coefficient must be positive.'
-        self.coefficient = coefficient
+        # store as a Python float so it does not upcast single precision
+        # parameters when multiplied with them
+        self.coefficient = float(coefficient)
 
     def __call__(self, parameter):
         """Calculate L2 penalty value for a parameter.
@@ -72,7 +90,9 @@ class L2Penalty(object):
         Returns:
             Value of penalty term.
         """
-        return 0.5 * self.coefficient * (parameter ** 2).sum()
+        # a dot product avoids allocating the squared parameter values
+        flat = parameter.ravel()
+        return 0.5 * self.coefficient * np.dot(flat, flat)
 
     def grad(self, parameter):
         """Calculate the penalty gradient with respect to the parameter.
@@ -86,5 +106,18 @@ class L2Penalty(object):
         """
         return self.coefficient * parameter
 
+    def add_grad(self, parameter, grads, scratch=None):
+        """Adds the penalty gradient to an array of gradients in-place.
+
+        Args:
+            parameter: Array corresponding to a model parameter.
+            grads: Array of gradients with respect to the parameter to add
+                the penalty gradient to.
+            scratch: Optional array of the same shape as the parameter to use
+                for intermediate results rather than allocating a new array.
+        """
+        scratch = np.multiply(parameter, self.coefficient, out=scratch)
+        grads += scratch
+
     def __repr__(self):
         return 'L2Penalty({0})'.format(self.coefficient)
\ No newline at end of file
@@ -0,0 +1,81 @@
+"""Tests of the layer computation backends."""
+
+import numpy as np
+import pytest
+import mlp.backends as backends
+from mlp.layers import (
+    AffineLayer, ConvolutionalLayer, ReluLayer, SigmoidLayer, TanhLayer)
+
+
+class _CountingBackend(backends.NumpyBackend):
+    """NumPy backend recording the kernels called."""
+
+    name = 'counting'
+
+    ops = frozenset(['dot', 'tanh', 'tanh_grad'])
+
+    def __init__(self):
+        self.calls = []
+
+    def dot(self, a, b, out=None):
+        self.calls.append('dot')
+        return super(_CountingBackend, self).dot(a, b, out)
+
+    def tanh(self, x, out=None):
+        self.calls.append('tanh')
+        return super(_CountingBackend, self).tanh(x, out)
+
+
+def test_supports_and_assign_backends():
+    backends.register_backend('counting', _CountingBackend)
+    try:
+        _check_counting_backend()
+    finally:
+        # unregister so other tests only see the built in backends
+        backends._backend_classes.pop('counting')
+        backends._backends.pop('counting', None)
+
+
+def _check_counting_backend():
+    counting = backends.get_backend('counting')
+    assert backends.get_backend('counting') is counting
+    numpy_backend = backends.get_backend('numpy')
+    layers = [AffineLayer(3, 4), TanhLayer(), SigmoidLayer(),
+              ConvolutionalLayer(1, 1, 3, 3, 2, 2), ReluLayer()]
+    # all layers support the NumPy backend
+    assert all(backends.supports(numpy_backend, layer) for layer in layers)
+    assert [backends.supports(counting, layer) for layer in layers] == [
+        True, True, False, False, True]
+    backends.assign_backends(layers, 'counting')
+    assert [layer.backend for layer in layers] == [
+        counting, counting, numpy_backend, numpy_backend, numpy_backend]
+    inputs = np.random.RandomState(1).standard_normal((2, 3))
+    expected = np.tanh(inputs.dot(layers[0].weights.T) + layers[0].biases)
+    assert np.allclose(layers[1].fprop(layers[0].fprop(inputs)), expected)
+    assert counting.calls == ['dot', 'tanh']
+    # explicitly assigned backends must support their layers
+    backends.assign_backends(layers[:2], [None, 'counting'])
+    assert layers[0].backend is numpy_backend
+    with pytest.raises(AssertionError):
+        backends.assign_backends(layers[2:3], ['counting'])
+    with pytest.raises(AssertionError):
+        backends.assign_backends(layers, ['counting'])
+    assert 'counting' in backends.available_backends()
+
+
+def test_numexpr_kernels_match_numpy():
+    pytest.importorskip('numexpr')
+    numexpr_backend = backends.get_backend('numexpr')
+    numpy_backend = backends.get_backend('numpy')
+    rng = np.random.RandomState(2)
+    x = rng.standard_normal((5, 7)).astype(np.float32)
+    grads = rng.standard_normal((5, 7)).astype(np.float32)
+    for name in ('sigmoid', 'tanh'):
+        y = getattr(numpy_backend, name)(x)
+        out = np.empty_like(x)
+        assert getattr(numexpr_backend, name)(x, out=out) is out
+        assert np.allclose(out, y, atol=1e-6)
+        assert out.dtype == np.float32
+        assert np.allclose(
+            getattr(numexpr_backend, name + '_grad')(y, grads),
+            getattr(numpy_backend, name + '_grad')(y, grads), atol=1e-6)
@@ -0,0 +1,23 @@
+"""Tests of the data providers."""
+
+import numpy as np
+from mlp.data_providers import EMNISTDataProvider, MNISTDataProvider
+
+
+def test_providers_return_label_targets(monkeypatch, tmp_path):
+    rng = np.random.RandomState(1)
+    labels = rng.randint(10, size=20).astype(np.int8)
+    for name in ('mnist', 'emnist'):
+        np.savez(str(tmp_path / '{0}-valid.npz'.format(name)),
+                 inputs=rng.uniform(size=(20, 784)), targets=labels)
+    monkeypatch.setenv('MLP_DATA_DIR', str(tmp_path))
+    for provider_class in (MNISTDataProvider, EMNISTDataProvider):
+        providers = [
+            provider_class('valid', batch_size=8, shuffle_order=False,
+                           one_hot_targets=one_hot_targets)
+            for one_hot_targets in (True, False)]
+        for (_, one_hot), (_, targets) in zip(*providers):
+            assert targets.shape == (one_hot.shape[0],)
+            assert np.issubdtype(targets.dtype, np.integer)
+            assert np.array_equal(one_hot.argmax(-1), targets)
+            assert np.all(one_hot.sum(-1) == 1)
@@ -0,0 +1,87 @@
+"""Tests of the error functions."""
+
+import numpy as np
+from mlp.errors import (
+    SumOfSquaredDiffsError, BinaryCrossEntropyError,
+    BinaryCrossEntropySigmoidError, CrossEntropyError,
+    CrossEntropySoftmaxError, ClassificationAccuracy)
+
+
+def _outputs_and_targets(seed=1):
+    rng = np.random.RandomState(seed)
+    outputs = rng.uniform(0.05, 0.95, (6, 4)).astype(np.float32)
+    targets = (rng.uniform(size=(6, 4)) > 0.5).astype(np.float64)
+    return outputs, targets
+
+
+def _check_value_and_grad(error, outputs, targets):
+    value, grads = error.value_and_grad(outputs, targets)
+    assert np.allclose(value, error(outputs, targets))
+    assert np.allclose(grads, error.grad(outputs, targets))
+    # targets should not upcast the gradients
+    assert grads.dtype == outputs.dtype
+
+
+def test_value_and_grad_matches_call_and_grad():
+    outputs, targets = _outputs_and_targets()
+    for error in (SumOfSquaredDiffsError(), BinaryCrossEntropyError(),
+                  BinaryCrossEntropySigmoidError()):
+        _check_value_and_grad(error, outputs, targets)
+    probs = outputs / outputs.sum(-1)[:, None]
+    labels = np.random.RandomState(2).randint(4, size=outputs.shape[0])
+    for error in (CrossEntropyError(), CrossEntropySoftmaxError()):
+        _check_value_and_grad(error, probs, labels)
+        _check_value_and_grad(error, probs, np.eye(4)[labels])
+
+
+def _numerical_grad(error, outputs, targets, step=1e-6):
+    numerical = np.empty_like(outputs)
+    for index in np.ndindex(*outputs.shape):
+        shifted = outputs.copy()
+        shifted[index] += step
+        numerical[index] = (
+            error(shifted, targets) - error(outputs, targets)) / step
+    return numerical
+
+
+def test_grad_matches_finite_differences():
+    outputs, targets = _outputs_and_targets()
+    outputs = outputs.astype(np.float64)
+    assert np.allclose(
+        SumOfSquaredDiffsError().grad(outputs, targets),
+        _numerical_grad(SumOfSquaredDiffsError(), outputs, targets),
+        atol=1e-4)
+    # the multi-class errors assume 1 of K coded targets
+    one_hot_targets = np.eye(4)[targets.argmax(-1)]
+    for error in (CrossEntropyError(), CrossEntropySoftmaxError()):
+        assert np.allclose(error.grad(outputs, one_hot_targets),
+                           _numerical_grad(error, outputs, one_hot_targets),
+                           atol=1e-4), error
+    # the binary errors are means over all outputs but their gradients only
+    # over the batch, so are compared for a single output
+    outputs, targets = outputs[:, :1], targets[:, :1]
+    for error in (BinaryCrossEntropyError(),
+                  BinaryCrossEntropySigmoidError()):
+        assert np.allclose(error.grad(outputs, targets),
+                           _numerical_grad(error, outputs, targets),
+                           atol=1e-4), error
+
+
+def test_label_targets_match_one_hot_targets():
+    outputs, _ = _outputs_and_targets()
+    probs = outputs / outputs.sum(-1)[:, None]
+    labels = np.random.RandomState(2).randint(4, size=outputs.shape[0])
+    one_hot = np.eye(4, dtype=np.float32)[labels]
+    for error in (CrossEntropyError(), CrossEntropySoftmaxError()):
+        assert np.allclose(error(probs, labels), error(probs, one_hot))
+        grads = error.grad(probs, labels)
+        assert grads.dtype == probs.dtype
+        assert np.allclose(grads, error.grad(probs, one_hot))
+    accuracy = ClassificationAccuracy()
+    assert accuracy(probs, labels) == accuracy(probs, one_hot)
+    # the largest output of each data point is the target class for half
+    expected = labels.copy()
+    expected[::2] = probs[::2].argmax(-1)
+    expected[1::2] = (probs[1::2].argmax(-1) + 1) % 4
+    assert accuracy(probs, expected) == 0.5
+    assert accuracy(probs, np.eye(4)[expected]) == 0.5
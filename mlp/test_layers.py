@@ -0,0 +1,374 @@
+"""Tests of the layers against naive reference implementations."""
+
+import numpy as np
+import mlp
+from mlp.arrays import GridBasisArray, SliceSparseArray
+from mlp.autotuner import ConvolutionPlanCache
+from mlp.layers import (
+    AffineLayer, ConvolutionalLayer, MaxPooling2DLayer, DropoutLayer,
+    RadialBasisFunctionLayer)
+from mlp.penalties import L2Penalty
+
+
+def _double_precision(test):
+    """Runs a test with double precision as the default dtype."""
+    def wrapped():
+        previous = mlp.get_default_dtype()
+        mlp.set_default_dtype(np.float64)
+        try:
+            test()
+        finally:
+            mlp.set_default_dtype(previous)
+    wrapped.__name__ = test.__name__
+    return wrapped
+
+
+def _numerical_grad(func, array, grads_wrt_outputs, step=1e-6):
+    """Finite difference gradient of `sum(func() * grads_wrt_outputs)`.
+
+    The gradient is with respect to `array`, which is perturbed in-place
+    (and restored) between calls to `func`.
+    """
+    numerical = np.empty_like(array)
+    for index in np.ndindex(*array.shape):
+        original = array[index]
+        array[index] = original + step
+        outputs_plus = func()
+        array[index] = original - step
+        outputs_minus = func()
+        array[index] = original
+        numerical[index] = np.sum(
+            (outputs_plus - outputs_minus) * grads_wrt_outputs) / (2 * step)
+    return numerical
+
+
+def _numerical_grads_wrt_inputs(layer, inputs, grads_wrt_outputs):
+    """Central finite difference estimate of the layer input gradients."""
+    inputs = inputs.copy()
+    return _numerical_grad(
+        lambda: layer.fprop(inputs), inputs, grads_wrt_outputs)
+
+
+@_double_precision
+def test_rbf_layer_matches_reference():
+    rng = np.random.RandomState(1)
+    for input_dim, grid_dim in [(1, 5), (2, 4), (3, 3), (4, 3)]:
+        intervals = [[rng.uniform(), 1. + rng.uniform()]
+                     for _ in range(input_dim)]
+        layer = RadialBasisFunctionLayer(grid_dim, intervals)
+        inputs = rng.uniform(size=(6, input_dim)) * 1.5
+        # distances to every grid point as in the unfactorised layer
+        reference = np.exp(
+            -(inputs[..., None] - layer.centres[None]) ** 2 /
+            layer.scales ** 2).reshape((inputs.shape[0], -1))
+        outputs = layer.fprop(inputs)
+        assert np.allclose(outputs, reference)
+        grads_wrt_outputs = rng.standard_normal(outputs.shape)
+        assert np.allclose(
+            layer.bprop(inputs, outputs, grads_wrt_outputs),
+            _numerical_grads_wrt_inputs(layer, inputs, grads_wrt_outputs),
+            atol=1e-6)
+
+
+@_double_precision
+def test_truncated_rbf_layer_matches_reference():
+    rng = np.random.RandomState(2)
+    for input_dim, grid_dim in [(1, 9), (2, 6), (3, 7)]:
+        intervals = [[rng.uniform(), 1. + rng.uniform()]
+                     for _ in range(input_dim)]
+        layer = RadialBasisFunctionLayer(grid_dim, intervals, support=2.)
+        # include inputs outside the intervals
+        inputs = rng.uniform(-0.5, 2.5, size=(6, input_dim))
+        offsets = (inputs[..., None] - layer.centres[None]) / layer.scales
+        reference = np.where(
+            abs(offsets) > 2., 0., np.exp(-offsets ** 2)).reshape(
+                (inputs.shape[0], -1))
+        outputs = layer.fprop(inputs)
+        assert isinstance(outputs, GridBasisArray)
+        assert outputs.shape == reference.shape
+        assert outputs.values.shape[2] < grid_dim
+        assert np.allclose(outputs.toarray(), reference)
+        grads_wrt_outputs = rng.standard_normal(reference.shape)
+        inputs_copy = inputs.copy()
+        assert np.allclose(
+            layer.bprop(inputs, outputs, grads_wrt_outputs),
+            _numerical_grad(lambda: layer.fprop(inputs_copy).toarray(),
+                            inputs_copy, grads_wrt_outputs),
+            atol=1e-6)
+        # an affine layer gives the same results as for the dense outputs
+        affine = AffineLayer(reference.shape[1], 3)
+        affine.biases = rng.standard_normal(3)
+        assert np.allclose(affine.fprop(outputs), affine.fprop(reference))
+        grads_wrt_affine_outputs = rng.standard_normal((inputs.shape[0], 3))
+        for grad, dense_grad in zip(
+                affine.grads_wrt_params(outputs, grads_wrt_affine_outputs),
+                affine.grads_wrt_params(reference, grads_wrt_affine_outputs)):
+            assert np.allclose(grad, dense_grad)
+
+
+def _naive_convolution(inputs, kernels, biases, padding, stride, dilation):
+    """Loops over output positions applying the flipped kernels."""
+    padded = np.pad(
+        inputs, ((0, 0), (0, 0), (padding, padding), (padding, padding)))
+    flipped_kernels = kernels[:, :, ::-1, ::-1]
+    kernel_extent = [dilation * (size - 1) + 1 for size in kernels.shape[2:]]
+    output_height = (padded.shape[2] - kernel_extent[0]) // stride + 1
+    output_width = (padded.shape[3] - kernel_extent[1]) // stride + 1
+    outputs = np.empty(
+        (inputs.shape[0], kernels.shape[0], output_height, output_width))
+    for i in range(output_height):
+        for j in range(output_width):
+            window = padded[
+                :, :,
+                i * stride:i * stride + kernel_extent[0]:dilation,
+                j * stride:j * stride + kernel_extent[1]:dilation]
+            outputs[:, :, i, j] = np.einsum(
+                'nchw,ochw->no', window, flipped_kernels)
+    return outputs + biases[None, :, None, None]
+
+
+def _check_convolution(algorithm, kernel_size, padding=0, stride=1,
+                       dilation=1, seed=2):
+    """Checks a layer against the naive convolution and its gradients.
+
+    Returns the layer, inputs, outputs and output gradients used.
+    """
+    rng = np.random.RandomState(seed)
+    inputs = rng.standard_normal((2, 3, 6, 5))
+    kernels = rng.standard_normal((4, 3, kernel_size, kernel_size))
+    biases = rng.standard_normal(4)
+    reference = _naive_convolution(
+        inputs, kernels, biases, padding, stride, dilation)
+    grads_wrt_outputs = rng.standard_normal(reference.shape)
+    ref_inputs, ref_kernels = inputs.copy(), kernels.copy()
+    grads_wrt_inputs = _numerical_grad(
+        lambda: _naive_convolution(
+            ref_inputs, kernels, biases, padding, stride, dilation),
+        ref_inputs, grads_wrt_outputs)
+    grads_wrt_kernels = _numerical_grad(
+        lambda: _naive_convolution(
+            inputs, ref_kernels, biases, padding, stride, dilation),
+        ref_kernels, grads_wrt_outputs)
+    layer = ConvolutionalLayer(
+        3, 4, 6, 5, kernel_size, kernel_size, padding=padding,
+        stride=stride, dilation=dilation, algorithm=algorithm)
+    layer.params = [kernels, biases]
+    outputs = layer.fprop(inputs)
+    assert np.allclose(outputs, reference), algorithm
+    assert np.allclose(
+        layer.bprop(inputs, outputs, grads_wrt_outputs),
+        grads_wrt_inputs, atol=1e-6), algorithm
+    grads = layer.grads_wrt_params(inputs, grads_wrt_outputs)
+    assert np.allclose(grads[0], grads_wrt_kernels, atol=1e-6), algorithm
+    assert np.allclose(grads[1], grads_wrt_outputs.sum((0, 2, 3)))
+    return layer, inputs, outputs, grads_wrt_outputs
+
+
+@_double_precision
+def test_im2col_convolution_matches_reference():
+    for kernel_size in (2, 3):
+        _check_convolution('im2col', kernel_size)
+
+
+@_double_precision
+def test_convolution_algorithms_match_reference():
+    for algorithm in ('einsum', 'fft'):
+        for kernel_size in (2, 3):
+            _check_convolution(algorithm, kernel_size)
+
+
+def test_plan_cache_selects_and_persists_plans(tmp_path):
+    path = str(tmp_path / 'plans.json')
+    plan_cache = ConvolutionPlanCache(path, num_repeats=1)
+    layer = ConvolutionalLayer(
+        3, 4, 8, 8, 5, 5, algorithm='auto', plan_cache=plan_cache)
+    inputs = np.random.RandomState(3).standard_normal(
+        (2, 3, 8, 8)).astype(np.float32)
+    assert layer.applicable_algorithms(inputs.shape, inputs.dtype) == [
+        'im2col', 'einsum', 'fft']
+    outputs = layer.fprop(inputs)
+    key = layer.plan_key(inputs.shape, inputs.dtype)
+    algorithm = plan_cache.plans[key]
+    assert algorithm in ConvolutionalLayer.algorithms
+    fixed = ConvolutionalLayer(3, 4, 8, 8, 5, 5, algorithm=algorithm)
+    fixed.params = layer.params
+    assert np.allclose(outputs, fixed.fprop(inputs), atol=1e-5)
+    # plans are keyed by dtype as well as shape
+    assert key != layer.plan_key(inputs.shape, np.float64)
+    # a new cache loads the saved plans rather than benchmarking again
+    loaded = ConvolutionPlanCache(path)
+    assert loaded.plans == plan_cache.plans
+
+    def benchmark(*args):
+        raise AssertionError('Cached plan should not be benchmarked.')
+    loaded.benchmark = benchmark
+    assert loaded.select(layer, inputs.shape, inputs.dtype) == algorithm
+    loaded.clear()
+    assert ConvolutionPlanCache(path).plans == {}
+
+
+def test_plan_cache_is_in_memory_unless_given_a_path(monkeypatch, tmp_path):
+    monkeypatch.delenv('MLP_CONV_PLAN_CACHE', raising=False)
+    monkeypatch.setenv('HOME', str(tmp_path))
+    plan_cache = ConvolutionPlanCache(num_repeats=1)
+    assert not plan_cache.path
+    layer = ConvolutionalLayer(
+        3, 4, 8, 8, 5, 5, padding=1, algorithm='auto', plan_cache=plan_cache)
+    inputs = np.random.RandomState(4).standard_normal(
+        (2, 3, 8, 8)).astype(np.float32)
+    # every timed repeat starts without cached padded inputs
+    padded_at_fprop = []
+
+    def recording(fprop):
+        def wrapped(*args, **kwargs):
+            padded_at_fprop.append(layer._padded)
+            return fprop(*args, **kwargs)
+        return wrapped
+    for algorithm in ConvolutionalLayer.algorithms:
+        name = '_fprop_' + algorithm
+        monkeypatch.setattr(layer, name, recording(getattr(layer, name)))
+    plan_cache.num_repeats = 2
+    layer.fprop(inputs)
+    assert len(padded_at_fprop) == 2 * len(
+        layer.applicable_algorithms(inputs.shape, inputs.dtype)) + 1
+    assert all(padded is None for padded in padded_at_fprop[:-1])
+    assert len(plan_cache.plans) == 1
+    assert not list(tmp_path.iterdir())
+    # the environment variable opts in to persisting plans
+    path = str(tmp_path / 'plans.json')
+    monkeypatch.setenv('MLP_CONV_PLAN_CACHE', path)
+    plan_cache = ConvolutionPlanCache(num_repeats=1)
+    assert plan_cache.path == path
+    plan_cache.select(layer, inputs.shape, inputs.dtype)
+    assert ConvolutionPlanCache(path).plans == plan_cache.plans
+
+
+@_double_precision
+def test_max_pooling_matches_reference():
+    rng = np.random.RandomState(3)
+    inputs = rng.standard_normal((2, 3, 7, 6))
+    for size, stride in [(2, 2), (3, 2), (2, 1)]:
+        layer = MaxPooling2DLayer(7, 6, size, stride)
+        output_height = (7 - size) // stride + 1
+        output_width = (6 - size) // stride + 1
+        reference = np.empty((2, 3, output_height, output_width))
+        for i in range(output_height):
+            for j in range(output_width):
+                reference[:, :, i, j] = inputs[
+                    :, :, i * stride:i * stride + size,
+                    j * stride:j * stride + size].max((2, 3))
+        outputs = layer.fprop(inputs)
+        assert np.allclose(outputs, reference)
+        grads_wrt_outputs = rng.standard_normal(outputs.shape)
+        grads_wrt_inputs = layer.bprop(inputs, outputs, grads_wrt_outputs)
+        assert np.allclose(
+            grads_wrt_inputs,
+            _numerical_grads_wrt_inputs(layer, inputs, grads_wrt_outputs),
+            atol=1e-6)
+
+
+@_double_precision
+def test_padded_strided_dilated_convolutions_match_reference():
+    configs = [
+        # (kernel size, padding, stride, dilation, algorithms)
+        (3, 1, 1, 1, ('im2col', 'einsum', 'fft')),
+        (2, 1, 1, 1, ('im2col', 'einsum', 'fft')),
+        (3, 1, 2, 1, ('im2col', 'einsum')),
+        (2, 0, 1, 2, ('im2col', 'einsum')),
+        (2, 2, 2, 2, ('im2col', 'einsum')),
+    ]
+    for kernel_size, padding, stride, dilation, algorithms in configs:
+        for algorithm in algorithms:
+            _check_convolution(
+                algorithm, kernel_size, padding, stride, dilation)
+
+
+def test_dropout_masks():
+    inputs = np.random.RandomState(4).uniform(
+        0.5, 1., (100, 1000)).astype(np.float32)
+    for share_across_batch in (True, False):
+        for inverted in (False, True):
+            layer = DropoutLayer(
+                np.random.RandomState(5), incl_prob=0.7,
+                share_across_batch=share_across_batch, inverted=inverted)
+            state = layer.get_rng_state()
+            outputs = layer.fprop(inputs)
+            mask = outputs != 0
+            scale = 1. / 0.7 if inverted else 1.
+            assert np.allclose(outputs[mask], inputs[mask] * scale)
+            assert abs(mask.mean() - 0.7) < 0.05
+            if share_across_batch:
+                assert (mask == mask[:1]).all()
+            grads_wrt_outputs = np.ones_like(inputs)
+            grads_wrt_inputs = layer.bprop(
+                inputs, outputs, grads_wrt_outputs)
+            assert np.allclose(grads_wrt_inputs, mask * scale)
+            # restoring the generator state reproduces the mask
+            layer.set_rng_state(state)
+            assert np.array_equal(layer.fprop(inputs), outputs)
+            deterministic = layer.fprop(inputs, stochastic=False)
+            assert np.allclose(
+                deterministic, inputs if inverted else inputs * 0.7)
+    # the deterministic inverted forward propagation does not copy
+    layer = DropoutLayer(inverted=True)
+    assert layer.fprop(inputs, stochastic=False) is inputs
+    # replicas sample independent masks without advancing the layer's
+    # generator
+    state = layer.get_rng_state()
+    replicas = [layer.replicate() for _ in range(2)]
+    masks = [replica.fprop(inputs) != 0 for replica in replicas]
+    assert not np.array_equal(masks[0], masks[1])
+    assert layer.get_rng_state() == state
+    assert not np.array_equal(layer.fprop(inputs) != 0, masks[0])
+
+
+@_double_precision
+def test_sparse_affine_grads_match_dense():
+    rng = np.random.RandomState(6)
+    inputs = np.zeros((8, 20))
+    inputs[np.arange(8), rng.randint(5, size=8)] = 1.
+    grads_wrt_outputs = rng.standard_normal((8, 3))
+    dense = AffineLayer(20, 3)
+    sparse = AffineLayer(20, 3, sparse_grads=True)
+    sparse.params = dense.params
+    grads = sparse.grads_wrt_params(inputs, grads_wrt_outputs)
+    assert isinstance(grads[0], SliceSparseArray)
+    assert grads[0].axis == 1
+    assert np.array_equal(grads[0].active, np.flatnonzero(inputs.any(0)))
+    for grad, dense_grad in zip(
+            grads, dense.grads_wrt_params(inputs, grads_wrt_outputs)):
+        assert np.allclose(grad, dense_grad)
+    # dense penalty gradients make the weight gradients dense
+    sparse.weights_penalty = L2Penalty(1e-2)
+    grads = sparse.grads_wrt_params(inputs, grads_wrt_outputs)
+    assert not isinstance(grads[0], SliceSparseArray)
+
+
+def test_backward_matches_bprop_and_grads_wrt_params():
+    rng = np.random.RandomState(7)
+    layers_and_inputs = [
+        (AffineLayer(5, 3), rng.standard_normal((4, 5)))]
+    for algorithm in ConvolutionalLayer.algorithms:
+        layers_and_inputs.append((
+            ConvolutionalLayer(3, 4, 6, 5, 3, 3, padding=1,
+                               algorithm=algorithm),
+            rng.standard_normal((2, 3, 6, 5))))
+    for layer, inputs in layers_and_inputs:
+        layer.params = [rng.standard_normal(param.shape)
+                        for param in layer.params]
+        outputs = layer.fprop(inputs)
+        grads_wrt_outputs = rng.standard_normal(outputs.shape)
+        grads_wrt_inputs, grads_wrt_params = layer.backward(
+            inputs, outputs, grads_wrt_outputs)
+        assert np.allclose(
+            grads_wrt_inputs,
+            layer.bprop(inputs, outputs, grads_wrt_outputs)), layer
+        for grad, expected in zip(
+                grads_wrt_params,
+                layer.grads_wrt_params(inputs, grads_wrt_outputs)):
+            assert np.allclose(grad, expected), layer
+        # the input gradients are skipped if not needed
+        grads_wrt_inputs, grads_wrt_params = layer.backward(
+            inputs, outputs, grads_wrt_outputs, grads_wrt_inputs=False)
+        assert grads_wrt_inputs is None
+        assert len(grads_wrt_params) == 2
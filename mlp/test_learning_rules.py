@@ -0,0 +1,248 @@
+"""Tests of the learning rules."""
+
+import numpy as np
+from mlp.arrays import FlatArrayList, SliceSparseArray
+from mlp.learning_rules import (
+    GradientDescentLearningRule, MomentumLearningRule, AdamLearningRule,
+    AdamLearningRuleWithWeightDecay, AdaGradLearningRule,
+    RMSPropLearningRule, LARSLearningRule, LAMBLearningRule,
+    MixedPrecisionLearningRule)
+from mlp.penalties import L1Penalty, L2Penalty
+
+SHAPES = [(4, 6), (4,), (3, 2, 2)]
+
+
+def _all_learning_rules():
+    return [
+        GradientDescentLearningRule(1e-2),
+        MomentumLearningRule(1e-2, 0.9),
+        AdamLearningRule(),
+        AdamLearningRuleWithWeightDecay(weight_decay=1e-2),
+        AdaGradLearningRule(),
+        RMSPropLearningRule(),
+        LARSLearningRule(weight_decay=1e-3),
+        LAMBLearningRule(weight_decay=1e-3),
+    ]
+
+
+def _random_arrays(rng, shapes=SHAPES):
+    return [rng.standard_normal(shape) for shape in shapes]
+
+
+def _as_flat(arrays):
+    flat_arrays = FlatArrayList.zeros_like(arrays)
+    for flat_array, array in zip(flat_arrays, arrays):
+        flat_array[...] = array
+    return flat_arrays
+
+
+def _run(learning_rule, params, grads_sequence, penalties=None):
+    learning_rule.initialise(params, penalties)
+    for grads in grads_sequence:
+        learning_rule.update_params(grads)
+    return params
+
+
+def test_mixed_precision_updates_master_params():
+    rng = np.random.RandomState(7)
+    params = _random_arrays(rng)
+    grads_sequence = [_random_arrays(rng) for _ in range(3)]
+    expected = _run(GradientDescentLearningRule(1e-1),
+                    [param.astype(np.float32) for param in params],
+                    [[grad.astype(np.float32) for grad in grads]
+                     for grads in grads_sequence])
+    rule = MixedPrecisionLearningRule(
+        GradientDescentLearningRule(1e-1), init_loss_scale=8.)
+    half_params = _run(
+        rule, [param.astype(np.float16) for param in params],
+        [[(8. * grad).astype(np.float16) for grad in grads]
+         for grads in grads_sequence])
+    for master_param, half_param, expected_param in zip(
+            rule.master_params, half_params, expected):
+        assert master_param.dtype == np.float32
+        assert half_param.dtype == np.float16
+        assert np.allclose(master_param, expected_param, atol=1e-2)
+        assert np.array_equal(half_param, master_param.astype(np.float16))
+
+
+def test_mixed_precision_skips_non_finite_steps():
+    params = [np.ones((2, 3), np.float16)]
+    rule = MixedPrecisionLearningRule(
+        GradientDescentLearningRule(1e-1), init_loss_scale=4.)
+    rule.initialise(params)
+    grads = [np.full((2, 3), np.inf, np.float16)]
+    rule.update_params(grads)
+    assert np.array_equal(params[0], np.ones((2, 3)))
+    assert np.array_equal(rule.master_params[0], np.ones((2, 3)))
+    assert rule.loss_scale == 2.
+    assert rule.num_skipped_steps == 1
+    grads[0][0, 0] = np.nan
+    rule.update_params(grads)
+    assert rule.loss_scale == 1.
+    assert rule.num_skipped_steps == 2
+
+
+def test_mixed_precision_loss_scale_schedule():
+    params = [np.ones(3, np.float16)]
+    rule = MixedPrecisionLearningRule(
+        GradientDescentLearningRule(1e-3), init_loss_scale=4.,
+        growth_factor=2., backoff_factor=0.5, growth_interval=2)
+    rule.initialise(params)
+    finite = [np.ones(3, np.float16)]
+    scales = []
+    for grads in (finite, finite, finite, [np.full(3, np.inf, np.float16)],
+                  finite, finite):
+        rule.update_params(grads)
+        scales.append(rule.loss_scale)
+    # grows after every two consecutive finite steps and halves on overflow
+    assert scales == [4., 8., 8., 4., 4., 8.]
+    rule.reset()
+    assert rule.loss_scale == 4. and rule.num_skipped_steps == 0
+
+
+def test_flat_updates_match_per_parameter_updates():
+    rng = np.random.RandomState(1)
+    params = _random_arrays(rng)
+    grads_sequence = [_random_arrays(rng) for _ in range(5)]
+    penalties = [L2Penalty(1e-2), None, L1Penalty(1e-3)]
+    for penalty_list in (None, penalties):
+        for rule, flat_rule in zip(_all_learning_rules(),
+                                   _all_learning_rules()):
+            expected = _run(
+                rule, [param.copy() for param in params],
+                [[grad.copy() for grad in grads]
+                 for grads in grads_sequence], penalty_list)
+            flat = _run(
+                flat_rule, _as_flat(params),
+                [_as_flat(grads) for grads in grads_sequence], penalty_list)
+            for param, flat_param in zip(expected, flat):
+                assert np.allclose(param, flat_param), rule
+
+
+def test_penalties_in_rule_match_penalty_grads():
+    rng = np.random.RandomState(2)
+    params = _random_arrays(rng)
+    grads_sequence = [_random_arrays(rng) for _ in range(3)]
+    penalties = [L2Penalty(1e-1), L1Penalty(1e-2), None]
+    for rule, plain_rule in zip(_all_learning_rules(),
+                                _all_learning_rules()):
+        expected = [param.copy() for param in params]
+        plain_rule.initialise(expected)
+        for grads in grads_sequence:
+            plain_rule.update_params([
+                grad if penalty is None else grad + penalty.grad(param)
+                for grad, param, penalty in zip(grads, expected, penalties)])
+        updated = _run(
+            rule, [param.copy() for param in params],
+            [[grad.copy() for grad in grads] for grads in grads_sequence],
+            penalties)
+        for param, expected_param in zip(updated, expected):
+            assert np.allclose(param, expected_param), rule
+
+
+def _sparse_grads_sequence(rng, num_steps=15, shape=(4, 6), num_active=2):
+    grads_sequence = []
+    for _ in range(num_steps):
+        active = np.sort(rng.choice(shape[1], num_active, replace=False))
+        grad = np.zeros(shape)
+        grad[:, active] = rng.standard_normal((shape[0], num_active))
+        grads_sequence.append((grad, active))
+    return grads_sequence
+
+
+def test_sparse_updates_match_dense_updates():
+    # zero gradients leave the parameters unchanged for these rules so the
+    # lazy sparse updates are exact
+    for rule_class in (AdaGradLearningRule, RMSPropLearningRule):
+        rng = np.random.RandomState(3)
+        params = [rng.standard_normal((4, 6))]
+        grads_sequence = _sparse_grads_sequence(rng)
+        dense = _run(rule_class(), [params[0].copy()],
+                     [[grad.copy()] for grad, _ in grads_sequence])
+        sparse = _run(rule_class(), [params[0].copy()], [
+            [SliceSparseArray.wrap(grad.copy(), active, 1)]
+            for grad, active in grads_sequence])
+        assert np.allclose(dense[0], sparse[0]), rule_class
+
+
+def test_sparse_moments_match_dense_moments():
+    for rule_class, names in ((AdamLearningRule, ('moms_1', 'moms_2')),
+                              (RMSPropLearningRule, ('moms_2',))):
+        rng = np.random.RandomState(4)
+        grads_sequence = _sparse_grads_sequence(rng)
+        dense_rule, sparse_rule = rule_class(), rule_class()
+        _run(dense_rule, [np.zeros((4, 6))],
+             [[grad.copy()] for grad, _ in grads_sequence])
+        _run(sparse_rule, [np.zeros((4, 6))], [
+            [SliceSparseArray.wrap(grad.copy(), active, 1)]
+            for grad, active in grads_sequence])
+        # a dense update first applies the decays deferred by sparse ones
+        final_grad = rng.standard_normal((4, 6))
+        dense_rule.update_params([final_grad.copy()])
+        sparse_rule.update_params([final_grad.copy()])
+        assert not sparse_rule._last_steps
+        for name in names:
+            assert np.allclose(getattr(dense_rule, name)[0],
+                               getattr(sparse_rule, name)[0]), name
+
+
+def test_sparse_grads_with_penalty_use_dense_update():
+    rng = np.random.RandomState(5)
+    grads_sequence = _sparse_grads_sequence(rng, num_steps=3)
+    dense = _run(AdamLearningRule(), [np.ones((4, 6))],
+                 [[grad.copy()] for grad, _ in grads_sequence],
+                 [L2Penalty(1e-1)])
+    sparse = _run(AdamLearningRule(), [np.ones((4, 6))], [
+        [SliceSparseArray.wrap(grad.copy(), active, 1)]
+        for grad, active in grads_sequence], [L2Penalty(1e-1)])
+    assert np.allclose(dense[0], sparse[0])
+
+
+def test_adam_with_weight_decay():
+    rng = np.random.RandomState(6)
+    params = _random_arrays(rng)
+    grads_sequence = [_random_arrays(rng) for _ in range(4)]
+    # without decay the updates are those of Adam
+    adam = _run(AdamLearningRule(), [param.copy() for param in params],
+                grads_sequence)
+    adam_w = _run(AdamLearningRuleWithWeightDecay(weight_decay=0.),
+                  [param.copy() for param in params], grads_sequence)
+    for param, param_w in zip(adam, adam_w):
+        assert np.allclose(param, param_w)
+    # a single step decays the parameters and subtracts the Adam step
+    learning_rate, decay = 1e-2, 1e-1
+    adam = _run(AdamLearningRule(learning_rate),
+                [param.copy() for param in params], grads_sequence[:1])
+    adam_w = _run(
+        AdamLearningRuleWithWeightDecay(learning_rate, weight_decay=decay),
+        [param.copy() for param in params], grads_sequence[:1])
+    for param, adam_param, adam_w_param in zip(params, adam, adam_w):
+        assert np.allclose(adam_w_param, adam_param - decay * param)
+
+
+def test_lars_trust_ratio():
+    params = [np.ones((3, 4))]
+    rule = LARSLearningRule(
+        learning_rate=1., mom_coeff=0., trust_coefficient=1e-2)
+    _run(rule, params, [[np.full((3, 4), 100.)]])
+    # the relative change is the trust coefficient whatever the gradient
+    assert np.allclose(params[0], 1. - 1e-2)
+    # zero parameters fall back to a trust ratio of the trust coefficient
+    params = [np.zeros((3, 4))]
+    _run(LARSLearningRule(learning_rate=0.5, mom_coeff=0.), params,
+         [[np.ones((3, 4))]])
+    assert np.allclose(params[0], -0.5 * 1e-3)
+    # as do vectors such as biases, which are not weight decayed
+    params = [np.ones(3)]
+    _run(LARSLearningRule(learning_rate=1., mom_coeff=0.,
+                          trust_coefficient=1e-2, weight_decay=0.1),
+         params, [[np.full(3, 10.)]])
+    assert np.allclose(params[0], 0.9)
+
+
+def test_lamb_trust_ratio():
+    for grad_scale in (1e-5, 1e5):
+        params = [np.ones((3, 4))]
+        _run(LAMBLearningRule(learning_rate=1e-2), params,
+             [[np.full((3, 4), grad_scale)]])
+        assert np.allclose(params[0], 1. - 1e-2)
@@ -0,0 +1,351 @@
+"""Tests of the models' execution modes against plain serial execution."""
+
+import copy
+import gc
+import os
+import tracemalloc
+import numpy as np
+import weakref
+import pytest
+import mlp
+from mlp.arrays import FlatArrayList
+from mlp.data_providers import CCPPDataProvider
+from mlp.errors import CrossEntropySoftmaxError, SumOfSquaredDiffsError
+from mlp.layers import (
+    AffineLayer, ConvolutionalLayer, DropoutLayer, MaxPooling2DLayer,
+    ReluLayer, ReshapeLayer, TanhLayer, RadialBasisFunctionLayer)
+from mlp.initialisers import ConstantInit, UniformInit
+from mlp.learning_rules import GradientDescentLearningRule
+from mlp.models import MultipleLayerModel
+from mlp.optimisers import Optimiser
+
+
+def _layers(dropout=False):
+    rng = np.random.RandomState(1)
+    layers = [
+        ReshapeLayer((2, 5, 5)),
+        ConvolutionalLayer(2, 3, 5, 5, 3, 3, padding=1),
+        ReluLayer(),
+        ReshapeLayer((75,)),
+        AffineLayer(75, 20),
+        TanhLayer(),
+        AffineLayer(20, 4),
+    ]
+    if dropout:
+        layers.insert(5, DropoutLayer(rng, incl_prob=0.8,
+                                      share_across_batch=False))
+    for layer in layers:
+        if hasattr(layer, 'params'):
+            layer.params = [
+                rng.uniform(-0.5, 0.5, param.shape).astype(param.dtype)
+                for param in layer.params]
+    return layers
+
+
+def _copy_params(source_layers, layers):
+    for source, layer in zip(source_layers, layers):
+        if hasattr(layer, 'params'):
+            layer.params = [param.copy() for param in source.params]
+    return layers
+
+
+def _batch(batch_size=10, seed=2):
+    rng = np.random.RandomState(seed)
+    inputs = rng.standard_normal((batch_size, 50)).astype(np.float32)
+    targets = np.eye(4, dtype=np.float32)[rng.randint(4, size=batch_size)]
+    return inputs, targets
+
+
+def _outputs_and_grads(model, inputs, targets):
+    activations = model.fprop(inputs)
+    grads_wrt_outputs = CrossEntropySoftmaxError().grad(
+        activations[-1], targets)
+    grads = model.grads_wrt_params(activations, grads_wrt_outputs)
+    return activations, [grad.copy() for grad in grads]
+
+
+def _assert_all_close(arrays, expected_arrays):
+    assert len(arrays) == len(expected_arrays)
+    for array, expected in zip(arrays, expected_arrays):
+        assert np.allclose(array, expected, atol=1e-5)
+
+
+def _check_matches_plain_model(**kwargs):
+    """Checks a model created with `kwargs` matches the plain model.
+
+    Returns the model checked.
+    """
+    inputs, targets = _batch()
+    layers = _layers()
+    expected_activations, expected_grads = _outputs_and_grads(
+        MultipleLayerModel(layers), inputs, targets)
+    model = MultipleLayerModel(_copy_params(layers, _layers()), **kwargs)
+    # repeat to check any reused buffers give the same results
+    for _ in range(2):
+        activations, grads = _outputs_and_grads(model, inputs, targets)
+        _assert_all_close(activations, expected_activations)
+        _assert_all_close(grads, expected_grads)
+    return model
+
+
+def test_buffer_arena_matches_plain_model():
+    model = _check_matches_plain_model(use_buffer_arena=True)
+    inputs, _ = _batch()
+    outputs = model.fprop(inputs)[-1]
+    assert model.fprop(inputs)[-1] is outputs
+    # other batch shapes get their own buffers
+    assert model.fprop(inputs[:3])[-1] is not outputs
+
+
+def test_default_dtype_honoured_by_initialisers_and_layers():
+    previous = mlp.get_default_dtype()
+    try:
+        for dtype in (np.float32, np.float64):
+            mlp.set_default_dtype(dtype)
+            assert UniformInit(-1., 1.)((3, 2)).dtype == dtype
+            assert ConstantInit(0.)(3).dtype == dtype
+            layer = AffineLayer(4, 3)
+            assert all(param.dtype == dtype for param in layer.params)
+    finally:
+        mlp.set_default_dtype(previous)
+    # an explicit dtype overrides the default
+    assert ConstantInit(0., dtype=np.float16)(3).dtype == np.float16
+
+
+def test_model_dtype_casts_params_and_asserts_no_upcast():
+    inputs, targets = _batch()
+    layers = _layers()
+    for layer in layers:
+        if hasattr(layer, 'params'):
+            layer.params = [param.astype(np.float64)
+                            for param in layer.params]
+    model = MultipleLayerModel(layers, dtype=np.float32)
+    assert all(param.dtype == np.float32 for param in model.params)
+    # float64 inputs and targets are cast rather than upcasting the model
+    activations, grads = _outputs_and_grads(
+        model, inputs.astype(np.float64), targets.astype(np.float64))
+    assert all(acts.dtype == np.float32 for acts in activations)
+    assert all(grad.dtype == np.float32 for grad in grads)
+    # a single double precision parameter upcasting the outputs is caught
+    layers[-1].weights = layers[-1].weights.astype(np.float64)
+    try:
+        model.fprop(inputs)
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError('Expected the upcast to be detected.')
+
+
+def test_sharded_model_matches_plain_model():
+    for num_shards in (1, 3):
+        _check_matches_plain_model(num_shards=num_shards)
+    # batches smaller than the shard count use one shard per input
+    model = MultipleLayerModel(_layers(), num_shards=3)
+    inputs, targets = _batch(batch_size=2)
+    _assert_all_close(
+        _outputs_and_grads(model, inputs, targets)[1],
+        _outputs_and_grads(MultipleLayerModel(_layers()), inputs, targets)[1])
+
+
+def test_sharded_model_with_dropout_matches_plain_model():
+    inputs, targets = _batch(batch_size=11)
+    for share_across_batch in (False, True):
+        plain_layers = _layers(dropout=True)
+        layers = _layers(dropout=True)
+        for dropout in (plain_layers[5], layers[5]):
+            dropout.share_across_batch = share_across_batch
+        plain_model = MultipleLayerModel(plain_layers)
+        model = MultipleLayerModel(layers, num_shards=3)
+        # new masks are drawn for each batch from the unsharded layer
+        for _ in range(2):
+            activations, grads = _outputs_and_grads(model, inputs, targets)
+            expected_activations, expected_grads = _outputs_and_grads(
+                plain_model, inputs, targets)
+            _assert_all_close(activations, expected_activations)
+            _assert_all_close(grads, expected_grads)
+        assert layers[5].get_rng_state() == plain_layers[5].get_rng_state()
+
+
+def test_checkpointed_model_matches_plain_model():
+    inputs, targets = _batch()
+    layers = _layers(dropout=True)
+    dropout = layers[5]
+    state = dropout.get_rng_state()
+    expected_activations, expected_grads = _outputs_and_grads(
+        MultipleLayerModel(layers), inputs, targets)
+    for checkpoints in ([2, 5], 'sqrt'):
+        dropout.set_rng_state(state)
+        model = MultipleLayerModel(layers, checkpoints=checkpoints)
+        activations, grads = _outputs_and_grads(model, inputs, targets)
+        kept = set([0, len(layers)]) | set(model.checkpoints)
+        for i, (activation, expected) in enumerate(
+                zip(activations, expected_activations)):
+            if i in kept:
+                assert np.allclose(activation, expected)
+            else:
+                assert activation is None
+        # the dropout masks are replayed when recomputing the activations
+        _assert_all_close(grads, expected_grads)
+
+
+def test_checkpointed_model_frees_discarded_activations():
+    inputs, targets = _batch()
+    rng = np.random.RandomState(1)
+    layers = [
+        ReshapeLayer((2, 5, 5)),
+        ConvolutionalLayer(2, 3, 5, 5, 3, 3, padding=1),
+        ReluLayer(),
+        MaxPooling2DLayer(5, 5, 3, 1),
+        ReshapeLayer((27,)),
+        AffineLayer(27, 4),
+    ]
+    for layer in layers:
+        if hasattr(layer, 'params'):
+            layer.params = [
+                rng.uniform(-0.5, 0.5, param.shape).astype(param.dtype)
+                for param in layer.params]
+    expected_activations, expected_grads = _outputs_and_grads(
+        MultipleLayerModel(layers), inputs, targets)
+    for layer in layers:
+        layer.clear_cache()
+    outputs = []
+
+    def recording(fprop):
+        def recording_fprop(*args, **kwargs):
+            result = fprop(*args, **kwargs)
+            outputs.append(weakref.ref(result))
+            return result
+        return recording_fprop
+
+    for layer in layers:
+        layer.fprop = recording(layer.fprop)
+    model = MultipleLayerModel(layers, checkpoints=[3])
+    activations = model.fprop(inputs)
+    gc.collect()
+    # only the checkpointed activations are still referenced
+    alive = [i + 1 for i, ref in enumerate(outputs) if ref() is not None]
+    assert alive == [3, 6]
+    del outputs[:]
+    grads = model.grads_wrt_params(
+        activations, CrossEntropySoftmaxError().grad(
+            activations[-1], targets))
+    gc.collect()
+    # nor are the recomputed activations after the backward pass
+    assert len(outputs) > 0
+    assert all(ref() is None for ref in outputs)
+    _assert_all_close(grads, expected_grads)
+
+
+def test_compiled_plan_matches_model():
+    inputs, targets = _batch()
+    model = MultipleLayerModel(_layers())
+    expected_activations, expected_grads = _outputs_and_grads(
+        model, inputs, targets)
+    plan = model.compile(inputs.shape)
+    assert plan.output_shape == (inputs.shape[0], 4)
+    for _ in range(2):
+        activations, grads = _outputs_and_grads(plan, inputs, targets)
+        _assert_all_close(activations, expected_activations)
+        _assert_all_close(grads, expected_grads)
+    # other batch shapes fall back to the model
+    _assert_all_close(plan.fprop(inputs[:3]), model.fprop(inputs[:3]))
+    # incompatible layers are reported when compiling
+    try:
+        model.compile((10, 49))
+    except AssertionError:
+        pass
+    else:
+        raise AssertionError('Expected incompatible shapes to be detected.')
+
+
+def test_compiled_plan_recompiles_when_params_reassigned():
+    inputs, targets = _batch()
+    layers = _layers(dropout=True)
+    model = MultipleLayerModel(layers)
+    plan = model.compile(inputs.shape)
+    buffers = plan._train_buffers
+    plan.fprop(inputs)
+    # updating the parameters in place keeps the compiled plan
+    assert plan._train_buffers is buffers
+    layers[4].params = [param * 2. for param in layers[4].params]
+    state = layers[5].get_rng_state()
+    activations, grads = _outputs_and_grads(plan, inputs, targets)
+    assert plan._train_buffers is not buffers
+    assert all(param is layer_param
+               for param, layer_param in zip(plan.params, model.params))
+    layers[5].set_rng_state(state)
+    expected_activations, expected_grads = _outputs_and_grads(
+        model, inputs, targets)
+    _assert_all_close(activations, expected_activations)
+    _assert_all_close(grads, expected_grads)
+
+
+def test_model_copy_uses_replicated_layers():
+    inputs, _ = _batch()
+    model = MultipleLayerModel(_layers(dropout=True))
+    replica = copy.copy(model)
+    replica.layers = [layer.replicate() for layer in model.layers]
+    state = model.layers[5].get_rng_state()
+    replica_state = replica.layers[5].get_rng_state()
+    replica.fprop(inputs)
+    # only the replica's dropout layer has sampled a mask
+    assert model.layers[5].get_rng_state() == state
+    assert replica.layers[5].get_rng_state() != replica_state
+
+
+def test_predict_chunks_match_fprop():
+    inputs, _ = _batch(batch_size=11)
+    model = MultipleLayerModel(_layers(dropout=True))
+    expected = model.fprop(inputs, evaluation=True)[-1]
+    for chunk_size in (None, 1, 4, 11, 20):
+        chunks = list(model.predict(inputs, chunk_size))
+        assert np.allclose(np.concatenate(chunks), expected)
+
+
+def test_flat_params_match_plain_model():
+    model = _check_matches_plain_model(flat_params=True)
+    assert isinstance(model.params, FlatArrayList)
+    _assert_all_close(model.params, MultipleLayerModel(_layers()).params)
+    # the gradients are views of a single flat array
+    inputs, targets = _batch()
+    activations = model.fprop(inputs)
+    grads = model.grads_wrt_params(
+        activations, CrossEntropySoftmaxError().grad(activations[-1], targets))
+    assert isinstance(grads, FlatArrayList)
+
+
+def test_truncated_rbf_model_trains_without_dense_outputs(monkeypatch):
+    data_dir = os.environ.get('MLP_DATA_DIR', os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data'))
+    if not os.path.isfile(os.path.join(data_dir, 'ccpp_data.npz')):
+        pytest.skip('CCPP data not available.')
+    monkeypatch.setenv('MLP_DATA_DIR', data_dir)
+    dataset = CCPPDataProvider(batch_size=100, max_num_batches=10,
+                               rng=np.random.RandomState(1))
+    grid_dim = 20
+    intervals = list(zip(dataset.inputs.min(0), dataset.inputs.max(0)))
+    output_dim = 4 * grid_dim**4
+    model = MultipleLayerModel([
+        RadialBasisFunctionLayer(grid_dim, intervals, support=3.),
+        AffineLayer(output_dim, 1, ConstantInit(0.))
+    ])
+    error = SumOfSquaredDiffsError()
+    optimiser = Optimiser(model, error, GradientDescentLearningRule(1e-5),
+                          dataset)
+
+    def mean_error():
+        return np.mean([error(model.fprop(inputs)[-1], targets)
+                        for inputs, targets in dataset])
+    initial_error = mean_error()
+    tracemalloc.start()
+    try:
+        for _ in range(3):
+            optimiser.do_training_epoch()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    assert mean_error() < 0.75 * initial_error
+    # the dense layer outputs for a batch would need far more memory
+    dense_bytes = (dataset.batch_size * output_dim *
+                   np.dtype(mlp.get_default_dtype()).itemsize)
+    assert peak < dense_bytes / 10
@@ -0,0 +1,285 @@
+"""Tests of the model optimisers."""
+
+import multiprocessing
+import numpy as np
+from mlp.arrays import FlatArrayList
+from mlp.data_providers import DataProvider
+from mlp.errors import CrossEntropySoftmaxError
+from mlp.layers import AffineLayer, DropoutLayer, TanhLayer
+from mlp.learning_rules import (
+    GradientDescentLearningRule, MixedPrecisionLearningRule)
+from mlp.models import MultipleLayerModel, SingleLayerModel
+import mlp.optimisers as optimiser_module
+from mlp.optimisers import (
+    Optimiser, DataParallelOptimiser, HogwildOptimiser)
+from mlp.penalties import L2Penalty
+
+
+def _dataset(num_data=64, input_dim=5, num_classes=3, batch_size=8, seed=1):
+    rng = np.random.RandomState(seed)
+    inputs = rng.standard_normal((num_data, input_dim)).astype(np.float32)
+    targets = np.eye(num_classes, dtype=np.float32)[
+        rng.randint(num_classes, size=num_data)]
+    return DataProvider(inputs, targets, batch_size,
+                        rng=np.random.RandomState(seed))
+
+
+def test_hogwild_stats_valid_after_train():
+    dataset = _dataset()
+    model = SingleLayerModel(AffineLayer(5, 3))
+    optimiser = HogwildOptimiser(
+        model, CrossEntropySoftmaxError(), GradientDescentLearningRule(1e-2),
+        dataset, num_workers=2)
+    optimiser.train(num_epochs=2, stats_interval=1)
+    # the shared memory blocks have been freed by `train` closing the
+    # optimiser so this would crash if the counts still used them
+    assert optimiser._update_counts.sum() == 2 * dataset.num_batches
+    assert len(optimiser.epoch_staleness) == 2
+    assert all(staleness.shape == (dataset.num_batches,)
+               for staleness in optimiser.epoch_staleness)
+    assert len(optimiser.epoch_throughputs) == 2
+    # closing again is a no-op
+    optimiser.close()
+
+
+def test_hogwild_batch_error_and_grads():
+    dataset = _dataset()
+    model = SingleLayerModel(AffineLayer(5, 3))
+    error = CrossEntropySoftmaxError()
+    optimiser = HogwildOptimiser(
+        model, error, GradientDescentLearningRule(1e-2), dataset,
+        num_workers=2)
+    try:
+        inputs, targets = dataset.next()
+        batch_error, grads = optimiser.batch_error_and_grads(inputs, targets)
+        outputs = model.fprop(inputs)[-1]
+        assert np.allclose(batch_error, error(outputs, targets))
+        expected = model.grads_wrt_params(
+            [inputs, outputs], error.grad(outputs, targets))
+        for grad, expected_grad in zip(grads, expected):
+            assert np.allclose(grad, expected_grad)
+        # training still works after computing gradients in this process
+        optimiser.do_training_epoch()
+    finally:
+        optimiser.close()
+
+
+def test_data_parallel_micro_batches_match_whole_batch():
+    dataset = _dataset(batch_size=16)
+    inputs, targets = dataset.next()
+    error = CrossEntropySoftmaxError()
+    model = SingleLayerModel(AffineLayer(5, 3))
+    expected_error, expected_grads = Optimiser(
+        model, error, GradientDescentLearningRule(), dataset
+    ).batch_error_and_grads(inputs, targets)
+    expected_grads = [grad.copy() for grad in expected_grads]
+    optimiser = DataParallelOptimiser(
+        model, error, GradientDescentLearningRule(), dataset,
+        num_workers=2, micro_batch_size=3, eval_chunk_size=5,
+        monitor_penalty=True)
+    try:
+        assert optimiser.micro_batch_size == 3
+        assert optimiser.eval_chunk_size == 5
+        batch_error, grads = optimiser.batch_error_and_grads(
+            inputs, targets)
+    finally:
+        optimiser.close()
+    assert np.allclose(batch_error, expected_error)
+    for grad, expected_grad in zip(grads, expected_grads):
+        assert np.allclose(grad, expected_grad, atol=1e-6)
+
+
+def test_parallel_optimisers_monitor_penalty():
+    for optimiser_class in (DataParallelOptimiser, HogwildOptimiser):
+        model = SingleLayerModel(AffineLayer(
+            5, 3, weights_penalty=L2Penalty(1e-2)))
+        optimiser = optimiser_class(
+            model, CrossEntropySoftmaxError(),
+            GradientDescentLearningRule(1e-2), _dataset(), num_workers=2,
+            micro_batch_size=4, monitor_penalty=True)
+        stats, keys, _ = optimiser.train(num_epochs=1, stats_interval=1)
+        assert 'params_penalty' in keys
+        assert np.allclose(stats[-1, keys['params_penalty']],
+                           model.params_penalty())
+
+
+def test_optimiser_leaves_layer_penalty_grads_enabled():
+    dataset = _dataset()
+    inputs, targets = dataset.next()
+    error = CrossEntropySoftmaxError()
+    layer = AffineLayer(5, 3, weights_penalty=L2Penalty(1e-1))
+    model = SingleLayerModel(layer)
+    optimiser = Optimiser(
+        model, error, GradientDescentLearningRule(1e-2), dataset)
+    optimiser.train(num_epochs=1, stats_interval=1)
+    assert layer.include_penalty_grads
+    # the optimiser's learning rule adds the penalty gradients so they are
+    # only excluded from the gradients the optimiser calculates
+    _, grads = optimiser.batch_error_and_grads(inputs, targets)
+    outputs = model.fprop(inputs)[-1]
+    model_grads = model.grads_wrt_params(
+        [inputs, outputs], error.grad(outputs, targets))
+    assert np.allclose(model_grads[0] - grads[0],
+                       layer.weights_penalty.grad(layer.weights))
+    assert np.allclose(model_grads[1], grads[1])
+
+
+class _UnpenalisedGradientDescent(GradientDescentLearningRule):
+    """Learning rule overriding `initialise` without a penalties argument."""
+
+    def initialise(self, params):
+        super(_UnpenalisedGradientDescent, self).initialise(params)
+
+
+def test_optimiser_with_rule_not_accepting_penalties():
+    error = CrossEntropySoftmaxError()
+    layer = AffineLayer(5, 3, weights_penalty=L2Penalty(1e-1))
+    expected_layer = AffineLayer(5, 3, weights_penalty=L2Penalty(1e-1))
+    expected_layer.params = [param.copy() for param in layer.params]
+    optimiser = Optimiser(
+        SingleLayerModel(layer), error, _UnpenalisedGradientDescent(1e-1),
+        _dataset())
+    # the layers still add the penalty gradients themselves
+    assert optimiser._penalty_layers == []
+    optimiser.train(num_epochs=1, stats_interval=1)
+    Optimiser(SingleLayerModel(expected_layer), error,
+              GradientDescentLearningRule(1e-1), _dataset()).train(
+        num_epochs=1, stats_interval=1)
+    for param, expected in zip(layer.params, expected_layer.params):
+        assert np.allclose(param, expected, atol=1e-6)
+    # including when wrapped by a learning rule passing the penalties on
+    optimiser = Optimiser(
+        SingleLayerModel(layer), error,
+        MixedPrecisionLearningRule(_UnpenalisedGradientDescent(1e-1)),
+        _dataset())
+    assert optimiser._penalty_layers == []
+
+
+def test_data_parallel_training_matches_serial_training():
+    error = CrossEntropySoftmaxError()
+    serial_model = SingleLayerModel(AffineLayer(5, 3))
+    parallel_layer = AffineLayer(5, 3)
+    parallel_layer.params = [param.copy() for param in serial_model.params]
+    parallel_model = SingleLayerModel(parallel_layer)
+    Optimiser(serial_model, error, GradientDescentLearningRule(1e-1),
+              _dataset()).train(num_epochs=2, stats_interval=1)
+    DataParallelOptimiser(
+        parallel_model, error, GradientDescentLearningRule(1e-1),
+        _dataset(), num_workers=3).train(num_epochs=2, stats_interval=1)
+    for param, serial_param in zip(parallel_model.params,
+                                   serial_model.params):
+        assert np.allclose(param, serial_param, atol=1e-5)
+
+
+def test_data_parallel_training_keeps_param_storage():
+    error = CrossEntropySoftmaxError()
+    for flat_params in (False, True):
+        layers = [AffineLayer(5, 4), TanhLayer(), AffineLayer(4, 3)]
+        serial_model = MultipleLayerModel(
+            [AffineLayer(5, 4), TanhLayer(), AffineLayer(4, 3)])
+        for layer, serial_layer in zip(layers, serial_model.layers):
+            if hasattr(layer, 'params'):
+                serial_layer.params = [
+                    param.copy() for param in layer.params]
+        model = MultipleLayerModel(layers, flat_params=flat_params)
+        params = model.params
+        learning_rule = GradientDescentLearningRule(1e-1)
+        optimiser = DataParallelOptimiser(
+            model, error, learning_rule, _dataset(), num_workers=2)
+        assert all(param is original
+                   for param, original in zip(model.params, params))
+        optimiser.train(num_epochs=1, stats_interval=1)
+        # the trained values are copied back into the original arrays
+        assert all(param is original
+                   for param, original in zip(model.params, params))
+        assert isinstance(model.params, FlatArrayList) == flat_params
+        assert all(param is original
+                   for param, original in zip(learning_rule.params, params))
+        assert not optimiser_module._unlinked_shared_memory
+        # training can continue, serially or in parallel
+        Optimiser(serial_model, error, GradientDescentLearningRule(1e-1),
+                  _dataset()).train(num_epochs=2, stats_interval=1)
+        optimiser.do_training_epoch()
+        optimiser.close()
+        for param, serial_param in zip(model.params, serial_model.params):
+            assert np.allclose(param, serial_param, atol=1e-5)
+
+
+def test_data_parallel_flat_grads():
+    dataset = _dataset()
+    inputs, targets = dataset.next()
+    error = CrossEntropySoftmaxError()
+    layers = [AffineLayer(5, 4), TanhLayer(), AffineLayer(4, 3)]
+    model = MultipleLayerModel(layers, flat_params=True)
+    expected_error, expected_grads = Optimiser(
+        model, error, GradientDescentLearningRule(), dataset
+    ).batch_error_and_grads(inputs, targets)
+    expected_grads = [grad.copy() for grad in expected_grads]
+    optimiser = DataParallelOptimiser(
+        model, error, GradientDescentLearningRule(), dataset,
+        num_workers=2)
+    try:
+        batch_error, grads = optimiser.batch_error_and_grads(
+            inputs, targets)
+        # reduced into flat gradients for a whole-buffer update
+        assert isinstance(grads, FlatArrayList)
+        assert np.allclose(batch_error, expected_error)
+        for grad, expected_grad in zip(grads, expected_grads):
+            assert np.allclose(grad, expected_grad, atol=1e-6)
+    finally:
+        optimiser.close()
+
+
+def test_parallel_optimisers_close_safety():
+    for optimiser_class in (DataParallelOptimiser, HogwildOptimiser):
+        dataset = _dataset()
+        model = SingleLayerModel(AffineLayer(5, 3))
+        optimiser = optimiser_class(
+            model, CrossEntropySoftmaxError(),
+            GradientDescentLearningRule(1e-2), dataset, num_workers=2)
+        # closing before any workers are started
+        optimiser.close()
+        model = SingleLayerModel(AffineLayer(5, 3))
+        optimiser = optimiser_class(
+            model, CrossEntropySoftmaxError(),
+            GradientDescentLearningRule(1e-2), dataset, num_workers=2)
+        optimiser.train(num_epochs=1, stats_interval=1)
+        optimiser.close()
+        # the parameters remain usable (and writable) after closing, without
+        # keeping any shared memory mapped
+        assert not optimiser_module._unlinked_shared_memory
+        params = [param.copy() for param in model.params]
+        model.fprop(dataset.inputs)
+        for param in model.params:
+            param *= 2.
+        for param, copied in zip(model.params, params):
+            assert np.allclose(param, 2. * copied)
+
+
+def test_hogwild_workers_draw_independent_dropout_masks(monkeypatch):
+    masks = multiprocessing.get_context('fork').Queue()
+    hogwild_worker = optimiser_module._hogwild_worker
+
+    def recording_worker(worker_index, seed, model, *args):
+        # record the first mask each worker's model samples
+        outputs = model.fprop(np.ones((8, 5), np.float32))[1]
+        masks.put((worker_index, outputs != 0))
+        hogwild_worker(worker_index, seed, model, *args)
+
+    monkeypatch.setattr(
+        optimiser_module, '_hogwild_worker', recording_worker)
+    dropout = DropoutLayer(np.random.RandomState(1), incl_prob=0.5,
+                           share_across_batch=False)
+    state = dropout.get_rng_state()
+    model = MultipleLayerModel([dropout, AffineLayer(5, 3)])
+    optimiser = HogwildOptimiser(
+        model, CrossEntropySoftmaxError(), GradientDescentLearningRule(1e-2),
+        _dataset(), num_workers=2)
+    try:
+        optimiser.do_training_epoch()
+        worker_masks = dict(masks.get(timeout=10) for _ in range(2))
+    finally:
+        optimiser.close()
+    assert not np.array_equal(worker_masks[0], worker_masks[1])
+    # the layer's own generator is left unchanged
+    assert dropout.get_rng_state() == state